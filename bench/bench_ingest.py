@@ -0,0 +1,118 @@
+#
+#   End-to-end PubMed ingest benchmark
+#
+#   generates synthetic PubMed files (test/make_pubmed_xml.py), starts a fake
+#   RobotReviewer (test/fake_robotreviewer.py), builds a scratch schema with
+#   dbutil.make_tables/migrate in the database from trialstreamer/config.json, and
+#   reports records/s for each stage:
+#
+#     iter_abstracts       parsing only
+#     classify             RobotReviewer round trips for the parsed records
+#     upload_to_postgres   the whole pipeline (parse, classify, write)
+#
+#   nothing outside the scratch schema and a temporary directory is touched
+#
+#   python bench/bench_ingest.py [--files 2] [--records 10000] [--latency 0.2] [--workers 1]
+#
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+
+from fake_robotreviewer import FakeRobotReviewer
+from make_pubmed_xml import write_pubmed_files
+from trialstreamer import config, dbutil, pubmed, rrclient
+
+SCHEMA = "bench_ingest"
+
+
+def scratch_schema():
+    cur = dbutil.db.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};".format(SCHEMA))
+    cur.close()
+    dbutil.db.commit()
+    # and for the connections opened later (e.g. the classification cache's)
+    os.environ['PGOPTIONS'] = '-c search_path={}'.format(SCHEMA)
+    dbutil.make_tables()
+    dbutil.migrate()
+
+
+def drop_scratch_schema():
+    dbutil.db.rollback()
+    cur = dbutil.db.cursor()
+    cur.execute("SET search_path TO public; DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
+    cur.close()
+    dbutil.db.commit()
+
+
+def count(table):
+    cur = dbutil.db.cursor()
+    cur.execute("SELECT count(*) FROM {};".format(table))
+    n = cur.fetchone()[0]
+    cur.close()
+    return n
+
+
+def report(name, n, elapsed, unit="records"):
+    print("{:20s} {:8d} {} in {:7.1f}s  {:8.0f} {}/s".format(name, n, unit, elapsed, n / max(elapsed, 1e-9), unit))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='End-to-end PubMed ingest benchmark')
+    argparser.add_argument('--files', type=int, default=2)
+    argparser.add_argument('--records', type=int, default=10000, help='citations per file')
+    argparser.add_argument('--batch-size', type=int, default=5000)
+    argparser.add_argument('--workers', type=int, default=1, help='parse processes')
+    argparser.add_argument('--latency', type=float, default=0.2, help='fake RobotReviewer seconds per report')
+    argparser.add_argument('--per-doc', type=float, default=0.0002, help='fake RobotReviewer seconds per article')
+    argparser.add_argument('--rr-workers', type=int, default=1, help='fake RobotReviewer reports processed at once')
+    argparser.add_argument('--keep', action='store_true', help="keep the scratch schema and files")
+    args = argparser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    data_dir = tempfile.mkdtemp(prefix="bench_ingest_")
+    config.PUBMED_LOCAL_DATA_PATH = data_dir
+
+    print("writing {} files of {} citations to {}".format(args.files, args.records, data_dir))
+    fns = write_pubmed_files(data_dir, args.files, args.records)
+    ftp_fns = ["/pubmed/baseline/" + os.path.basename(fn) for fn in fns]
+
+    with FakeRobotReviewer(latency=args.latency, per_doc=args.per_doc, workers=args.rr_workers) as fake:
+        rrclient._client = rrclient.RobotReviewerClient(base_url=fake.url, api_key="")
+        scratch_schema()
+        try:
+            # parse
+            start = time.time()
+            entries = [entry for fn in fns for entry in pubmed.iter_abstracts(fn)]
+            report("iter_abstracts", len(entries), time.time() - start)
+
+            # classify, without the cache so that every record goes to RobotReviewer
+            start = time.time()
+            n = 0
+            for entry_batch in pubmed.grouper(entries, args.batch_size):
+                n += len(pubmed.classify(entry_batch, use_cache=False))
+            report("classify", n, time.time() - start)
+            del entries
+
+            # everything
+            fake.requests = 0
+            start = time.time()
+            pubmed.upload_to_postgres(ftp_fns, safety_test_parse=False, batch_size=args.batch_size, force_update=True, workers=args.workers)
+            n = count("pubmed") + count("pubmed_excludes")
+            report("upload_to_postgres", n, time.time() - start)
+            print("{} RCTs stored, {} excludes, {} RobotReviewer HTTP requests".format(count("pubmed"), count("pubmed_excludes"), fake.requests))
+        finally:
+            if not args.keep:
+                drop_scratch_schema()
+                shutil.rmtree(data_dir)
+
+
+if __name__ == '__main__':
+    main()
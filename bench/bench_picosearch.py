@@ -0,0 +1,160 @@
+#
+#   Benchmark: picosearch concept lookups, jsonb @> chains vs pico_cuis postings
+#
+#   fills a scratch schema with synthetic annotated RCTs (CUIs drawn from a
+#   skewed vocabulary, as real PICO annotations are), then runs the PubMed
+#   part of picosearch with picoquery.mesh_filter (one GIN probe per CUI)
+#   and with picoquery.postings_filter (cui = any(...) over the btree
+#   postings), for terms expanded to different numbers of CUIs
+#
+#   both plans are checked to match the same articles before timing
+#
+#   runs in a scratch schema of the database in trialstreamer/config.json,
+#   which is dropped afterwards
+#
+#   python bench/bench_picosearch.py [--records 200000] [--vocab 20000] [--queries 20]
+#
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from psycopg2 import sql
+from trialstreamer import dbutil, picoquery
+
+SCHEMA = "bench_picosearch"
+FIELDS = ("population", "interventions", "outcomes")
+
+
+def cui(i):
+    return "C{:07d}".format(i)
+
+
+def pick(rng, vocab):
+    # roughly Zipfian: a few CUIs are in many articles, most in a handful
+    return min(int(10 * (rng.paretovariate(1.2) - 1)), vocab - 1)
+
+
+def make_rows(n, vocab, seed=0):
+    rng = random.Random(seed)
+    pubmed_rows, annotation_rows = [], []
+    for i in range(n):
+        pmid = str(10000000 + i)
+        pubmed_rows.append((pmid, 2000 + i % 20, "A randomised trial {}".format(i), True, True))
+        mesh = [json.dumps([{"cui": cui(pick(rng, vocab)), "mesh_term": "term"} for _ in range(rng.randint(1, 6))]) for _ in FIELDS]
+        annotation_rows.append((pmid, ) + tuple(mesh) + (rng.randint(20, 2000), rng.random()))
+    return pubmed_rows, annotation_rows
+
+
+def load(pubmed_rows, annotation_rows):
+    cur = dbutil.db.cursor()
+    start = time.time()
+    dbutil.copy_rows(cur, "pubmed", ("pmid", "year", "ti", "is_rct_balanced", "is_human"), pubmed_rows)
+    dbutil.copy_rows(cur, "pubmed_annotations", ("pmid", "population_mesh", "interventions_mesh", "outcomes_mesh", "num_randomized", "prob_low_rob"), annotation_rows)
+    dbutil.db.commit()
+    elapsed = time.time() - start
+    # as autovacuum would have by the time anyone searches (without it the
+    # visibility map is empty, and every index only scan visits the heap)
+    conn = dbutil.get_db()
+    conn.autocommit = True
+    for table in ("pubmed", "pubmed_annotations", "pico_cuis"):
+        cur.execute("VACUUM ANALYZE {};".format(table))
+    conn.autocommit = False
+    cur.execute("SELECT count(*) FROM pico_cuis;")
+    postings = cur.fetchone()[0]
+    cur.close()
+    dbutil.db.commit()
+    return elapsed, postings
+
+
+def make_queries(rng, n, n_cuis, vocab):
+    """
+    n queries of one or two terms, each expanded to n_cuis CUIs (as
+    get_subtree would expand a broad concept)
+    """
+    queries = []
+    for _ in range(n):
+        terms = []
+        for field in rng.sample(FIELDS, rng.randint(1, 2)):
+            cuis = {cui(pick(rng, vocab))}
+            while len(cuis) < n_cuis:
+                cuis.add(cui(rng.randrange(vocab)))
+            terms.append((field, sorted(cuis)))
+        queries.append(terms)
+    return queries
+
+
+def search_sql(params, limit=True):
+    # the PubMed query of cnxapp.search_pubmed, returning just the pmids
+    out = (sql.SQL("SELECT pm.pmid FROM pubmed as pm, pubmed_annotations as pa WHERE ") + params +
+           sql.SQL(" AND pm.pmid = pa.pmid AND pm.is_rct_balanced=true and pm.is_human=true"))
+    if limit:
+        out += sql.SQL(" order by pa.prob_low_rob * pa.num_randomized desc nulls last limit 250")
+    return out
+
+
+def run(cur, query, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        cur.execute(query)
+        cur.fetchall()
+        times.append(time.time() - start)
+    return statistics.median(times)
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='picosearch jsonb vs postings benchmark')
+    argparser.add_argument('--records', type=int, default=200000)
+    argparser.add_argument('--vocab', type=int, default=20000, help='distinct CUIs')
+    argparser.add_argument('--queries', type=int, default=20, help='queries per expansion size')
+    argparser.add_argument('--repeat', type=int, default=3)
+    args = argparser.parse_args()
+
+    cur = dbutil.db.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};".format(SCHEMA))
+    cur.close()
+    dbutil.db.commit()
+    dbutil.make_tables()
+    dbutil.migrate()
+
+    try:
+        elapsed, postings = load(*make_rows(args.records, args.vocab))
+        print("loaded {} annotated articles ({} postings, via the triggers) in {:.1f}s".format(args.records, postings, elapsed))
+
+        rng = random.Random(1)
+        cur = dbutil.db.cursor()
+        print("{:>6s} {:>12s} {:>14s} {:>8s}".format("CUIs", "jsonb ms", "postings ms", "speedup"))
+        for n_cuis in (1, 5, 20, 50):
+            jsonb_times, postings_times = [], []
+            for terms in make_queries(rng, args.queries, n_cuis, args.vocab):
+                jsonb_params = picoquery.mesh_filter(terms)
+                postings_params = picoquery.postings_filter(terms, 'pubmed', picoquery.column("pa", "pmid"))
+
+                cur.execute(search_sql(jsonb_params, limit=False))
+                expected = set(r[0] for r in cur.fetchall())
+                cur.execute(search_sql(postings_params, limit=False))
+                assert set(r[0] for r in cur.fetchall()) == expected, "plans disagree for {}".format(terms)
+
+                jsonb_times.append(run(cur, search_sql(jsonb_params), args.repeat))
+                postings_times.append(run(cur, search_sql(postings_params), args.repeat))
+            jsonb_ms = 1000 * statistics.median(jsonb_times)
+            postings_ms = 1000 * statistics.median(postings_times)
+            print("{:6d} {:12.1f} {:14.1f} {:7.1f}x".format(n_cuis, jsonb_ms, postings_ms, jsonb_ms / max(postings_ms, 1e-9)))
+        cur.close()
+    finally:
+        dbutil.db.rollback()
+        cur = dbutil.db.cursor()
+        cur.execute("SET search_path TO public; DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
+        cur.close()
+        dbutil.db.commit()
+
+
+if __name__ == '__main__':
+    main()
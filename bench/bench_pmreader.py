@@ -0,0 +1,99 @@
+#
+#   Microbenchmark: PubMed citation parsing
+#
+#   compares PubmedCorpusReader.to_dict with the single pass
+#   pmreader.citation_to_dict (on ElementTree, and on lxml if installed),
+#   and with the summary-only LazyCitation used before classification
+#
+#   python bench/bench_pmreader.py [pubmed.xml or pubmed.xml.gz] [--repeat N]
+#
+
+import argparse
+import gzip
+import io
+import os
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trialstreamer.readers import pmreader
+
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+DEFAULT_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'pubmed_sample.xml')
+
+
+def load(fn):
+    opener = gzip.open if fn.endswith('.gz') else open
+    with opener(fn, 'rb') as f:
+        return f.read()
+
+
+def iter_citations(data, iterparse):
+    for event, elem in iterparse(io.BytesIO(data), events=("end",)):
+        if elem.tag == "MedlineCitation":
+            yield elem
+
+
+def reader_to_dict(elem):
+    return pmreader.PubmedCorpusReader(xml_ET=elem).to_dict()
+
+
+def check(data):
+    """
+    both extraction paths have to give identical dicts
+    """
+    n = 0
+    for elem in iter_citations(data, ET.iterparse):
+        expected = reader_to_dict(elem)
+        assert pmreader.citation_to_dict(elem) == expected, expected['pmid']
+        n += 1
+    if lxml_etree is not None:
+        for elem, expected in zip(iter_citations(data, lxml_etree.iterparse), (reader_to_dict(e) for e in iter_citations(data, ET.iterparse))):
+            assert pmreader.citation_to_dict(elem) == expected, expected['pmid']
+    return n
+
+
+def run(data, iterparse, extract, repeat):
+    start = time.perf_counter()
+    n = 0
+    for _ in range(repeat):
+        for elem in iter_citations(data, iterparse):
+            extract(elem)
+            elem.clear()
+            n += 1
+    return n, time.perf_counter() - start
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='PubMed citation parsing microbenchmark')
+    argparser.add_argument('fn', nargs='?', default=DEFAULT_FIXTURE, help='PubMed XML file (.xml or .xml.gz)')
+    argparser.add_argument('--repeat', type=int, default=200, help='times to parse the file')
+    args = argparser.parse_args()
+
+    data = load(args.fn)
+    print(f"{check(data)} citations in {args.fn}, outputs match")
+
+    cases = [("etree + PubmedCorpusReader.to_dict", ET.iterparse, reader_to_dict),
+             ("etree + citation_to_dict", ET.iterparse, pmreader.citation_to_dict),
+             ("etree + LazyCitation (summary only)", ET.iterparse, pmreader.LazyCitation)]
+    if lxml_etree is not None:
+        cases.append(("lxml + citation_to_dict", lxml_etree.iterparse, pmreader.citation_to_dict))
+    else:
+        print("lxml not installed, skipping lxml backend")
+
+    baseline = None
+    for name, iterparse, extract in cases:
+        n, elapsed = run(data, iterparse, extract, args.repeat)
+        rate = n / elapsed
+        baseline = baseline or rate
+        print(f"{name:40s} {rate:10.0f} citations/s  ({rate / baseline:.2f}x)")
+
+
+if __name__ == '__main__':
+    main()
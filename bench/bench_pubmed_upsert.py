@@ -0,0 +1,103 @@
+#
+#   Benchmark: writing classified PubMed batches to Postgres
+#
+#   compares the per-batch execute_values upserts (pubmed.write_rows) with
+#   the COPY into unlogged staging tables + one merge per file path
+#   (pubmed.stage_rows / pubmed.merge_staged), for a fresh load and for
+#   re-loading the same PMIDs (the update case)
+#
+#   runs in a scratch schema of the database in trialstreamer/config.json,
+#   which is dropped afterwards
+#
+#   python bench/bench_pubmed_upsert.py [--records 50000] [--batch-size 5000]
+#
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from trialstreamer import dbutil, pubmed
+
+SCHEMA = "bench_upsert"
+
+
+def make_rows(n, seed=0):
+    rng = random.Random(seed)
+    include_rows, exclude_rows = [], []
+    now = datetime.datetime.now()
+    for i in range(n):
+        pmid = str(10000000 + i)
+        scores = [rng.gauss(0, 2) for _ in range(7)]
+        clf = ("svm_cnn", scores[0], now, 0, scores[0] > 3.7, scores[0] > 2.1, scores[0] > 0.1, "Manual") + tuple(scores[1:]) + (rng.random(), True, now)
+        if i % 10 == 0:
+            title = "A randomised trial of treatment {}".format(i)
+            abstract = " ".join("word{}".format(rng.randint(0, 5000)) for _ in range(250))
+            pm_data = json.dumps({"pmid": pmid, "title": title, "abstract": abstract, "mesh": [{"cui": "C{:07d}".format(rng.randint(0, 999999))} for _ in range(8)]})
+            include_rows.append((pmid, "MEDLINE", 2000 + i % 20, title, abstract, pm_data, "pubmed20n0001.xml.gz") + clf)
+        else:
+            exclude_rows.append((pmid, "MEDLINE", 2000 + i % 20, "pubmed20n0001.xml.gz") + clf)
+    return include_rows, exclude_rows
+
+
+def batches(rows, batch_size):
+    return [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+
+
+def truncate():
+    cur = dbutil.db.cursor()
+    cur.execute("TRUNCATE pubmed, pubmed_excludes;")
+    cur.close()
+    dbutil.db.commit()
+
+
+def run_execute_values(include_rows, exclude_rows, batch_size):
+    start = time.time()
+    for inc, exc in zip(batches(include_rows, batch_size // 10), batches(exclude_rows, batch_size - batch_size // 10)):
+        pubmed.write_rows(inc, exc, [])
+    return time.time() - start
+
+
+def run_copy(include_rows, exclude_rows, batch_size):
+    start = time.time()
+    pubmed.clear_staging()
+    for inc, exc in zip(batches(include_rows, batch_size // 10), batches(exclude_rows, batch_size - batch_size // 10)):
+        pubmed.stage_rows(inc, exc, [])
+    pubmed.merge_staged()
+    return time.time() - start
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='PubMed bulk upsert benchmark')
+    argparser.add_argument('--records', type=int, default=50000)
+    argparser.add_argument('--batch-size', type=int, default=5000)
+    args = argparser.parse_args()
+
+    cur = dbutil.db.cursor()
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0}; SET search_path TO {0};".format(SCHEMA))
+    cur.close()
+    dbutil.db.commit()
+    dbutil.make_tables()
+    dbutil.migrate()
+
+    try:
+        include_rows, exclude_rows = make_rows(args.records)
+        for name, run in (("execute_values upsert", run_execute_values), ("COPY + staged merge", run_copy)):
+            truncate()
+            fresh = run(include_rows, exclude_rows, args.batch_size)
+            again = run(include_rows, exclude_rows, args.batch_size)
+            print("{:24s} fresh load {:8.0f} rows/s   reload {:8.0f} rows/s".format(name, args.records / fresh, args.records / again))
+    finally:
+        cur = dbutil.db.cursor()
+        cur.execute("SET search_path TO public; DROP SCHEMA IF EXISTS {} CASCADE;".format(SCHEMA))
+        cur.close()
+        dbutil.db.commit()
+
+
+if __name__ == '__main__':
+    main()
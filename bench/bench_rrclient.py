@@ -0,0 +1,75 @@
+#
+#   Throughput benchmark: RobotReviewer client against the fake server
+#
+#   compares the previous one-report-at-a-time client (bare requests,
+#   polling every 0.3s) with rrclient.RobotReviewerClient
+#
+#   python bench/bench_rrclient.py [--articles 20000] [--latency 0.5] [--per-doc 0.0002] [--workers 2]
+#
+
+import argparse
+import os
+import sys
+import time
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test"))
+
+from fake_robotreviewer import FakeRobotReviewer
+from trialstreamer import rrclient
+
+
+def make_articles(n):
+    return [{"ti": f"A randomised trial of treatment {i}" if i % 5 == 0 else f"A cohort study of exposure {i}",
+             "ab": f"We studied {i} people. " * 20} for i in range(n)]
+
+
+def sequential_predict(base_url, X, tasks, batch_size):
+    """
+    the previous behaviour of pubmed.predict, for comparison
+    """
+    out = []
+    for i in range(0, len(X), batch_size):
+        r = requests.post(base_url + 'queue-documents', json={"articles": X[i:i + batch_size], "robots": tasks, "filter_rcts": "none"}, headers={"api-key": ""})
+        report_id = r.json()['report_id']
+        while requests.get(base_url + 'report-status/' + report_id, headers={"api-key": ""}).json()['state'] != 'SUCCESS':
+            time.sleep(0.3)
+        out.extend(requests.get(base_url + 'report/' + report_id, headers={"api-key": ""}).json())
+    return out
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='RobotReviewer client throughput benchmark')
+    argparser.add_argument('--articles', type=int, default=20000)
+    argparser.add_argument('--batch-size', type=int, default=5000, help='articles per classify() call')
+    argparser.add_argument('--latency', type=float, default=0.5, help='fake server seconds per report')
+    argparser.add_argument('--per-doc', type=float, default=0.0002, help='fake server seconds per article')
+    argparser.add_argument('--workers', type=int, default=2, help='fake server reports processed at once')
+    argparser.add_argument('--max-in-flight', type=int, default=4)
+    args = argparser.parse_args()
+
+    X = make_articles(args.articles)
+    tasks = ['rct_bot', 'human_bot']
+
+    with FakeRobotReviewer(latency=args.latency, per_doc=args.per_doc, workers=args.workers) as fake:
+        start = time.time()
+        old = sequential_predict(fake.url, X, tasks, args.batch_size)
+        elapsed = time.time() - start
+        print(f"sequential client:  {len(old) / elapsed:8.0f} articles/s  ({fake.requests} HTTP requests)")
+
+        fake.requests = 0
+        client = rrclient.RobotReviewerClient(base_url=fake.url, api_key="", max_in_flight=args.max_in_flight,
+                                              target_latency=60)
+        start = time.time()
+        new = []
+        for i in range(0, len(X), args.batch_size):
+            new.extend(client.predict(X[i:i + args.batch_size], tasks=tasks, filter_rcts='none'))
+        elapsed = time.time() - start
+        print(f"RobotReviewerClient:{len(new) / elapsed:8.0f} articles/s  ({fake.requests} HTTP requests, final chunk size {client.batch_size})")
+
+        assert [a['ti'] for a in old] == [a['ti'] for a in new]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#
+#   Fake RobotReviewer REST API, for tests and benchmarks
+#
+#   implements queue-documents, report-status/<id> and report/<id>, with
+#   deterministic made-up predictions for the bots trialstreamer uses, and
+#   a configurable processing time per report; fail_next makes the next
+#   requests answer 503, as a restarting server would
+#
+#   python test/fake_robotreviewer.py --port 5055 --latency 0.5 --per-doc 0.0005
+#
+
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+rct_re = re.compile(r"random", re.IGNORECASE)
+
+
+def fake_annotation(article, robots):
+    """
+    plausible RobotReviewer output for an article, seeded from its text
+    """
+    text = (article.get('ti') or '') + ' ' + (article.get('ab') or '')
+    rng = random.Random(hashlib.md5(text.encode('utf-8')).hexdigest())
+    out = dict(article)
+
+    if 'rct_bot' in robots:
+        likely_rct = bool(rct_re.search(text)) or 'Randomized Controlled Trial' in article.get('ptyp', [])
+        score = rng.gauss(2.5 if likely_rct else -2.0, 1.0)
+        model = "svm_cnn_ptyp" if 'ptyp' in article else "svm_cnn"
+        out['rct_bot'] = {"model": model, "score": score,
+                          "ptyp_rct": int('Randomized Controlled Trial' in article.get('ptyp', [])),
+                          "preds": {k: score + rng.gauss(0, 0.2) for k in ["cnn", "svm", "svm_cnn", "svm_ptyp", "cnn_ptyp", "svm_cnn_ptyp"]},
+                          "is_rct_precise": score > 3.7, "is_rct_balanced": score > 2.1, "is_rct_sensitive": score > 0.1}
+        out['rct_bot']['preds']['probability'] = 1 / (1 + 2.718281828 ** -score)
+    if 'human_bot' in robots:
+        out['human_bot'] = {"is_human": rng.random() < 0.9}
+    if 'pico_span_bot' in robots:
+        pico = {}
+        for field in ['population', 'interventions', 'outcomes']:
+            pico[field] = [f"{field} span {i}" for i in range(rng.randint(0, 3))]
+            pico[f"{field}_mesh"] = [{"cui": f"C{rng.randint(0, 9999999):07d}", "mesh_term": f"term {i}", "mesh_ui": f"D{rng.randint(0, 999999):06d}"} for i in range(rng.randint(0, 4))]
+            pico[f"{field}_berts"] = [rng.random() for _ in range(8)]
+        out['pico_span_bot'] = pico
+    if 'sample_size_bot' in robots:
+        out['sample_size_bot'] = {"num_randomized": str(rng.randint(10, 5000)) if rng.random() < 0.8 else 'not found'}
+    if 'bias_ab_bot' in robots:
+        out['bias_ab_bot'] = {"prob_low_rob": rng.random()}
+    if 'punchline_bot' in robots:
+        out['punchline_bot'] = {"punchline_text": "The intervention improved outcomes.",
+                                "effect": rng.choice(["↑ sig. increase", "↓ sig. decrease", "— no diff"])}
+    return out
+
+
+class FakeRobotReviewer():
+    """
+    latency = fixed seconds per report, per_doc = extra seconds per article,
+    workers = reports processed at once (RobotReviewer has a single GPU worker
+    by default, so later reports queue up behind earlier ones)
+
+    every request is logged to self.log as (time, method, path)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.2, per_doc=0.0, workers=1):
+        self.latency = latency
+        self.per_doc = per_doc
+        self.worker_free_at = [0.0] * workers
+        self.reports = {}
+        self.requests = 0
+        self.fail_next = 0
+        self.log = []
+        self.lock = threading.Lock()
+        self.ids = itertools.count()
+        self.server = _Server((host, port), _handler(self))
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def queue(self, data):
+        robots = data.get('robots', ['rct_bot'])
+        articles = [fake_annotation(a, robots) for a in data['articles']]
+        if data.get('filter_rcts', 'none') != 'none':
+            articles = [a for a in articles if a.get('rct_bot', {}).get(data['filter_rcts'], True)]
+        with self.lock:
+            report_id = str(next(self.ids))
+            now = time.time()
+            worker = min(range(len(self.worker_free_at)), key=lambda i: self.worker_free_at[i])
+            ready_at = max(now, self.worker_free_at[worker]) + self.latency + self.per_doc * len(data['articles'])
+            self.worker_free_at[worker] = ready_at
+            self.reports[report_id] = (ready_at, articles)
+        return report_id
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _handler(fake):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, obj, status=200):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def failed(self, method):
+            with fake.lock:
+                fake.requests += 1
+                fake.log.append((time.time(), method, self.path))
+                fail = fake.fail_next > 0
+                if fail:
+                    fake.fail_next -= 1
+            if fail:
+                self.send_json({"error": "service unavailable"}, status=503)
+            return fail
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if self.failed('POST'):
+                return
+            if self.path.rstrip('/').endswith('queue-documents'):
+                data = json.loads(body)
+                self.send_json({"report_id": fake.queue(data)})
+            else:
+                self.send_json({"error": "not found"}, status=404)
+
+        def do_GET(self):
+            if self.failed('GET'):
+                return
+            parts = self.path.strip('/').split('/')
+            report = fake.reports.get(parts[-1]) if len(parts) >= 2 else None
+            if report is None:
+                self.send_json({"error": "not found"}, status=404)
+            elif parts[-2] == 'report-status':
+                self.send_json({"state": "SUCCESS" if time.time() >= report[0] else "PENDING"})
+            elif parts[-2] == 'report':
+                self.send_json(report[1])
+            else:
+                self.send_json({"error": "not found"}, status=404)
+
+    return Handler
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Fake RobotReviewer API server')
+    argparser.add_argument('--host', default='127.0.0.1')
+    argparser.add_argument('--port', type=int, default=5055)
+    argparser.add_argument('--latency', type=float, default=0.2, help='seconds per report')
+    argparser.add_argument('--per-doc', type=float, default=0.0, help='extra seconds per article')
+    argparser.add_argument('--workers', type=int, default=1, help='reports processed at once')
+    args = argparser.parse_args()
+    fake = FakeRobotReviewer(args.host, args.port, latency=args.latency, per_doc=args.per_doc, workers=args.workers)
+    print(f"Fake RobotReviewer listening on {fake.url}")
+    fake.server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
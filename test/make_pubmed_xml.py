@@ -0,0 +1,138 @@
+#
+#   Synthetic PubMed XML for tests and benchmarks
+#
+#   writes gzipped files in the layout of the PubMed baseline/update files
+#   (PubmedArticle records with MedlineCitation and PubmedData, and for
+#   update files a DeleteCitation list at the end), with a realistic mix of
+#   structured/unstructured abstracts, authors, MeSH, publication types,
+#   registry ids and DOIs, and roughly 1 in 10 records written as RCTs
+#
+#   python test/make_pubmed_xml.py OUT_DIR [--files 2] [--records 30000] [--updates]
+#
+
+import argparse
+import gzip
+import os
+import random
+from xml.sax.saxutils import escape
+
+WORDS = ("patients randomised randomized trial treatment placebo control group outcome primary secondary "
+         "efficacy safety cohort children adults women men hospital clinical study intervention dose weeks "
+         "months mortality pain blood pressure diabetes cancer therapy surgery vaccine infection quality life "
+         "analysis significant reduction increase compared baseline follow-up adverse events risk ratio").split()
+SECTIONS = ("BACKGROUND", "OBJECTIVE", "METHODS", "RESULTS", "CONCLUSIONS")
+JOURNALS = (("BMC public health", "BMC Public Health"), ("The Lancet", "Lancet"), ("JAMA", "JAMA"),
+            ("The New England journal of medicine", "N Engl J Med"), ("Trials", "Trials"), ("PloS one", "PLoS One"))
+MONTHS = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+MESH = ("Humans", "Female", "Male", "Adult", "Child", "Aged", "Hypertension", "Diabetes Mellitus, Type 2",
+        "Randomized Controlled Trials as Topic", "Treatment Outcome", "Double-Blind Method", "Neoplasms")
+NAMES = ("Smith", "Okafor", "Nguyen", "Garcia", "Müller", "Kowalski", "Tanaka", "Silva", "Ahmed", "Cohen")
+
+
+def sentence(rng, n_min=8, n_max=25):
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(n_min, n_max))).capitalize() + "."
+
+
+def citation_xml(rng, pmid):
+    is_rct = rng.random() < 0.1
+    year = rng.randint(1950, 2020)
+    status, method = rng.choice((("MEDLINE", "Curated"), ("MEDLINE", "Automated"), ("MEDLINE", None),
+                                 ("PubMed-not-MEDLINE", None), ("In-Process", None)))
+    journal, abbrv = rng.choice(JOURNALS)
+    title = ("A randomised controlled trial of " if is_rct else "") + sentence(rng, 6, 18)
+    doi = "10.{}/{}.{}".format(rng.randint(1000, 9999), abbrv.replace(" ", "").lower(), pmid)
+
+    out = ['  <PubmedArticle>\n',
+           '    <MedlineCitation Status="{}"{} Owner="NLM">\n'.format(status, ' IndexingMethod="{}"'.format(method) if method else ''),
+           '      <PMID Version="1">{}</PMID>\n'.format(pmid),
+           '      <Article PubModel="Print">\n',
+           '        <Journal>\n          <JournalIssue CitedMedium="Print">\n',
+           '            <Volume>{}</Volume>\n            <Issue>{}</Issue>\n'.format(rng.randint(1, 400), rng.randint(1, 12)),
+           '            <PubDate>\n              <Year>{}</Year>\n              <Month>{}</Month>\n            </PubDate>\n'.format(year, rng.choice(MONTHS)),
+           '          </JournalIssue>\n          <Title>{}</Title>\n          <ISOAbbreviation>{}</ISOAbbreviation>\n        </Journal>\n'.format(escape(journal), escape(abbrv)),
+           '        <ArticleTitle>{}</ArticleTitle>\n'.format(escape(title))]
+    first_page = rng.randint(1, 2000)
+    out.append('        <Pagination>\n          <MedlinePgn>{}-{}</MedlinePgn>\n        </Pagination>\n'.format(first_page, first_page + rng.randint(1, 15)))
+    out.append('        <ELocationID EIdType="doi" ValidYN="Y">{}</ELocationID>\n'.format(doi))
+    if rng.random() < 0.85:
+        out.append('        <Abstract>\n')
+        if rng.random() < 0.6:
+            for section in SECTIONS:
+                out.append('          <AbstractText Label="{0}" NlmCategory="{0}">{1}</AbstractText>\n'.format(
+                    section, escape(" ".join(sentence(rng) for _ in range(rng.randint(1, 4))))))
+        else:
+            out.append('          <AbstractText>{}</AbstractText>\n'.format(escape(" ".join(sentence(rng) for _ in range(rng.randint(4, 12))))))
+        out.append('        </Abstract>\n')
+    out.append('        <AuthorList CompleteYN="Y">\n')
+    for _ in range(rng.randint(1, 8)):
+        surname = rng.choice(NAMES)
+        out.append('          <Author ValidYN="Y">\n            <LastName>{}</LastName>\n            <ForeName>{}</ForeName>\n            <Initials>{}</Initials>\n'.format(
+            escape(surname), escape(rng.choice(NAMES)), surname[0]))
+        out.append('            <AffiliationInfo>\n              <Affiliation>{}</Affiliation>\n            </AffiliationInfo>\n          </Author>\n'.format(
+            escape(sentence(rng, 4, 10))))
+    out.append('        </AuthorList>\n        <Language>eng</Language>\n')
+    if is_rct and rng.random() < 0.5:
+        out.append('        <DataBankList CompleteYN="Y">\n          <DataBank>\n            <DataBankName>ClinicalTrials.gov</DataBankName>\n'
+                   '            <AccessionNumberList>\n              <AccessionNumber>NCT{:08d}</AccessionNumber>\n            </AccessionNumberList>\n'
+                   '          </DataBank>\n        </DataBankList>\n'.format(rng.randint(0, 99999999)))
+    out.append('        <PublicationTypeList>\n          <PublicationType UI="D016428">Journal Article</PublicationType>\n')
+    if is_rct:
+        out.append('          <PublicationType UI="D016449">Randomized Controlled Trial</PublicationType>\n')
+    out.append('        </PublicationTypeList>\n      </Article>\n')
+    out.append('      <MeshHeadingList>\n')
+    for term in rng.sample(MESH, rng.randint(0, 6)):
+        out.append('        <MeshHeading>\n          <DescriptorName UI="D000000" MajorTopicYN="N">{}</DescriptorName>\n        </MeshHeading>\n'.format(escape(term)))
+    out.append('      </MeshHeadingList>\n    </MedlineCitation>\n')
+    out.append('    <PubmedData>\n      <PublicationStatus>ppublish</PublicationStatus>\n      <ArticleIdList>\n'
+               '        <ArticleId IdType="pubmed">{}</ArticleId>\n        <ArticleId IdType="doi">{}</ArticleId>\n'
+               '      </ArticleIdList>\n    </PubmedData>\n  </PubmedArticle>\n'.format(pmid, doi))
+    return "".join(out)
+
+
+def write_pubmed_file(fn, n_records, start_pmid=10000000, seed=0, updates=False, delete_fraction=0.01):
+    """
+    write n_records synthetic citations (PMIDs from start_pmid) to fn, a
+    .xml.gz; with updates, also a DeleteCitation list of earlier PMIDs
+    """
+    rng = random.Random(seed)
+    with gzip.open(fn, 'wt', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE PubmedArticleSet>\n<PubmedArticleSet>\n')
+        for pmid in range(start_pmid, start_pmid + n_records):
+            f.write(citation_xml(rng, pmid))
+        if updates:
+            n_deleted = int(n_records * delete_fraction)
+            f.write('  <DeleteCitation>\n')
+            for pmid in rng.sample(range(max(1, start_pmid - n_records), start_pmid + 1), n_deleted):
+                f.write('    <PMID Version="1">{}</PMID>\n'.format(pmid))
+            f.write('  </DeleteCitation>\n')
+        f.write('</PubmedArticleSet>\n')
+
+
+def write_pubmed_files(out_dir, n_files, n_records, updates=False, seed=0):
+    """
+    write n_files files of n_records each to out_dir, named as the PubMed
+    FTP files are; returns their filenames
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    fns = []
+    for i in range(n_files):
+        fn = os.path.join(out_dir, "pubmed20n{:04d}.xml.gz".format(i + 1))
+        write_pubmed_file(fn, n_records, start_pmid=10000000 + i * n_records, seed=seed + i, updates=updates)
+        fns.append(fn)
+    return fns
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Write synthetic PubMed XML files')
+    argparser.add_argument('out_dir')
+    argparser.add_argument('--files', type=int, default=2)
+    argparser.add_argument('--records', type=int, default=30000, help='citations per file (the real files have ~30000)')
+    argparser.add_argument('--updates', action='store_true', help='add DeleteCitation lists, as in the update files')
+    argparser.add_argument('--seed', type=int, default=0)
+    args = argparser.parse_args()
+    for fn in write_pubmed_files(args.out_dir, args.files, args.records, updates=args.updates, seed=args.seed):
+        print(fn, "{:.1f}MB".format(os.path.getsize(fn) / 1e6))
+
+
+if __name__ == '__main__':
+    main()
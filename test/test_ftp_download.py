@@ -0,0 +1,96 @@
+#
+#   PubMed FTP downloads against a local FTP server: interrupted transfers
+#   resume from their .part file, and files failing their md5 are thrown away
+#
+#   python -m pytest test/test_ftp_download.py
+#
+#   (needs pyftpdlib; skipped without it)
+#
+
+import ftplib
+import hashlib
+import os
+import threading
+
+import pytest
+
+pyftpdlib = pytest.importorskip("pyftpdlib")
+from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler
+from pyftpdlib.servers import FTPServer
+
+from trialstreamer import config, ftppool, pubmed
+
+DATA = os.urandom(300 * 1024)
+
+
+@pytest.fixture
+def ftp_root(tmp_path):
+    """
+    an anonymous FTP server on localhost serving a temporary directory
+    """
+    root = tmp_path / "ftp"
+    root.mkdir()
+    authorizer = DummyAuthorizer()
+    authorizer.add_anonymous(str(root))
+    handler = type("Handler", (FTPHandler, ), {"authorizer": authorizer})
+    server = FTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, kwargs={"timeout": 0.1}, daemon=True)
+    thread.start()
+    try:
+        yield root, server.address[1]
+    finally:
+        server.close_all()
+        thread.join()
+
+
+def test_resume_from_part_file(ftp_root, tmp_path):
+    root, port = ftp_root
+    (root / "pubmed20n0001.xml.gz").write_bytes(DATA)
+    out_filename = str(tmp_path / "pubmed20n0001.xml.gz")
+    with open(out_filename + ".part", "wb") as f:
+        f.write(DATA[:100000])
+
+    hasher = hashlib.md5()
+    with ftppool.FTPPool("127.0.0.1", port=port, size=1) as pool, pool.connection() as ftp:
+        n_bytes = pubmed.retr_to_file(ftp, "pubmed20n0001.xml.gz", out_filename, hasher=hasher, resume=True)
+
+    assert n_bytes == len(DATA) - 100000  # only the rest was transferred
+    assert not os.path.exists(out_filename + ".part")
+    with open(out_filename, "rb") as f:
+        assert f.read() == DATA
+    assert hasher.hexdigest() == hashlib.md5(DATA).hexdigest()
+
+
+def test_interrupted_transfer_keeps_part_file(tmp_path):
+    class DroppedFTP:
+        def retrbinary(self, cmd, callback, rest=None):
+            callback(DATA[:1000])
+            raise ftplib.error_temp("426 Connection closed; transfer aborted.")
+
+    out_filename = str(tmp_path / "pubmed20n0001.xml.gz")
+    with pytest.raises(ftplib.error_temp):
+        pubmed.retr_to_file(DroppedFTP(), "pubmed20n0001.xml.gz", out_filename, resume=True)
+
+    assert not os.path.exists(out_filename)
+    with open(out_filename + ".part", "rb") as f:
+        assert f.read() == DATA[:1000]
+
+
+def test_md5_mismatch_deletes_files(ftp_root, tmp_path, monkeypatch):
+    root, port = ftp_root
+    (root / "pubmed20n0001.xml.gz").write_bytes(DATA)
+    (root / "pubmed20n0001.xml.gz.md5").write_text("MD5(pubmed20n0001.xml.gz)= {}\n".format("0" * 32))
+    (root / "pubmed20n0002.xml.gz").write_bytes(DATA[::-1])
+    (root / "pubmed20n0002.xml.gz.md5").write_text("MD5(pubmed20n0002.xml.gz)= {}\n".format(hashlib.md5(DATA[::-1]).hexdigest()))
+    local = tmp_path / "local"
+    local.mkdir()
+    monkeypatch.setattr(config, "PUBMED_LOCAL_DATA_PATH", str(local), raising=False)
+    monkeypatch.setattr(pubmed, "max_retry_attempts", 0)
+
+    with ftppool.FTPPool("127.0.0.1", port=port, size=2) as pool:
+        pubmed.download_and_validate_gzs(["pubmed20n0001.xml.gz", "pubmed20n0002.xml.gz"], pool=pool)
+
+    # the corrupted file (and its hash) are gone, the good one is kept and recorded
+    assert sorted(os.listdir(str(local))) == ["md5_manifest.json", "pubmed20n0002.xml.gz", "pubmed20n0002.xml.gz.md5"]
+    assert list(pubmed.load_manifest()) == ["pubmed20n0002.xml.gz"]
@@ -0,0 +1,55 @@
+#
+#   iter_abstracts memory: records are freed as they are read, so the peak
+#   shouldn't grow with the length of the file
+#
+#   python -m pytest test/test_iter_abstracts.py
+#
+#   (ElementTree only: tracemalloc can't see lxml's allocations)
+#
+
+import tracemalloc
+
+from make_pubmed_xml import write_pubmed_file
+from trialstreamer import pubmed
+
+
+def peak_memory(fn, updates=False):
+    """
+    records read from fn, and the peak traced memory while reading them
+    """
+    tracemalloc.start()
+    try:
+        n = sum(1 for _ in pubmed.iter_abstracts(fn, updates=updates, backend='etree'))
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return n, peak
+
+
+def test_iter_abstracts_memory_is_flat(tmp_path):
+    small_fn, large_fn = str(tmp_path / "pubmed20n0001.xml.gz"), str(tmp_path / "pubmed20n0002.xml.gz")
+    write_pubmed_file(small_fn, 2000)
+    write_pubmed_file(large_fn, 20000)
+
+    n_small, small_peak = peak_memory(small_fn)
+    n_large, large_peak = peak_memory(large_fn)
+
+    assert (n_small, n_large) == (2000, 20000)
+    # a few records' worth (~0.3MB); holding the records would be hundreds
+    # of MB, and even their emptied elements a few MB
+    assert large_peak < 1024 * 1024
+    # 10x the records, the same memory
+    assert large_peak < small_peak + 256 * 1024
+
+
+def test_iter_abstracts_updates_memory_is_flat(tmp_path):
+    small_fn, large_fn = str(tmp_path / "pubmed20n1001.xml.gz"), str(tmp_path / "pubmed20n1002.xml.gz")
+    write_pubmed_file(small_fn, 2000, updates=True)
+    write_pubmed_file(large_fn, 20000, updates=True)
+
+    n_small, small_peak = peak_memory(small_fn, updates=True)
+    n_large, large_peak = peak_memory(large_fn, updates=True)
+
+    assert (n_small, n_large) == (2001, 20001)  # the records, and the DeleteCitation list
+    assert large_peak < 1024 * 1024
+    assert large_peak < small_peak + 256 * 1024
@@ -0,0 +1,121 @@
+#
+#   RobotReviewerClient against the fake RobotReviewer server: chunked
+#   reports come back in order, status polls back off, failed requests are
+#   retried, and the chunk size follows the observed latency and throughput
+#
+#   python -m pytest test/test_rrclient.py
+#
+
+import pytest
+import requests
+
+from fake_robotreviewer import FakeRobotReviewer
+from trialstreamer import rrclient
+
+
+def make_articles(n):
+    return [{"ti": f"A randomised trial of treatment {i}", "ab": f"We studied {i} people."} for i in range(n)]
+
+
+def make_client(fake, **kwargs):
+    kwargs.setdefault("retry_backoff", 0.01)
+    return rrclient.RobotReviewerClient(base_url=fake.url, api_key="", **kwargs)
+
+
+def paths(fake, prefix):
+    return [(t, path) for t, method, path in fake.log if path.startswith(prefix)]
+
+
+def test_chunks_returned_in_order():
+    with FakeRobotReviewer(latency=0.05, workers=4) as fake:
+        client = make_client(fake, batch_size=30, min_batch_size=10, max_in_flight=4)
+        X = make_articles(100)
+        out = client.predict(X, tasks=['rct_bot'], filter_rcts='none')
+
+    assert [a['ti'] for a in out] == [a['ti'] for a in X]
+    assert len(paths(fake, '/queue-documents')) == 4
+    assert client.stats["reports"] == 4 and client.stats["articles"] == 100
+
+
+def test_status_polls_back_off():
+    with FakeRobotReviewer(latency=1.0) as fake:
+        client = make_client(fake, poll_initial=0.05, poll_factor=2, poll_max=0.3)
+        client.predict(make_articles(5), filter_rcts='none')
+
+    polls = [t for t, _ in paths(fake, '/report-status/')]
+    gaps = [b - a for a, b in zip(polls, polls[1:])]
+    # sleeps of 0.05, 0.1, 0.2, then capped at 0.3, plus each request's own
+    # time (a fixed 0.05s poll would take 20)
+    assert len(polls) <= 8
+    assert max(gaps) > 2 * gaps[0]
+    assert max(gaps) < 0.3 + 0.15
+
+
+def test_server_errors_are_retried():
+    with FakeRobotReviewer(latency=0.05) as fake:
+        client = make_client(fake, retry_attempts=3)
+        fake.fail_next = 3
+        out = client.predict(make_articles(5), filter_rcts='none')
+
+    assert len(out) == 5
+    # the upload was tried four times, the last one queued
+    assert len(paths(fake, '/queue-documents')) == 4
+    assert fake.reports.keys() == {'0'}
+
+
+def test_gives_up_after_retry_attempts():
+    with FakeRobotReviewer(latency=0.05) as fake:
+        client = make_client(fake, retry_attempts=2)
+        fake.fail_next = 3
+        with pytest.raises(requests.HTTPError):
+            client.predict(make_articles(5), filter_rcts='none')
+
+    assert len(paths(fake, '/queue-documents')) == 3
+    assert not fake.reports
+
+
+def test_connection_errors_are_retried():
+    with FakeRobotReviewer() as fake:
+        url = fake.url
+    client = rrclient.RobotReviewerClient(base_url=url, api_key="", retry_attempts=1, retry_backoff=0.01)
+    with pytest.raises(requests.ConnectionError):
+        client.predict(make_articles(5), filter_rcts='none')
+
+
+def test_slow_reports_shrink_the_chunk_size():
+    with FakeRobotReviewer(latency=0.3) as fake:
+        client = make_client(fake, batch_size=100, min_batch_size=10, target_latency=0.2)
+        client.predict(make_articles(50), filter_rcts='none')
+
+    # one report, over target_latency: shrunk by 1.5x (and not hill climbed,
+    # as fewer articles than a chunk were sent)
+    assert client.batch_size == 66
+
+
+def test_chunk_size_hill_climbs_on_throughput():
+    with FakeRobotReviewer(latency=0.1, per_doc=0.002, workers=4) as fake:
+        client = make_client(fake, batch_size=100, min_batch_size=10, max_batch_size=400, max_in_flight=4)
+        sizes = [client.batch_size]
+        for _ in range(4):
+            client.predict(make_articles(200), filter_rcts='none')
+            sizes.append(client.batch_size)
+
+    # starts by stepping down 1.25x ...
+    assert sizes[1] == 80
+    # ... then takes a step after every full predict()
+    for before, after in zip(sizes, sizes[1:]):
+        assert after != before and 10 <= after <= 400
+    assert client._last_rate is not None
+
+
+def test_tune_reverses_when_throughput_drops():
+    with FakeRobotReviewer() as fake:
+        client = make_client(fake, batch_size=1000, min_batch_size=50, max_batch_size=5000)
+    client._tune(1000, 10.0)  # 100/s: first step is down
+    assert client.batch_size == 800
+    client._tune(1000, 20.0)  # 50/s: worse, so turn round
+    assert client.batch_size == 1000
+    client._tune(1000, 5.0)  # 200/s: better, keep going up
+    assert client.batch_size == 1250
+    client._tune(10, 0.01)  # fewer articles than a chunk: no change
+    assert client.batch_size == 1250
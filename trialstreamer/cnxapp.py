@@ -10,13 +10,14 @@ import connexion
 import trialstreamer
 from trialstreamer import ris
 from collections import OrderedDict
+import concurrent.futures
 import datetime
 import os
+import time
 import humanize
 from flask import json
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extras import Json
 from collections import defaultdict
 import pickle
 from io import BytesIO as StringIO  # py3
@@ -28,7 +29,8 @@ from flask import send_file
 from trialstreamer import schwartz_hearst
 
 log.info("Connecting to database")
-from trialstreamer import dbutil
+from trialstreamer import dbutil, dbpool, picoquery, searchcache
+dbutil.get_db()  # makes any missing tables
 log.info('Done!')
 
 log.info("Loading data")
@@ -109,9 +111,7 @@ def meta():
     returns last updated date, and also total RCT count
     """
 
-    with psycopg2.connect(dbname=trialstreamer.config.POSTGRES_DB, user=trialstreamer.config.POSTGRES_USER,
-           host=trialstreamer.config.POSTGRES_IP, password=trialstreamer.config.POSTGRES_PASS,
-           port=trialstreamer.config.POSTGRES_PORT) as db:
+    with dbpool.connection() as db:
         cur = db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
         # get last PubMed updated date
         cur.execute("select download_date from update_log where update_type='fullcheck' order by download_date desc limit 1;")
@@ -123,6 +123,17 @@ def meta():
     return {"last_updated": last_updated, "num_rcts": f"{num_rcts:,}"}
 
 
+def dbpool_stats():
+    """
+    returns connection pool metrics for this worker (waits for a free connection etc)
+    """
+    out = dbpool.get_pool().stats()
+    cache = searchcache.get_cache()
+    if cache is not None:
+        out['picosearch_cache'] = cache.stats()
+    return out
+
+
 def covid19():
     """
     returns RCTs from Pubmed and MedRxiv in people with Covid-19
@@ -141,9 +152,7 @@ def covid19():
     """
 
     out = []
-    with psycopg2.connect(dbname=trialstreamer.config.POSTGRES_DB, user=trialstreamer.config.POSTGRES_USER,
-           host=trialstreamer.config.POSTGRES_IP, password=trialstreamer.config.POSTGRES_PASS,
-           port=trialstreamer.config.POSTGRES_PORT) as db:
+    with dbpool.connection() as db:
         cur = db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
 
         out = {}
@@ -165,6 +174,16 @@ def get_medrxiv_cite(authors, source, year):
     return f"{authors[0]['author_name']}{' et al.' if len(authors) > 1 else ''}, {source}. {year}"
 
 
+def get_abbrev_dict(row):
+    """
+    the abbreviations stored at annotation time, or (for rows from before
+    the backfill) worked out from the abstract
+    """
+    if row['abbrev_dict'] is not None:
+        return row['abbrev_dict']
+    return schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=row['ab'])
+
+
 def picosearch(body):
     """
     gets brief display info for articles matching a structured PICO query
@@ -184,9 +203,86 @@ def picosearch(body):
         return []
     retmode = body.get("retmode", "json-short")
 
-    builder = []
+    cache = searchcache.get_cache()
+    if cache is not None:
+        key = searchcache.cache_key(query, ordering, expand_terms, retmode)
+        with dbpool.connection() as db:
+            generation = searchcache.data_generation(db)
+        out = cache.get(key, generation)
+        timed_out = []
+        if out is None:
+            out, timed_out = search(query, ordering, expand_terms, retmode)
+            if not timed_out:
+                cache.put(key, generation, out)
+        else:
+            log.info('returning cached results')
+    else:
+        out, timed_out = search(query, ordering, expand_terms, retmode)
+
+    # partial results (a source timed out) are flagged in a header, so the
+    # body keeps its usual shape
+    headers = {"X-Trialstreamer-Timed-Out": ",".join(timed_out)} if timed_out else {}
+
+    log.info('returning results')
+    if retmode=='json-short':
+        return out, 200, headers
+    elif retmode=='ris':
+        report = ris.dumps(out)
+        strIO = StringIO()
+        strIO.write(report.encode('utf-8')) # need to send as a bytestring
+        strIO.seek(0)
+        response = send_file(strIO,
+                             attachment_filename="trialstreamer.ris",
+                             as_attachment=True)
+        response.headers.extend(headers)
+        return response
+
+
+def source_timeout(source):
+    """
+    seconds allowed for one source of a picosearch (picosearch_timeout, or
+    e.g. picosearch_timeout_ictrp for just ICTRP)
+    """
+    return getattr(trialstreamer.config, f'PICOSEARCH_TIMEOUT_{source.upper()}', getattr(trialstreamer.config, 'PICOSEARCH_TIMEOUT', 15))
+
+
+def set_deadline(db, deadline):
+    """
+    makes postgres cancel this transaction's queries at the deadline
+    (a time.time()), so a slow source gives its connection back
+    """
+    remaining = deadline - time.time()
+    if remaining <= 0:
+        raise concurrent.futures.TimeoutError()
+    cur = db.cursor()
+    cur.execute("SET LOCAL statement_timeout = %s;", (max(1, int(remaining * 1000)), ))
+    cur.close()
+
+
+_search_executor = None
 
+
+def get_search_executor():
+    """
+    threads for the picosearch sub-queries (greenlets under gevent, once
+    threading is patched); enough for every pooled connection
+    """
+    global _search_executor
+    if _search_executor is None:
+        _search_executor = concurrent.futures.ThreadPoolExecutor(max_workers=3 * dbpool.get_pool().size)
+    return _search_executor
+
+
+def search(query, ordering, expand_terms, retmode):
+    """
+    runs a picosearch query against PubMed, ICTRP and (for COVID-19) the
+    preprints at once, each on its own pooled connection
+
+    returns the results before formatting, in that order, and a list of the
+    sources which timed out and were left out
+    """
     log.debug('building SQL')
+    terms = []
     for c in query:
 
         if expand_terms:
@@ -194,20 +290,50 @@ def picosearch(body):
         else:
             expansion = [c['cui']]
 
-        subtree_builder = []
+        terms.append((c['field'], sorted(expansion)))
 
-        for c_i in expansion:
+    # off by default: on bench/bench_picosearch.py's synthetic data the
+    # jsonb plan is faster, so only turn it on after measuring real data
+    use_postings = getattr(trialstreamer.config, 'PICOSEARCH_POSTINGS', False)
+    if use_postings:
+        with dbpool.connection() as db:
+            use_postings = picoquery.postings_ready(db)
 
-            field = sql.SQL('.').join((sql.Identifier("pa"), sql.Identifier(f"{c['field']}_mesh")))
-            contents = sql.Literal(Json([{"cui": c_i}]))
-            subtree_builder.append(sql.SQL(' @> ').join((field, contents)))
+    if use_postings:
+        pubmed_params = picoquery.postings_filter(terms, 'pubmed', picoquery.column("pa", "pmid"))
+        ictrp_params = picoquery.postings_filter(terms, 'ictrp', picoquery.column("pa", "regid"))
+    else:
+        pubmed_params = ictrp_params = picoquery.mesh_filter(terms)
 
-        builder.append(sql.SQL('(') + sql.SQL(' OR ').join(subtree_builder) + sql.SQL(')'))
+    sources = [('pubmed', search_pubmed, pubmed_params), ('ictrp', search_ictrp, ictrp_params)]
+    if any(((q_i['cui']=="TS-COV19") and (q_i['field']=="population") for q_i in query)):
+        # only a few hundred preprints, so no postings for these
+        sources.append(('preprints', search_preprints, picoquery.mesh_filter(terms)))
 
-    params = sql.SQL(' AND ').join(builder)
+    start = time.time()
+    executor = get_search_executor()
+    futures = []
+    for source, fn, params in sources:
+        deadline = start + source_timeout(source)
+        futures.append((source, deadline, executor.submit(fn, params, ordering, retmode, deadline)))
 
+    out = []
+    timed_out = []
+    for source, deadline, future in futures:
+        try:
+            # a little longer than the statement_timeout, so that postgres
+            # normally cancels the query (and frees the connection) first
+            out.extend(future.result(timeout=max(0, deadline + 1 - time.time())))
+        except (concurrent.futures.TimeoutError, psycopg2.extensions.QueryCanceledError):
+            log.warning(f'picosearch {source} query timed out after {time.time() - start:.1f}s, leaving it out')
+            timed_out.append(source)
+    log.debug(f'picosearch sub-queries done in {time.time() - start:.2f}s')
+    return out, timed_out
+
+
+def search_pubmed(params, ordering, retmode, deadline):
     if retmode=='json-short':
-        select = sql.SQL("SELECT pm.pmid, pm.ti, pm.ab, pm.year, pa.punchline_text, pa.population, pa.interventions, pa.outcomes, pa.num_randomized, pa.prob_low_rob, pa.punchline_text, pm.pm_data->'authors' as authors, pm.pm_data->'journal' as journal, pm.pm_data->'dois' as dois, pa.prob_low_rob * pa.num_randomized as score FROM pubmed as pm, pubmed_annotations as pa WHERE ")
+        select = sql.SQL("SELECT pm.pmid, pm.ti, pm.ab, pm.year, pa.punchline_text, pa.population, pa.interventions, pa.outcomes, pa.num_randomized, pa.prob_low_rob, pa.punchline_text, pa.abbrev_dict, pm.pm_data->'authors' as authors, pm.pm_data->'journal' as journal, pm.pm_data->'dois' as dois, pa.prob_low_rob * pa.num_randomized as score FROM pubmed as pm, pubmed_annotations as pa WHERE ")
     elif retmode=='ris':
         select = sql.SQL("SELECT pm.pmid as pmid, pm.year as year, pm.ti as ti, pm.ab as ab, pm.pm_data->>'journal' as journal FROM pubmed as pm, pubmed_annotations as pa WHERE ")
 
@@ -221,11 +347,8 @@ def picosearch(body):
     out = []
 
     log.debug('connecting to DB')
-
-    # PUBMED
-    with psycopg2.connect(dbname=trialstreamer.config.POSTGRES_DB, user=trialstreamer.config.POSTGRES_USER,
-           host=trialstreamer.config.POSTGRES_IP, password=trialstreamer.config.POSTGRES_PASS,
-           port=trialstreamer.config.POSTGRES_PORT) as db:
+    with dbpool.connection() as db:
+        set_deadline(db, deadline)
         log.debug('creating cursor')
         with db.cursor(cursor_factory=psycopg2.extras.RealDictCursor, name="pico_cui") as cur:
             log.debug('running query server side')
@@ -242,7 +365,7 @@ def picosearch(body):
                         "dois": row['dois'],
                         "prob_low_rob": row['prob_low_rob'],
                         "num_randomized": row['num_randomized'],
-                        "abbrev_dict": schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=row['ab']),
+                        "abbrev_dict": get_abbrev_dict(row),
                         "article_type": "journal article"})
                 elif retmode=='ris':
                     out.append(OrderedDict([("TY", "JOUR"),
@@ -252,8 +375,10 @@ def picosearch(body):
                                             ("YR", row['year']),
                                             ("JO", row['journal']),
                                             ("AB", row['ab'])]))
+    return out
 
-    ### ICTRP
+
+def search_ictrp(params, ordering, retmode, deadline):
     log.debug('building ICTRP SQL')
     if retmode=='json-short':
         ictrp_select = sql.SQL("SELECT pa.regid, pa.ti, pa.year, pa.population, pa.interventions, pa.outcomes, pa.target_size, pa.is_rct, pa.is_recruiting, pa.countries, pa.date_registered FROM ictrp as pa WHERE ")
@@ -261,10 +386,11 @@ def picosearch(body):
         ictrp_select = sql.SQL("SELECT pa.regid as id, pa.year as year, pa.ti as ti FROM ictrp as pa WHERE ")
     ictrp_join = sql.SQL("AND pa.is_rct='RCT' LIMIT 250;")
 
+    out = []
+
     log.debug('connecting to database (ICTRP)')
-    with psycopg2.connect(dbname=trialstreamer.config.POSTGRES_DB, user=trialstreamer.config.POSTGRES_USER,
-           host=trialstreamer.config.POSTGRES_IP, password=trialstreamer.config.POSTGRES_PASS,
-           port=trialstreamer.config.POSTGRES_PORT) as db:
+    with dbpool.connection() as db:
+        set_deadline(db, deadline)
         log.debug('creating ICTRP cursor')
         with db.cursor(cursor_factory=psycopg2.extras.RealDictCursor, name="pico_mesh") as cur:
             log.debug('running ICTRP query')
@@ -279,58 +405,46 @@ def picosearch(body):
                 elif retmode=='ris':
                     # TODO MAKE RIS REASONABLE FOR ICTRP
                     pass
+    return out
 
-    ### START COVID-19 PREPRINTS
-    if any(((q_i['cui']=="TS-COV19") and (q_i['field']=="population") for q_i in query)):
-
-        if retmode=='json-short':
-            cov_select = sql.SQL("SELECT pa.ti, pa.ab, pa.year, pa.punchline_text, pa.population, pa.interventions, pa.outcomes, pa.num_randomized, pa.prob_low_rob, pa.punchline_text, pa.authors, pa.source, pa.doi FROM medrxiv_covid19 as pa WHERE ")
-        elif retmode=='ris':
-            cov_select = sql.SQL("SELECT pa.year as year, pa.ti as ti, pa.ab as ab FROM medrxiv_covid19 as pa WHERE ")
-        cov_join = sql.SQL(" AND pa.is_rct_balanced=true AND pa.is_human=true LIMIT 250;")
-
-        with psycopg2.connect(dbname=trialstreamer.config.POSTGRES_DB, user=trialstreamer.config.POSTGRES_USER,
-           host=trialstreamer.config.POSTGRES_IP, password=trialstreamer.config.POSTGRES_PASS,
-           port=trialstreamer.config.POSTGRES_PORT) as db:
-            with db.cursor(cursor_factory=psycopg2.extras.RealDictCursor, name="pico_mesh") as cur:
-                cur.execute(cov_select + params + cov_join)
-                log.debug((cov_select + cov_join).as_string(cur))
-                for i, row in enumerate(cur):
-                    if retmode=='json-short':
-                        out.append({"ti": row['ti'], "year": row['year'], "punchline_text": row['punchline_text'],
-                            "citation": get_medrxiv_cite(row['authors'], row['source'], row['year']),
-                            "population": row['population'],
-                            "interventions": row['interventions'],
-                            "dois": [row['doi']],
-                            "outcomes": row['outcomes'],
-                            "prob_low_rob": row['prob_low_rob'],
-                            "num_randomized": row['num_randomized'],
-                            "abbrev_dict": schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=row['ab']),
-                            "article_type": "preprint"})
-                    elif retmode=='ris':
-                        pass
-                        # TODO MAKE RIS REASONABLE FOR ICTRP
 
-    log.info('returning results')
+def search_preprints(params, ordering, retmode, deadline):
     if retmode=='json-short':
-        return out
+        cov_select = sql.SQL("SELECT pa.ti, pa.ab, pa.year, pa.punchline_text, pa.population, pa.interventions, pa.outcomes, pa.num_randomized, pa.prob_low_rob, pa.punchline_text, pa.abbrev_dict, pa.authors, pa.source, pa.doi FROM medrxiv_covid19 as pa WHERE ")
     elif retmode=='ris':
-        report = ris.dumps(out)
-        strIO = StringIO()
-        strIO.write(report.encode('utf-8')) # need to send as a bytestring
-        strIO.seek(0)
-        return send_file(strIO,
-                         attachment_filename="trialstreamer.ris",
-                         as_attachment=True)
+        cov_select = sql.SQL("SELECT pa.year as year, pa.ti as ti, pa.ab as ab FROM medrxiv_covid19 as pa WHERE ")
+    cov_join = sql.SQL(" AND pa.is_rct_balanced=true AND pa.is_human=true LIMIT 250;")
+
+    out = []
+
+    with dbpool.connection() as db:
+        set_deadline(db, deadline)
+        with db.cursor(cursor_factory=psycopg2.extras.RealDictCursor, name="pico_mesh") as cur:
+            cur.execute(cov_select + params + cov_join)
+            log.debug((cov_select + cov_join).as_string(cur))
+            for i, row in enumerate(cur):
+                if retmode=='json-short':
+                    out.append({"ti": row['ti'], "year": row['year'], "punchline_text": row['punchline_text'],
+                        "citation": get_medrxiv_cite(row['authors'], row['source'], row['year']),
+                        "population": row['population'],
+                        "interventions": row['interventions'],
+                        "dois": [row['doi']],
+                        "outcomes": row['outcomes'],
+                        "prob_low_rob": row['prob_low_rob'],
+                        "num_randomized": row['num_randomized'],
+                        "abbrev_dict": get_abbrev_dict(row),
+                        "article_type": "preprint"})
+                elif retmode=='ris':
+                    pass
+                    # TODO MAKE RIS REASONABLE FOR ICTRP
+    return out
 
 
 def get_trial(uuid):
     print(uuid)
 
     out = []
-    with psycopg2.connect(dbname=trialstreamer.config.POSTGRES_DB, user=trialstreamer.config.POSTGRES_USER,
-               host=trialstreamer.config.POSTGRES_IP, password=trialstreamer.config.POSTGRES_PASS,
-               port=trialstreamer.config.POSTGRES_PORT) as db:
+    with dbpool.connection() as db:
         with db.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cur:
             # first try pubmid @TODO probably we can ascertain this w/a regular expression and avoid this
             # brute force means of checking if it's a pmid.
@@ -341,7 +455,7 @@ def get_trial(uuid):
             select = sql.SQL("""
                 SELECT pm.pmid, pm.ti, pm.ab, pm.year, pa.punchline_text, pa.population, pa.interventions, pa.outcomes,
                 pa.population_mesh, pa.interventions_mesh, pa.outcomes_mesh, pa.num_randomized, pa.low_rsg_bias,
-                pa.low_ac_bias, pa.low_bpp_bias, pa.punchline_text, pm.pm_data->'authors' as authors, pm.pm_data->'journal' as journal,
+                pa.low_ac_bias, pa.low_bpp_bias, pa.punchline_text, pa.abbrev_dict, pm.pm_data->'authors' as authors, pm.pm_data->'journal' as journal,
                 pm.pm_data->'dois' as dois FROM pubmed as pm, pubmed_annotations as pa
                 WHERE (pm.pmid = '{0}' AND pa.pmid = '{0}')""".format(uuid))
             cur.execute(select)
@@ -362,7 +476,7 @@ def get_trial(uuid):
                         "low_ac_bias": row['low_ac_bias'],
                         "low_bpp_bias": row['low_bpp_bias'],
                         "num_randomized": row['num_randomized'],
-                        "abbrev_dict": schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=row['ab']),
+                        "abbrev_dict": get_abbrev_dict(row),
                         "article_type": "journal article"})
                 return out
 
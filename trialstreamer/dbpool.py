@@ -0,0 +1,156 @@
+#
+#   Postgres connection pool for the API
+#
+
+from trialstreamer import config
+import contextlib
+import logging
+import threading
+import time
+import psycopg2
+from psycopg2 import extensions
+
+log = logging.getLogger(__name__)
+
+
+def gevent_wait_callback(conn, timeout=None):
+    """
+    psycopg2 wait callback which yields to the gevent hub while waiting on
+    the server, so one slow query doesn't hold up the worker's other greenlets
+    """
+    from gevent.socket import wait_read, wait_write
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(conn.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(conn.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError("Bad result from poll: {}".format(state))
+
+
+def make_green():
+    """
+    install the gevent wait callback if gevent has patched this process
+    (as it has under gunicorn's gevent workers, see server.py)
+    """
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    if not monkey.is_module_patched('socket'):
+        return False
+    extensions.set_wait_callback(gevent_wait_callback)
+    return True
+
+
+class ConnectionPool():
+    """
+    a fixed number of connections shared by the requests of one worker
+
+    connection() blocks (cooperatively, under gevent, since threading is
+    patched) until a connection is free, and keeps count of how long
+    requests wait for one
+    """
+
+    def __init__(self, size=4, **connect_kwargs):
+        self.size = size
+        self.connect_kwargs = connect_kwargs
+        self.idle = []
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.metrics = {"acquired": 0, "connects": 0, "discarded": 0, "in_use": 0,
+                        "wait_seconds": 0.0, "max_wait_seconds": 0.0, "waited": 0}
+
+    def _get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+            self.metrics["connects"] += 1
+        return psycopg2.connect(**self.connect_kwargs)
+
+    def _put(self, conn, discard=False):
+        with self.lock:
+            if discard or conn.closed:
+                self.metrics["discarded"] += 1
+                try:
+                    conn.close()
+                except psycopg2.Error:
+                    pass
+            else:
+                self.idle.append(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """
+        a connection from the pool; committed and returned afterwards, or
+        rolled back if the block raises (and dropped if it is broken)
+        """
+        start = time.time()
+        self.slots.acquire()
+        waited = time.time() - start
+        with self.lock:
+            self.metrics["acquired"] += 1
+            self.metrics["in_use"] += 1
+            self.metrics["wait_seconds"] += waited
+            self.metrics["max_wait_seconds"] = max(self.metrics["max_wait_seconds"], waited)
+            if waited > 0.001:
+                self.metrics["waited"] += 1
+        conn = None
+        try:
+            conn = self._get()
+            yield conn
+            conn.commit()
+        except Exception:
+            if conn is not None:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._put(conn, discard=True)
+                    conn = None
+            raise
+        finally:
+            if conn is not None:
+                self._put(conn)
+            with self.lock:
+                self.metrics["in_use"] -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            out = dict(self.metrics, size=self.size, idle=len(self.idle))
+        out["mean_wait_seconds"] = out["wait_seconds"] / out["acquired"] if out["acquired"] else 0.0
+        return out
+
+    def close(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    the pool for this process (i.e. per gunicorn worker, as they fork before
+    handling any requests), set up from the config
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if make_green():
+                log.info("using gevent wait callback for postgres")
+            _pool = ConnectionPool(size=getattr(config, 'POSTGRES_POOL_SIZE', 4),
+                                   dbname=config.POSTGRES_DB, user=config.POSTGRES_USER,
+                                   host=config.POSTGRES_IP, password=config.POSTGRES_PASS,
+                                   port=config.POSTGRES_PORT)
+        return _pool
+
+
+def connection():
+    return get_pool().connection()
@@ -6,16 +6,90 @@ from trialstreamer import config
 import psycopg2
 import psycopg2.extras
 import datetime
+import threading
 
-db = psycopg2.connect(dbname=config.POSTGRES_DB, user=config.POSTGRES_USER,
-                      host=config.POSTGRES_IP, password=config.POSTGRES_PASS,
-                      port=config.POSTGRES_PORT)
+_db = None
+_db_lock = threading.Lock()
 
 
-def make_tables():
+def connect():
+    """
+    a new connection to the database in the config
+    """
+    return psycopg2.connect(dbname=config.POSTGRES_DB, user=config.POSTGRES_USER,
+                            host=config.POSTGRES_IP, password=config.POSTGRES_PASS,
+                            port=config.POSTGRES_PORT)
+
+
+def get_db():
+    """
+    the connection for this process, opened on first use (when any missing
+    tables are made), so that importing dbutil doesn't need a database
+    """
+    global _db
+    with _db_lock:
+        if _db is None:
+            conn = connect()
+            make_tables(conn)  # if they don't exist
+            _db = conn
+        return _db
+
+
+class _LazyConnection():
+    """
+    stands in for get_db(), so dbutil.db can be used as before
+    """
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+
+db = _LazyConnection()
+
+
+# serialises make_tables and migrate across processes (e.g. gunicorn workers
+# booting at once)
+schema_lock_id = 72290001
+
+
+# the counts read by the API, over pubmed_counts; these used to be
+# materialized views needing a full refresh
+count_views = {
+    "pubmed_year_counts": "select year, is_rct_precise, is_rct_balanced, n as is_rct_sensitive, ptyp_rct, "
+                          "round(rct_probability::numeric) as est_rct_count from pubmed_counts where year >= 1948 and n > 0",
+    "pubmed_rct_count": "select coalesce(sum(is_rct_balanced), 0) as count_rct_balanced from pubmed_counts",
+}
+
+
+# columns missing from the tables of older schemas, as (table, column, type).
+# make_tables only alters a table which lacks one, since ALTER TABLE takes an
+# ACCESS EXCLUSIVE lock even when the column is already there
+added_columns = [
+    # written by pubmed.upload_to_postgres
+    ("pubmed", "update_date", "timestamp"),
+    ("pubmed_excludes", "is_human", "boolean"),
+    ("pubmed_excludes", "update_date", "timestamp"),
+    # Schwartz-Hearst abbreviations of the abstract, computed when the
+    # article is annotated so the API doesn't have to (see
+    # pubmed.backfill_abbrev_dicts)
+    ("pubmed_annotations", "abbrev_dict", "jsonb"),
+    ("medrxiv_covid19", "abbrev_dict", "jsonb"),
+    # written by annotate_rcts, and read by picosearch
+    ("pubmed_annotations", "prob_low_rob", "real"),
+    # see pubmed.get_clf_version
+    ("pubmed_clf_cache", "clf_version", "char(16)"),
+]
+
+
+def make_tables(conn=None):
     """
     set up the database if it doesn't yet exist
+
+    this runs whenever a process first connects (see get_db), so it only
+    creates what is missing; the slow one-off changes are in migrate
     """
+    if conn is None:
+        conn = get_db()
     create_tables_command = ("""create table if not exists pubmed (
             id serial primary key,
             pmid varchar(16) unique,
@@ -67,6 +141,89 @@ def make_tables():
             source_filename varchar(256)
             );
 
+create table if not exists pubmed_clf_cache (
+            content_hash char(40) primary key,
+            clf jsonb,
+            clf_date timestamp,
+            clf_version char(16)
+            );
+
+-- unlogged staging tables for the COPY based bulk load (see pubmed.stage_rows)
+create unlogged table if not exists pubmed_staging (
+            seq bigserial,
+            pmid varchar(16),
+            pm_status varchar(32),
+            year integer,
+            ti text,
+            ab text,
+            pm_data jsonb,
+            source_filename varchar(256),
+            clf_type varchar(16),
+            clf_score real,
+            clf_date timestamp,
+            ptyp_rct smallint,
+            is_rct_precise boolean,
+            is_rct_balanced boolean,
+            is_rct_sensitive boolean,
+            indexing_method varchar(32),
+            score_svm real,
+            score_cnn real,
+            score_svm_cnn real,
+            score_svm_ptyp real,
+            score_cnn_ptyp real,
+            score_svm_cnn_ptyp real,
+            rct_probability real,
+            is_human boolean,
+            update_date timestamp
+            );
+
+create unlogged table if not exists pubmed_excludes_staging (
+            seq bigserial,
+            pmid varchar(16),
+            pm_status varchar(32),
+            year integer,
+            source_filename varchar(256),
+            clf_type varchar(16),
+            clf_score real,
+            clf_date timestamp,
+            ptyp_rct smallint,
+            is_rct_precise boolean,
+            is_rct_balanced boolean,
+            is_rct_sensitive boolean,
+            indexing_method varchar(32),
+            score_svm real,
+            score_cnn real,
+            score_svm_cnn real,
+            score_svm_ptyp real,
+            score_cnn_ptyp real,
+            score_svm_cnn_ptyp real,
+            rct_probability real,
+            is_human boolean,
+            update_date timestamp
+            );
+
+create unlogged table if not exists pubmed_deletes_staging (
+            pmid varchar(16)
+            );
+
+-- how far through each file the staging tables have got, for resuming;
+-- unlogged like them, so that after a crash both are emptied together and
+-- nothing is skipped as already staged
+create unlogged table if not exists ingest_checkpoints (
+            source_filename varchar(256) primary key,
+            record_offset integer,
+            last_pmid varchar(16),
+            complete boolean,
+            update_date timestamp
+            );
+
+do $$
+begin
+    if exists (select 1 from pg_class where oid = 'ingest_checkpoints'::regclass and relpersistence = 'p') then
+        alter table ingest_checkpoints set unlogged;
+    end if;
+end $$;
+
 create unique index if not exists pubmed_pmid on pubmed (pmid);
 create unique index if not exists pubmed_id on pubmed (id);
 
@@ -164,6 +321,7 @@ create table if not exists update_log (
 
 
 create index if not exists idx_pmid_dois on pmid_dois (pmid);
+create index if not exists idx_upw_pmid on upw (pmid);
 create index if not exists idx_pm_data on pubmed using gin((pm_data->'mesh'))
     where is_rct_balanced=true;
 create index if not exists idx_ictrp_pop on pubmed_annotations using gin(population_mesh jsonb_path_ops);
@@ -176,16 +334,31 @@ create index if not exists idx_ti_vec on pubmed using gin(to_tsvector('english'
 create index if not exists idx_ti_ab_vec on pubmed using gin(to_tsvector('english', (ti || '  ' || ab))) where is_rct_balanced=true;
 
 
-create materialized view if not exists pubmed_year_counts AS
-    select year,
-        sum(case is_rct_precise when true then 1 else 0 end) as is_rct_precise,
-        sum(case is_rct_balanced when true then 1 else 0 end) as is_rct_balanced,
-        count(*) as is_rct_sensitive,
-        sum(case ptyp_rct when 1 then 1 else 0 end) as ptyp_rct,
-        round(count(*) * avg(rct_probability)) as est_rct_count
-from pubmed where year >= 1948 group by year;
+-- one row per (annotated article or ICTRP registration, PICO field, CUI),
+-- kept up to date by triggers (see migrate); picosearch looks CUIs up here with
+-- btree scans (cui = any(...)) instead of a jsonb @> probe per CUI
+create table if not exists pico_cuis (
+            source varchar(16),
+            doc_id varchar(32),
+            field varchar(16),
+            cui varchar(16)
+            );
+
+create index if not exists idx_pico_cuis_cui on pico_cuis (source, field, cui, doc_id);
+create index if not exists idx_pico_cuis_doc on pico_cuis (source, doc_id);
 
-create materialized view if not exists pubmed_rct_count as select count(*) as count_rct_balanced from pubmed where is_rct_balanced=true;
+
+-- per-year counts of pubmed (year 0 holds articles without a year), kept up
+-- to date by triggers once migrate has run, and by pubmed.update_counts
+-- until then
+create table if not exists pubmed_counts (
+            year integer primary key,
+            n bigint default 0,
+            is_rct_precise bigint default 0,
+            is_rct_balanced bigint default 0,
+            ptyp_rct bigint default 0,
+            rct_probability double precision default 0
+            );
 
 
 create table if not exists medrxiv_covid19 (
@@ -231,12 +404,234 @@ create table if not exists pubmed_bert (
 # create index if not exists idx_medrxiv_data on medrxiv_covid19 using gin(interventions_mesh) where is_rct_balanced=true;
 # create index if not exists idx_medrxiv_data on medrxiv_covid19 using gin(outcomes_mesh) where is_rct_balanced=true;
 # """
-    cur = db.cursor()
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (schema_lock_id, ))
     cur.execute(create_tables_command)
+    cur.execute("SELECT table_name, column_name FROM information_schema.columns WHERE table_schema = current_schema();")
+    columns = set(cur.fetchall())
+    for table, column, column_type in added_columns:
+        if (table, column) not in columns:
+            cur.execute("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {};".format(table, column, column_type))
+    for name, query in count_views.items():
+        # older databases have materialized views of the same name, which
+        # are left to migrate
+        cur.execute("SELECT to_regclass(%s);", (name, ))
+        if cur.fetchone()[0] is None:
+            cur.execute("CREATE VIEW {} AS {};".format(name, query))
+    cur.close()
+    conn.commit()
+
+
+migrations_command = """
+-- for pubmed.prune_clf_cache
+create index if not exists pubmed_clf_cache_version on pubmed_clf_cache (clf_version);
+
+create or replace function pico_cuis_delta() returns trigger language plpgsql as $$
+begin
+    if TG_OP = 'DELETE' then
+        if TG_TABLE_NAME = 'pubmed_annotations' then
+            delete from pico_cuis p using old_rows r where p.source = 'pubmed' and p.doc_id = r.pmid;
+        else
+            delete from pico_cuis p using old_rows r where p.source = 'ictrp' and p.doc_id = r.regid;
+        end if;
+    elsif TG_OP = 'UPDATE' then
+        -- only the rows whose concepts changed (ictrp.add_year, for one,
+        -- updates every row)
+        if TG_TABLE_NAME = 'pubmed_annotations' then
+            delete from pico_cuis p using old_rows o where p.source = 'pubmed' and p.doc_id = o.pmid
+                and not exists (select 1 from new_rows n where n.pmid = o.pmid and n.population_mesh is not distinct from o.population_mesh
+                    and n.interventions_mesh is not distinct from o.interventions_mesh and n.outcomes_mesh is not distinct from o.outcomes_mesh);
+            insert into pico_cuis (source, doc_id, field, cui)
+                select distinct 'pubmed', r.pmid, f.field, e.elem->>'cui'
+                from new_rows r,
+                    lateral (values ('population', r.population_mesh), ('interventions', r.interventions_mesh), ('outcomes', r.outcomes_mesh)) f(field, mesh),
+                    lateral jsonb_array_elements(case when jsonb_typeof(f.mesh) = 'array' then f.mesh else '[]'::jsonb end) e(elem)
+                where e.elem->>'cui' is not null
+                    and not exists (select 1 from old_rows o where o.pmid = r.pmid and o.population_mesh is not distinct from r.population_mesh
+                    and o.interventions_mesh is not distinct from r.interventions_mesh and o.outcomes_mesh is not distinct from r.outcomes_mesh);
+        else
+            delete from pico_cuis p using old_rows o where p.source = 'ictrp' and p.doc_id = o.regid
+                and not exists (select 1 from new_rows n where n.regid = o.regid and n.population_mesh is not distinct from o.population_mesh
+                    and n.interventions_mesh is not distinct from o.interventions_mesh and n.outcomes_mesh is not distinct from o.outcomes_mesh);
+            insert into pico_cuis (source, doc_id, field, cui)
+                select distinct 'ictrp', r.regid, f.field, e.elem->>'cui'
+                from new_rows r,
+                    lateral (values ('population', r.population_mesh), ('interventions', r.interventions_mesh), ('outcomes', r.outcomes_mesh)) f(field, mesh),
+                    lateral jsonb_array_elements(case when jsonb_typeof(f.mesh) = 'array' then f.mesh else '[]'::jsonb end) e(elem)
+                where e.elem->>'cui' is not null
+                    and not exists (select 1 from old_rows o where o.regid = r.regid and o.population_mesh is not distinct from r.population_mesh
+                    and o.interventions_mesh is not distinct from r.interventions_mesh and o.outcomes_mesh is not distinct from r.outcomes_mesh);
+        end if;
+    else
+        if TG_TABLE_NAME = 'pubmed_annotations' then
+            insert into pico_cuis (source, doc_id, field, cui)
+                select distinct 'pubmed', r.pmid, f.field, e.elem->>'cui'
+                from new_rows r,
+                    lateral (values ('population', r.population_mesh), ('interventions', r.interventions_mesh), ('outcomes', r.outcomes_mesh)) f(field, mesh),
+                    lateral jsonb_array_elements(case when jsonb_typeof(f.mesh) = 'array' then f.mesh else '[]'::jsonb end) e(elem)
+                where e.elem->>'cui' is not null;
+        else
+            insert into pico_cuis (source, doc_id, field, cui)
+                select distinct 'ictrp', r.regid, f.field, e.elem->>'cui'
+                from new_rows r,
+                    lateral (values ('population', r.population_mesh), ('interventions', r.interventions_mesh), ('outcomes', r.outcomes_mesh)) f(field, mesh),
+                    lateral jsonb_array_elements(case when jsonb_typeof(f.mesh) = 'array' then f.mesh else '[]'::jsonb end) e(elem)
+                where e.elem->>'cui' is not null;
+        end if;
+    end if;
+    return null;
+end $$;
+
+do $$
+begin
+    if not exists (select 1 from pg_trigger where tgrelid = 'pubmed_annotations'::regclass and tgname = 'pico_cuis_insert') then
+        -- postings for what is already annotated (once), then keep them up to date
+        lock table pubmed_annotations in share row exclusive mode;
+        delete from pico_cuis where source = 'pubmed';
+        insert into pico_cuis (source, doc_id, field, cui)
+            select distinct 'pubmed', r.pmid, f.field, e.elem->>'cui'
+            from pubmed_annotations r,
+                lateral (values ('population', r.population_mesh), ('interventions', r.interventions_mesh), ('outcomes', r.outcomes_mesh)) f(field, mesh),
+                lateral jsonb_array_elements(case when jsonb_typeof(f.mesh) = 'array' then f.mesh else '[]'::jsonb end) e(elem)
+            where e.elem->>'cui' is not null;
+        create trigger pico_cuis_insert after insert on pubmed_annotations referencing new table as new_rows
+            for each statement execute procedure pico_cuis_delta();
+        create trigger pico_cuis_update after update on pubmed_annotations referencing old table as old_rows new table as new_rows
+            for each statement execute procedure pico_cuis_delta();
+        create trigger pico_cuis_delete after delete on pubmed_annotations referencing old table as old_rows
+            for each statement execute procedure pico_cuis_delta();
+        analyze pico_cuis;
+    end if;
+    if not exists (select 1 from pg_trigger where tgrelid = 'ictrp'::regclass and tgname = 'pico_cuis_insert') then
+        lock table ictrp in share row exclusive mode;
+        delete from pico_cuis where source = 'ictrp';
+        insert into pico_cuis (source, doc_id, field, cui)
+            select distinct 'ictrp', r.regid, f.field, e.elem->>'cui'
+            from ictrp r,
+                lateral (values ('population', r.population_mesh), ('interventions', r.interventions_mesh), ('outcomes', r.outcomes_mesh)) f(field, mesh),
+                lateral jsonb_array_elements(case when jsonb_typeof(f.mesh) = 'array' then f.mesh else '[]'::jsonb end) e(elem)
+            where e.elem->>'cui' is not null;
+        create trigger pico_cuis_insert after insert on ictrp referencing new table as new_rows
+            for each statement execute procedure pico_cuis_delta();
+        create trigger pico_cuis_update after update on ictrp referencing old table as old_rows new table as new_rows
+            for each statement execute procedure pico_cuis_delta();
+        create trigger pico_cuis_delete after delete on ictrp referencing old table as old_rows
+            for each statement execute procedure pico_cuis_delta();
+        analyze pico_cuis;
+    end if;
+end $$;
+
+create or replace function pubmed_counts_delta() returns trigger language plpgsql as $$
+begin
+    if TG_OP in ('UPDATE', 'DELETE') then
+        insert into pubmed_counts as c (year, n, is_rct_precise, is_rct_balanced, ptyp_rct, rct_probability)
+            select coalesce(year, 0), -count(*), -count(*) filter (where is_rct_precise), -count(*) filter (where is_rct_balanced),
+                   -count(*) filter (where ptyp_rct = 1), -coalesce(sum(rct_probability), 0)
+            from old_rows group by coalesce(year, 0)
+        on conflict (year) do update set n = c.n + excluded.n, is_rct_precise = c.is_rct_precise + excluded.is_rct_precise,
+            is_rct_balanced = c.is_rct_balanced + excluded.is_rct_balanced, ptyp_rct = c.ptyp_rct + excluded.ptyp_rct,
+            rct_probability = c.rct_probability + excluded.rct_probability;
+    end if;
+    if TG_OP in ('INSERT', 'UPDATE') then
+        insert into pubmed_counts as c (year, n, is_rct_precise, is_rct_balanced, ptyp_rct, rct_probability)
+            select coalesce(year, 0), count(*), count(*) filter (where is_rct_precise), count(*) filter (where is_rct_balanced),
+                   count(*) filter (where ptyp_rct = 1), coalesce(sum(rct_probability), 0)
+            from new_rows group by coalesce(year, 0)
+        on conflict (year) do update set n = c.n + excluded.n, is_rct_precise = c.is_rct_precise + excluded.is_rct_precise,
+            is_rct_balanced = c.is_rct_balanced + excluded.is_rct_balanced, ptyp_rct = c.ptyp_rct + excluded.ptyp_rct,
+            rct_probability = c.rct_probability + excluded.rct_probability;
+    end if;
+    return null;
+end $$;
+
+do $$
+begin
+    if exists (select 1 from pg_matviews where schemaname = current_schema() and matviewname = 'pubmed_year_counts') then
+        drop materialized view pubmed_year_counts;
+    end if;
+    if exists (select 1 from pg_matviews where schemaname = current_schema() and matviewname = 'pubmed_rct_count') then
+        drop materialized view pubmed_rct_count;
+    end if;
+    if not exists (select 1 from pg_trigger where tgrelid = 'pubmed'::regclass and tgname = 'pubmed_counts_insert') then
+        -- counts for what is already there (once), then keep them up to date
+        lock table pubmed in share row exclusive mode;
+        delete from pubmed_counts;
+        insert into pubmed_counts (year, n, is_rct_precise, is_rct_balanced, ptyp_rct, rct_probability)
+            select coalesce(year, 0), count(*), count(*) filter (where is_rct_precise), count(*) filter (where is_rct_balanced),
+                   count(*) filter (where ptyp_rct = 1), coalesce(sum(rct_probability), 0)
+            from pubmed group by coalesce(year, 0);
+        create trigger pubmed_counts_insert after insert on pubmed referencing new table as new_rows
+            for each statement execute procedure pubmed_counts_delta();
+        create trigger pubmed_counts_update after update on pubmed referencing old table as old_rows new table as new_rows
+            for each statement execute procedure pubmed_counts_delta();
+        create trigger pubmed_counts_delete after delete on pubmed referencing old table as old_rows
+            for each statement execute procedure pubmed_counts_delta();
+    end if;
+end $$;
+
+"""
+
+
+def migrate():
+    """
+    the slow, one-off changes to an existing database, run with update.py
+    --migrate after upgrading (and safe to run again): replaces the count
+    materialized views, backfills pubmed_counts and pico_cuis, creates
+    the triggers which keep them up to date from then on, and indexes the
+    classification cache by version
+    """
+    cur = db.cursor()
+    cur.execute("SELECT pg_advisory_xact_lock(%s);", (schema_lock_id, ))
+    cur.execute(migrations_command)
+    for name, query in count_views.items():
+        cur.execute("CREATE OR REPLACE VIEW {} AS {};".format(name, query))
     cur.close()
     db.commit()
 
 
+def copy_value(v):
+    """
+    a value in COPY text format
+    """
+    if v is None:
+        return '\\N'
+    if isinstance(v, bool):
+        return 't' if v else 'f'
+    if isinstance(v, (datetime.date, datetime.datetime)):
+        return v.isoformat()
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class _CopyBuffer():
+    """
+    file-like object feeding rows to copy_expert a line at a time, so the
+    whole batch is never held as one string
+    """
+
+    def __init__(self, rows):
+        self.lines = ('\t'.join(copy_value(v) for v in row) + '\n' for row in rows)
+        self.buf = ''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            out, self.buf = self.buf + ''.join(self.lines), ''
+            return out
+        while len(self.buf) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buf += line
+        out, self.buf = self.buf[:size], self.buf[size:]
+        return out
+
+
+def copy_rows(cur, table, columns, rows):
+    """
+    stream rows (tuples in the order of columns) into table with COPY FROM STDIN
+    """
+    cur.copy_expert("COPY {} ({}) FROM STDIN".format(table, ', '.join(columns)), _CopyBuffer(rows))
+
+
 def log_update(update_type=None, source_filename=None, source_date=None,
                download_date=None):
     if download_date is None:
@@ -263,10 +658,3 @@ def last_update(update_type):
     else:
         return None
 
-
-def update_counts():
-    cur = db.cursor()
-    cur.execute("SELECT COUNT(*) FROM pubmed WHERE is_rct_precise=true;")
-
-
-make_tables()  # if they don't exist
@@ -0,0 +1,129 @@
+#
+#   Pooled FTP downloads
+#
+
+import ftplib
+import logging
+import queue
+import threading
+import time
+import tqdm
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+
+class FTPPool():
+    """
+    a bounded pool of logged in FTP sessions, which are reused between
+    downloads, and thrown away (and reconnected on next use) after an error
+
+    host/port can point at a local FTP server (e.g. pyftpdlib) for testing
+    """
+
+    def __init__(self, host, user="anonymous", passwd="", port=21, size=4, timeout=60):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.passwd = passwd
+        self.size = size
+        self.timeout = timeout
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def connect(self):
+        ftp = ftplib.FTP(timeout=self.timeout)
+        ftp.connect(self.host, self.port)
+        ftp.login(user=self.user, passwd=self.passwd)
+        return ftp
+
+    @contextmanager
+    def connection(self):
+        """
+        borrow a session from the pool (logging in if none are idle)
+        """
+        self._slots.acquire()
+        try:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                ftp = self.connect()
+            try:
+                yield ftp
+            except Exception:
+                # session may be left mid-transfer; drop it and reconnect next time
+                self._discard(ftp)
+                raise
+            else:
+                self._idle.put(ftp)
+        finally:
+            self._slots.release()
+
+    def _discard(self, ftp):
+        try:
+            ftp.close()
+        except Exception:
+            pass
+
+    def close(self):
+        while True:
+            try:
+                ftp = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                ftp.quit()
+            except Exception:
+                self._discard(ftp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def download_all(pool, jobs, fetch, max_retry_attempts=1, retry_backoff=0, desc="files downloaded"):
+    """
+    run fetch(ftp, job) for each job across the pool's sessions
+
+    fetch should return the number of bytes transferred; a failing job is
+    retried (on a fresh session) up to max_retry_attempts times, waiting
+    retry_backoff * 2**(attempt - 1) seconds before each retry
+    returns the list of jobs which could not be completed
+    """
+    stats = {"bytes": 0, "files": 0}
+    lock = threading.Lock()
+
+    def run(job):
+        attempt = 0
+        while True:
+            try:
+                with pool.connection() as ftp:
+                    n_bytes = fetch(ftp, job)
+                with lock:
+                    stats["bytes"] += n_bytes
+                    stats["files"] += 1
+                return True
+            except Exception as e:
+                attempt += 1
+                if attempt > max_retry_attempts:
+                    log.error(f'Giving up on {job} after {attempt} attempts: {e}')
+                    return False
+                log.info(f'Failed {job} ({e}), retrying download ({attempt})...')
+                time.sleep(retry_backoff * 2 ** (attempt - 1))
+
+    failed = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=pool.size) as executor:
+        futures = {executor.submit(run, job): job for job in jobs}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures), desc=desc):
+            if not future.result():
+                failed.append(futures[future])
+
+    elapsed = time.time() - start
+    if stats["files"]:
+        log.info("Downloaded {} files, {:.1f} MB in {:.1f}s ({:.2f} MB/s over {} connections)".format(
+            stats["files"], stats["bytes"] / 1e6, elapsed, stats["bytes"] / 1e6 / max(elapsed, 1e-6), pool.size))
+    return failed
@@ -300,8 +300,11 @@ def parse_file(fn):
         for line in tqdm.tqdm(iter(process.stdout.readline, b'')):  # replace '' with b'' for Python 3
             yield json.loads(line.decode('utf-8'))
 
-def upload_to_postgres(fn, force_update=False):
-
+def upload_to_postgres(fn, force_update=False, batch_size=500):
+    """
+    insert the RCTs from an ICTRP file, batch_size rows per statement (so
+    the statement level pico_cuis trigger fires once per batch)
+    """
 
     cur = dbutil.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
@@ -313,10 +316,15 @@ def upload_to_postgres(fn, force_update=False):
         already_done = set((r['regid'] for r in cur))
 
 
-    for i, entry in tqdm.tqdm(enumerate(parse_file(fn)), desc="parsing ICTRP entries"):
+    rows = []
 
-        if i % 500 == 0:
-            dbutil.db.commit()
+    def flush():
+        psycopg2.extras.execute_values(cur, "INSERT INTO ictrp (regid, ti, population, interventions, outcomes, population_mesh, interventions_mesh, outcomes_mesh, is_rct, is_recruiting, target_size, date_registered, year, countries, ictrp_data, source_filename) VALUES %s;",
+            rows, page_size=len(rows))
+        dbutil.db.commit()
+        rows.clear()
+
+    for i, entry in tqdm.tqdm(enumerate(parse_file(fn)), desc="parsing ICTRP entries"):
 
         if entry['study_id'] in already_done:
             continue
@@ -333,13 +341,15 @@ def upload_to_postgres(fn, force_update=False):
             json.dumps(p['interventions_mesh']), json.dumps(p['outcomes_mesh']),
             p['is_rct'], p['is_recruiting'], p['target_size'], p['date_registered'], p['year'],
             json.dumps(p['countries']), json.dumps(entry), fn)
-
-        cur.execute("INSERT INTO ictrp (regid, ti, population, interventions, outcomes, population_mesh, interventions_mesh, outcomes_mesh, is_rct, is_recruiting, target_size, date_registered, year, countries, ictrp_data, source_filename) VALUES (%s, %s, %s, %s,%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
-            row)
+        rows.append(row)
 
         already_done.add(entry['study_id'])
 
+        if len(rows) >= batch_size:
+            flush()
 
+    if rows:
+        flush()
     cur.close()
     dbutil.db.commit()
 
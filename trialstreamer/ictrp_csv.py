@@ -310,8 +310,11 @@ def check_if_new_data():
         return None
 
 
-def upload_to_postgres(fn, force_update=False):
-
+def upload_to_postgres(fn, force_update=False, batch_size=500):
+    """
+    upsert the RCTs from an ICTRP CSV export, batch_size rows per statement
+    (so the statement level pico_cuis triggers fire once per batch)
+    """
 
     cur = dbutil.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
@@ -322,15 +325,20 @@ def upload_to_postgres(fn, force_update=False):
         cur.execute("SELECT regid from ictrp;")
         already_done = set((r['regid'] for r in cur))
     timestamp = datetime.datetime.now()
+    rows = []
+
+    def flush():
+        psycopg2.extras.execute_values(cur, "INSERT INTO ictrp (regid, ti, population, interventions, outcomes, population_mesh, interventions_mesh, outcomes_mesh, is_rct, is_recruiting, target_size, date_registered, year, countries, ictrp_data, source_filename, url, update_date) VALUES %s ON CONFLICT (regid) DO UPDATE SET ti=EXCLUDED.ti, population=EXCLUDED.population, interventions=EXCLUDED.interventions, outcomes=EXCLUDED.outcomes, population_mesh=EXCLUDED.population_mesh, interventions_mesh=EXCLUDED.interventions_mesh, outcomes_mesh=EXCLUDED.outcomes_mesh, is_rct=EXCLUDED.is_rct, is_recruiting=EXCLUDED.is_recruiting, target_size=EXCLUDED.target_size, date_registered=EXCLUDED.date_registered, year=EXCLUDED.year, countries=EXCLUDED.countries, ictrp_data=EXCLUDED.ictrp_data, source_filename=EXCLUDED.source_filename, url=EXCLUDED.url, update_date=EXCLUDED.update_date;",
+            rows, page_size=len(rows))
+        dbutil.db.commit()
+        rows.clear()
+
     with zipfile.ZipFile(fn) as zipf:
 	    csv_fn = [i.filename for i in zipf.infolist() if os.path.splitext(i.filename)[-1]=='.csv'][0]	    
 	    with io.TextIOWrapper(zipf.open(csv_fn), encoding="utf-8-sig") as csvf:
                 reader = csv.DictReader(csvf, fieldnames=headers, delimiter=",")
                 for i, r in tqdm.tqdm(enumerate(reader), desc="parsing ICTRP entries"):
 
-                    if i % 500 == 0:
-                        dbutil.db.commit()
-
                     if r['study_id'] in already_done:
                         continue
 
@@ -345,11 +353,15 @@ def upload_to_postgres(fn, force_update=False):
                         json.dumps(p['countries']), json.dumps([]), fn, p['url'], timestamp) # temporarily we will not have the full parsed data
 
 
-                    cur.execute("INSERT INTO ictrp (regid, ti, population, interventions, outcomes, population_mesh, interventions_mesh, outcomes_mesh, is_rct, is_recruiting, target_size, date_registered, year, countries, ictrp_data, source_filename, url, update_date) VALUES (%s, %s, %s, %s,%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (regid) DO UPDATE SET ti=EXCLUDED.ti, population=EXCLUDED.population, interventions=EXCLUDED.interventions, outcomes=EXCLUDED.outcomes, population_mesh=EXCLUDED.population_mesh, interventions_mesh=EXCLUDED.interventions_mesh, outcomes_mesh=EXCLUDED.outcomes_mesh, is_rct=EXCLUDED.is_rct, is_recruiting=EXCLUDED.is_recruiting, target_size=EXCLUDED.target_size, date_registered=EXCLUDED.date_registered, year=EXCLUDED.year, countries=EXCLUDED.countries, ictrp_data=EXCLUDED.ictrp_data, source_filename=EXCLUDED.source_filename, url=EXCLUDED.url, update_date=EXCLUDED.update_date;",
-                        row)
+                    rows.append(row)
 
                     already_done.add(r['study_id'])
 
+                    if len(rows) >= batch_size:
+                        flush()
+
+    if rows:
+        flush()
     cur.close()
     dbutil.db.commit()
 
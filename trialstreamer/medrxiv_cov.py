@@ -7,8 +7,9 @@ import os
 import json
 import requests
 import datetime
-from trialstreamer import config, dbutil
+from trialstreamer import config, dbutil, rrclient, schwartz_hearst
 import psycopg2
+from psycopg2.extras import execute_values
 import time
 import logging
 
@@ -44,27 +45,7 @@ def get_articles():
 
 
 def predict(X, tasks=None, filter_rcts="is_rct_sensitive"):
-
-    if tasks is None:
-        tasks = ['rct_bot']
-    base_url = config.ROBOTREVIEWER_URL
-    upload_data = {
-        "articles": X,
-        "robots": tasks,
-        "filter_rcts": filter_rcts
-    }
-    r = requests.post(base_url+'queue-documents', json=upload_data, headers={"api-key": trialstreamer.config.ROBOTREVIEWER_API_KEY})
-    report_id = r.json()
-
-    def check_report(report_id):
-        r = requests.get(base_url +'report-status/'+report_id['report_id'], headers={"api-key": trialstreamer.config.ROBOTREVIEWER_API_KEY})
-        return r.json()['state'] == 'SUCCESS'
-
-    while not check_report(report_id):
-        time.sleep(0.3)
-
-    report = requests.get(base_url +'report/'+report_id['report_id'], headers={"api-key": trialstreamer.config.ROBOTREVIEWER_API_KEY}).json()
-    return report
+    return rrclient.predict(X, tasks=tasks, filter_rcts=filter_rcts)
 
 
 def upload_to_postgres(annotations, meta):
@@ -88,9 +69,9 @@ def upload_to_postgres(annotations, meta):
         ti, ab, is_human, is_rct_precise, is_rct_balanced, is_rct_sensitive,
         rct_probability, population, interventions, outcomes, population_mesh,
         interventions_mesh, outcomes_mesh, num_randomized, prob_low_rob,
-        punchline_text, effect, authors, source) VALUES (%s, 
+        punchline_text, effect, authors, source, abbrev_dict) VALUES (%s, 
         %s, %s, %s, %s, %s, %s,  %s, %s, %s, %s, %s, %s, %s, %s, 
-        %s, %s, %s, %s, %s, %s, %s, %s);
+        %s, %s, %s, %s, %s, %s, %s, %s, %s);
         """, (m['doi'], m['url'], m['year'], m['date'], a['ti'], a['ab'],
              a['human_bot']['is_human'], a['rct_bot']['is_rct_precise'], 
              a['rct_bot']['is_rct_balanced'], a['rct_bot']['is_rct_sensitive'],
@@ -106,9 +87,31 @@ def upload_to_postgres(annotations, meta):
              a['punchline_bot']['punchline_text'],
              a['punchline_bot']['effect'],
             json.dumps(m['authors']),
-             m['source']))
+             m['source'],
+             json.dumps(schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=a['ab']))))
    
     
+def backfill_abbrev_dicts(batch_size=1000):
+    """
+    fill in abbrev_dict for preprints stored before it was computed
+    """
+    cur = dbutil.db.cursor()
+    todo_cur = dbutil.db.cursor(name='preprint_abbrevs_to_backfill', withhold=True)
+    todo_cur.itersize = batch_size * 10
+    todo_cur.execute("SELECT id, ab FROM medrxiv_covid19 WHERE abbrev_dict IS NULL;")
+
+    num_updated = 0
+    for rows in iter(lambda: todo_cur.fetchmany(batch_size), []):
+        execute_values(cur, "UPDATE medrxiv_covid19 m SET abbrev_dict = v.abbrev_dict::jsonb FROM (VALUES %s) AS v(id, abbrev_dict) WHERE m.id = v.id;",
+                       [(id_, json.dumps(schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=ab))) for id_, ab in rows])
+        dbutil.db.commit()
+        num_updated += len(rows)
+
+    todo_cur.close()
+    cur.close()
+    log.info(f'{num_updated} preprint abbreviation dictionaries backfilled')
+
+
 def update():
     log.info("Fetching articles from MedRxiv feed")
     articles = get_articles()
@@ -0,0 +1,53 @@
+#
+#   SQL for the PICO concept conditions of a picosearch
+#
+
+from psycopg2 import sql
+from psycopg2.extras import Json
+
+
+def column(alias, name):
+    return sql.SQL('.').join((sql.Identifier(alias), sql.Identifier(name)))
+
+
+def mesh_filter(terms, alias="pa"):
+    """
+    condition on the jsonb <field>_mesh columns of alias, for terms as a list
+    of (field, cuis): one @> probe per CUI, ORed within a term and ANDed
+    across terms
+    """
+    builder = []
+    for field, cuis in terms:
+        mesh = column(alias, f"{field}_mesh")
+        subtree_builder = [sql.SQL(' @> ').join((mesh, sql.Literal(Json([{"cui": c_i}])))) for c_i in cuis]
+        builder.append(sql.SQL('(') + sql.SQL(' OR ').join(subtree_builder) + sql.SQL(')'))
+    return sql.SQL(' AND ').join(builder)
+
+
+def postings_filter(terms, source, id_column):
+    """
+    the same condition from the pico_cuis postings: id_column (e.g.
+    column("pa", "pmid")) is in the intersection, over the terms, of the
+    documents with any of the term's CUIs in its field
+    """
+    builder = []
+    for field, cuis in terms:
+        builder.append(sql.SQL("SELECT doc_id FROM pico_cuis WHERE source = {} AND field = {} AND cui = ANY({})").format(
+            sql.Literal(source), sql.Literal(field), sql.Literal(list(cuis))))
+    return id_column + sql.SQL(" IN (") + sql.SQL(' INTERSECT ').join(builder) + sql.SQL(")")
+
+
+def postings_ready(db):
+    """
+    whether pico_cuis has been filled, and its triggers set up, by
+    update.py --migrate; until then (or if the postings have since been
+    emptied or the triggers dropped) the jsonb columns have to be searched
+
+    checked on every search, as a few catalog and index probes
+    """
+    cur = db.cursor()
+    cur.execute("SELECT (SELECT count(*) FROM pg_trigger WHERE tgname = 'pico_cuis_insert' AND tgrelid IN ('pubmed_annotations'::regclass, 'ictrp'::regclass)) = 2 "
+                "AND (EXISTS (SELECT 1 FROM pico_cuis) OR NOT EXISTS (SELECT 1 FROM pubmed_annotations));")
+    ready = cur.fetchone()[0]
+    cur.close()
+    return ready
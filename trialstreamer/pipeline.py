@@ -0,0 +1,131 @@
+#
+#   Threaded pipeline with bounded queues between stages
+#
+
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Pipeline():
+    """
+    runs a source iterator and a chain of stage functions each in their own
+    thread, joined by bounded queues, so that (e.g.) parsing, classifying
+    and writing can all be busy at once
+
+    iterating over the pipeline (from the consuming thread) yields the output
+    of the last stage, in the order the source produced its items. an
+    exception in any stage is re-raised in the consumer. if the consumer
+    stops early (e.g. it raises), it should call close() so that the
+    threads stop
+
+    source_name = name for the source stage (for depths/timings)
+    stages = list of (name, function) pairs, each taking and returning an item
+    maxsize = max number of items waiting after each stage
+    """
+
+    def __init__(self, source, stages, source_name="source", maxsize=2):
+        self.source = source
+        self.names = [source_name] + [name for name, _ in stages]
+        self.stages = stages
+        self.queues = [queue.Queue(maxsize=maxsize) for _ in self.names]
+        self.busy = {name: 0.0 for name in self.names}
+        self.stop = threading.Event()
+        self.error = None
+        self.threads = []
+
+    def depths(self):
+        """
+        items waiting after each stage; a full queue points at a slow stage
+        downstream of it, empty queues at a slow stage upstream
+        """
+        return {name: q.qsize() for name, q in zip(self.names, self.queues)}
+
+    def timings(self):
+        """
+        seconds each stage has spent working (rather than waiting)
+        """
+        return dict(self.busy)
+
+    def _put(self, q, item):
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q):
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fail(self, e):
+        self.error = e
+        self.stop.set()
+
+    def _run_source(self):
+        name, q_out = self.names[0], self.queues[0]
+        try:
+            items = iter(self.source)
+            while True:
+                start = time.time()
+                item = next(items, _DONE)
+                self.busy[name] += time.time() - start
+                if item is _DONE or not self._put(q_out, item):
+                    break
+        except Exception as e:
+            log.exception(f"pipeline stage {name} failed")
+            self._fail(e)
+        self._put(q_out, _DONE)
+
+    def _run_stage(self, idx):
+        name, fn = self.stages[idx]
+        q_in, q_out = self.queues[idx], self.queues[idx + 1]
+        try:
+            while True:
+                item = self._get(q_in)
+                if item is _DONE:
+                    break
+                start = time.time()
+                out = fn(item)
+                self.busy[name] += time.time() - start
+                if not self._put(q_out, out):
+                    break
+        except Exception as e:
+            log.exception(f"pipeline stage {name} failed")
+            self._fail(e)
+        self._put(q_out, _DONE)
+
+    def close(self):
+        """
+        stop every stage and wait for their threads to finish
+        """
+        self.stop.set()
+        for t in self.threads:
+            t.join()
+
+    def __iter__(self):
+        self.threads = [threading.Thread(target=self._run_source, daemon=True)]
+        self.threads.extend(threading.Thread(target=self._run_stage, args=(i,), daemon=True) for i in range(len(self.stages)))
+        for t in self.threads:
+            t.start()
+        try:
+            while True:
+                item = self._get(self.queues[-1])
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self.close()
+        if self.error is not None:
+            raise self.error
@@ -3,7 +3,8 @@
 #
 
 
-from trialstreamer import dbutil, config
+from trialstreamer import dbutil, config, ftppool, rrclient, schwartz_hearst
+from trialstreamer.pipeline import Pipeline
 from trialstreamer.readers import pmreader
 import trialstreamer
 import logging
@@ -14,6 +15,10 @@ from dateutil import parser
 import hashlib
 import tqdm
 import xml.etree.cElementTree as ET
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
 import subprocess
 import sys
 import json
@@ -22,9 +27,15 @@ import ftplib
 import glob
 import psycopg2
 import collections
+import functools
+import itertools
+import multiprocessing
+import numpy as np
 from itertools import zip_longest
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from psycopg2.extras import execute_values
 import requests
+import threading
 import time
 
 
@@ -37,6 +48,27 @@ log = logging.getLogger(__name__)
 
 homepage = "ftp.ncbi.nlm.nih.gov"
 max_retry_attempts = config.DOWNLOAD_RETRY_ATTEMPTS or 1
+ftp_workers = getattr(config, 'FTP_WORKERS', 4)
+retry_backoff = getattr(config, 'DOWNLOAD_RETRY_BACKOFF', 2)
+md5_block_size = 1024 * 1024
+manifest_basename = 'md5_manifest.json'
+
+record_tags = ("MedlineCitation", "PubmedArticle", "PubmedBookArticle", "DeleteCitation")
+xml_backend = getattr(config, 'XML_BACKEND', 'etree')
+pipeline_queue_size = getattr(config, 'PIPELINE_QUEUE_SIZE', 2)
+clf_cache_enabled = getattr(config, 'CLF_CACHE', True)
+bulk_copy = getattr(config, 'PUBMED_BULK_COPY', True)
+annotate_workers = getattr(config, 'ANNOTATE_WORKERS', 4)
+# a fixed article, whose RobotReviewer scores identify the model (see get_clf_version)
+clf_probe = {"ti": "Aspirin versus placebo for the prevention of stroke: a randomised controlled trial",
+             "ab": "We randomly assigned 2000 adults with atrial fibrillation to aspirin or placebo. "
+                   "The primary outcome was stroke at two years.",
+             "ptyp": ["Randomized Controlled Trial", "Journal Article"]}
+_clf_version = None
+_clf_version_lock = threading.Lock()
+if xml_backend == 'lxml' and lxml_etree is None:
+    log.warning("xml_backend is set to lxml, but lxml is not installed; using ElementTree")
+    xml_backend = 'etree'
 
 
 def get_ftp():
@@ -117,9 +149,10 @@ def already_done_updates():
     return already_done_files
 
 
-def download_ftp_updates():
+def download_ftp_updates(workers=1):
     """
     Grab the updates
+    workers = number of processes parsing files in parallel
 
     """
     log.info("Obtaining daily updates from PubMed")
@@ -145,14 +178,15 @@ def download_ftp_updates():
 
     log.info("Checking hashfiles, and downloading any missing")
 
-    download_md5s(update_ftp_fns, updates=True)
-    download_and_validate_gzs(update_ftp_fns, updates=True)
+    with get_ftp_pool() as pool:
+        download_md5s(update_ftp_fns, updates=True, pool=pool)
+        download_and_validate_gzs(update_ftp_fns, updates=True, pool=pool)
     log.info("Uploading to postgres")
     already_done_fns = already_done_gzs(updates=True)
     log.info(f"{len(already_done_fns)} valid gz files")
 
     safety_test_parse = config.SAFETY_TEST_PARSE
-    upload_to_postgres(update_ftp_fns, safety_test_parse=safety_test_parse, batch_size=5000, updates=True, modtimes=update_ftp_mod_times)
+    upload_to_postgres(update_ftp_fns, safety_test_parse=safety_test_parse, batch_size=5000, updates=True, modtimes=update_ftp_mod_times, workers=workers)
 
     log.info("Uploaded!")
     # log.info("Refreshing counts")
@@ -160,18 +194,38 @@ def download_ftp_updates():
     log.info("All done successfully!")
 
 
-def update_counts():
+def update_counts(force=False):
+    """
+    bring the per-year counts up to date
+
+    once update.py --migrate has set up the triggers on pubmed, they keep
+    pubmed_counts current and this does nothing (unless force, for repairs);
+    until then the counts are redone from scratch here, and any materialized
+    views left from older schemas refreshed
+    """
     cur = dbutil.db.cursor()
-    cur.execute("refresh materialized view pubmed_rct_count;")
+    cur.execute("SELECT 1 FROM pg_trigger WHERE tgrelid = 'pubmed'::regclass AND tgname = 'pubmed_counts_insert';")
+    if cur.fetchone() is not None and not force:
+        cur.close()
+        return
+    cur.execute("LOCK TABLE pubmed IN SHARE ROW EXCLUSIVE MODE;")
+    cur.execute("DELETE FROM pubmed_counts;")
+    cur.execute("INSERT INTO pubmed_counts (year, n, is_rct_precise, is_rct_balanced, ptyp_rct, rct_probability) "
+                "SELECT coalesce(year, 0), count(*), count(*) filter (where is_rct_precise), count(*) filter (where is_rct_balanced), "
+                "count(*) filter (where ptyp_rct = 1), coalesce(sum(rct_probability), 0) FROM pubmed GROUP BY coalesce(year, 0);")
+    cur.execute("SELECT matviewname FROM pg_matviews WHERE schemaname = current_schema() AND matviewname IN ('pubmed_year_counts', 'pubmed_rct_count');")
+    for (matview, ) in cur.fetchall():
+        cur.execute("REFRESH MATERIALIZED VIEW {};".format(matview))
     cur.close()
     dbutil.db.commit()
 
 
-def download_ftp_baseline(force_update=False):
+def download_ftp_baseline(force_update=False, workers=1):
     """
     Grab all the latest baseline files (checking if already done first)
 
     edit safety_test_parse in config file for deployment
+    workers = number of processes parsing files in parallel
 
     """
     log.info("Checking baseline data from PubMed")
@@ -186,18 +240,19 @@ def download_ftp_baseline(force_update=False):
     baseline_ftp_fns = get_baseline_fns()
     log.info("{} PubMed title/abstract files on FTP server".format(len(baseline_ftp_fns)))
     log.info("Checking hashfiles, and downloading any missing")
-    download_md5s(baseline_ftp_fns)
-    log.info("Verifying local gzipped data files")
-    already_done_fns = already_done_gzs()
+    with get_ftp_pool() as pool:
+        download_md5s(baseline_ftp_fns, pool=pool)
+        log.info("Verifying local gzipped data files")
+        already_done_fns = already_done_gzs()
 
-    # validate_downloaded_data(already_done_fns)
+        # validate_downloaded_data(already_done_fns)
 
-    log.info("Data validated")
-    log.info("Downloading and validating remaining files")
-    download_and_validate_gzs(baseline_ftp_fns)
+        log.info("Data validated")
+        log.info("Downloading and validating remaining files")
+        download_and_validate_gzs(baseline_ftp_fns, pool=pool)
     download_date = datetime.datetime.now()
     log.info("Uploading to postgres")
-    upload_to_postgres(baseline_ftp_fns, safety_test_parse, force_update=force_update)
+    upload_to_postgres(baseline_ftp_fns, safety_test_parse, force_update=force_update, workers=workers)
     log.info("Uploaded!")
     # log.info("Refreshing counts")
     # update_counts()
@@ -206,174 +261,404 @@ def download_ftp_baseline(force_update=False):
     dbutil.log_update(update_type='pubmed_baseline', source_filename=os.path.basename(baseline_ftp_fns[0])[:8], source_date=get_date_from_fn(baseline_ftp_fns[0]), download_date=download_date)
 
 
-def download_md5s(gz_fns, updates=False):
+def get_ftp_pool(size=None):
+    """
+    bounded pool of persistent FTP sessions to the PubMed server
+    """
+    if size is None:
+        size = ftp_workers
+    return ftppool.FTPPool(homepage, user="anonymous", passwd=config.PUBMED_USER_EMAIL, size=size)
+
+
+def local_path(gz_fn, updates=False):
+    if updates:
+        return os.path.join(config.PUBMED_LOCAL_DATA_PATH, 'updates', os.path.basename(gz_fn))
+    else:
+        return os.path.join(config.PUBMED_LOCAL_DATA_PATH, os.path.basename(gz_fn))
+
+
+def retr_to_file(ftp, remote_fn, out_filename, hasher=None, resume=False):
+    """
+    download a single file over an open FTP session, returns bytes written
+    if a hashlib object is passed, each chunk is fed to it as it is written
+
+    if resume=True the transfer goes to out_filename + '.part', which is kept
+    when the transfer fails, and picked up from where it stopped (FTP REST)
+    on the next attempt; it is renamed to out_filename once complete
+    """
+    if not resume:
+        part_filename = out_filename
+        offset = 0
+    else:
+        part_filename = out_filename + ".part"
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        if offset and hasher is not None:
+            # bring the hash up to date with what is already on disk
+            with open(part_filename, 'rb') as f:
+                for block in iter(lambda: f.read(md5_block_size), b''):
+                    hasher.update(block)
+        if offset:
+            log.info(f'Resuming {remote_fn} from byte {offset}')
+
+    n_bytes = 0
+    try:
+        with open(part_filename, 'ab' if offset else 'wb') as f:
+            def write(chunk):
+                nonlocal n_bytes
+                f.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                n_bytes += len(chunk)
+            ftp.retrbinary('RETR ' + remote_fn, write, rest=offset or None)
+    except Exception:
+        # Delete corrupted file (partial downloads are kept to resume)
+        if not resume and os.path.exists(out_filename):
+            os.remove(out_filename)
+        raise
+    if resume:
+        os.replace(part_filename, out_filename)
+    return n_bytes
+
+
+def download_md5s(gz_fns, updates=False, pool=None):
     """
     get the hashes from a list of PubMed gziped filenames
     """
     already_done = already_done_md5s(updates=updates)
-    ftp = get_ftp()
-    for i, gz_fn in enumerate(tqdm.tqdm(gz_fns, desc='md5 hashes downloaded from PubMed FTP server')):
-        if os.path.basename(gz_fn) + ".md5" in already_done:
-            # skip the already downloaded hashes
-            continue
-        if updates:
-            out_filename = os.path.join(config.PUBMED_LOCAL_DATA_PATH, 'updates', os.path.basename(gz_fn))
-        else:
-            out_filename = os.path.join(config.PUBMED_LOCAL_DATA_PATH, os.path.basename(gz_fn))
-        attempt = 0
-        while attempt <= max_retry_attempts:
-            try:
-                log.info(f'Downloading {out_filename+".md5"}... ')
-                with open(out_filename + ".md5", 'wb') as f:
-                    ftp.retrbinary('RETR ' + gz_fn + ".md5", f.write)
-                break
-            except Exception:
-                attempt += 1
-                log.info(f'Failed, retrying download ({attempt})...')
-                # Delete corrupted file
-                if os.path.exists(out_filename + ".md5"):
-                    os.remove(out_filename + ".md5")
+    todo = [gz_fn for gz_fn in gz_fns if os.path.basename(gz_fn) + ".md5" not in already_done]
 
+    def fetch(ftp, gz_fn):
+        out_filename = local_path(gz_fn, updates=updates)
+        log.info(f'Downloading {out_filename+".md5"}... ')
+        return retr_to_file(ftp, gz_fn + ".md5", out_filename + ".md5")
 
-def download_and_validate_gzs(gz_fns, updates=False):
+    own_pool = pool is None
+    if own_pool:
+        pool = get_ftp_pool()
+    try:
+        ftppool.download_all(pool, todo, fetch, max_retry_attempts=max_retry_attempts,
+                             retry_backoff=retry_backoff, desc='md5 hashes downloaded from PubMed FTP server')
+    finally:
+        if own_pool:
+            pool.close()
+
+
+def download_and_validate_gzs(gz_fns, updates=False, pool=None):
     """
     download datafiles, and validate
     if updates=True, saves to the updates local folder
+
+    several .gz/.md5 pairs are fetched at once over a pool of reused FTP
+    sessions (size set by ftp_workers in the config)
     """
     already_done = already_done_gzs(updates=updates)
+    todo = [gz_fn for gz_fn in gz_fns if os.path.basename(gz_fn) not in already_done]
+    verified = {}
+
+    def fetch(ftp, gz_fn):
+        out_filename = local_path(gz_fn, updates=updates)
+        log.info(f'Downloading {out_filename}...')
+        try:
+            # get the (small) hash first, so the data file is verified as it lands
+            n_bytes = retr_to_file(ftp, gz_fn + ".md5", out_filename + ".md5")
+            hasher = hashlib.md5()
+            n_bytes += retr_to_file(ftp, gz_fn, out_filename, hasher=hasher, resume=True)
+            log.info(f'Validating downloaded file {out_filename}')
+            if hasher.hexdigest() != read_md5_file(out_filename + ".md5"):
+                raise Exception("File {} doesn't match md5... possibly corrupted, suggest delete and redownload".format(out_filename))
+            verified[os.path.basename(gz_fn)] = hasher.hexdigest()
+        except ftplib.all_errors:
+            # interrupted transfer, leave any .part file to be resumed
+            raise
+        except Exception:
+            # Delete corrupted files
+            if os.path.exists(out_filename):
+                os.remove(out_filename)
+            if os.path.exists(out_filename + ".md5"):
+                os.remove(out_filename + ".md5")
+            raise
+        return n_bytes
+
+    own_pool = pool is None
+    if own_pool:
+        pool = get_ftp_pool()
+    try:
+        failed = ftppool.download_all(pool, todo, fetch, max_retry_attempts=max_retry_attempts,
+                                      retry_backoff=retry_backoff, desc='data files downloaded from PubMed FTP server')
+    finally:
+        if own_pool:
+            pool.close()
+        record_validated(verified, updates=updates)
+    if failed:
+        log.warning("{} files could not be downloaded: {}".format(len(failed), ", ".join(failed)))
+
+
+def manifest_fn(updates=False):
+    return local_path(manifest_basename, updates=updates)
+
+
+def load_manifest(updates=False):
+    """
+    filename -> {"size", "mtime", "md5"} for local files already validated
+    """
+    try:
+        with open(manifest_fn(updates=updates), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-    for i, gz_fn in enumerate(tqdm.tqdm(gz_fns, desc='data files downloaded from PubMed FTP server')):
-        if os.path.basename(gz_fn) in already_done:
-            # skip the already downloaded files
-            continue
 
-        if updates:
-            out_filename = os.path.join(config.PUBMED_LOCAL_DATA_PATH, 'updates', os.path.basename(gz_fn))
-        else:
-            out_filename = os.path.join(config.PUBMED_LOCAL_DATA_PATH, os.path.basename(gz_fn))
+def save_manifest(manifest, updates=False):
+    fn = manifest_fn(updates=updates)
+    with open(fn + ".tmp", 'w') as f:
+        json.dump(manifest, f)
+    os.replace(fn + ".tmp", fn)
 
-        ftp = get_ftp()
 
-        attempt = 0
-        while attempt <= max_retry_attempts:
-            try:
-                log.info(f'Downloading {out_filename}...')
-                with open(out_filename, 'wb') as f:
-                    ftp.retrbinary('RETR ' + gz_fn, f.write)
-                with open(out_filename + ".md5", 'wb') as f:
-                    ftp.retrbinary('RETR ' + gz_fn + ".md5", f.write)
-                log.info(f'Validating downloaded file {out_filename}')
-                validate_file(out_filename, out_filename + ".md5", raise_for_errors=True)
-                break
+def manifest_entry(fn_path, md5):
+    st = os.stat(fn_path)
+    return {"size": st.st_size, "mtime": st.st_mtime, "md5": md5}
+
 
-            except Exception:
-                attempt += 1
-                log.info(f'Failed, retrying download ({attempt})...')
-                # Delete corrupted files
-                if os.path.exists(out_filename):
-                    os.remove(out_filename)
-                if os.path.exists(out_filename + ".md5"):
-                    os.remove(out_filename + ".md5")
+def record_validated(md5s, updates=False):
+    """
+    add freshly verified files (filename -> md5) to the manifest
+    """
+    if not md5s:
+        return
+    manifest = load_manifest(updates=updates)
+    for fn, md5 in md5s.items():
+        manifest[fn] = manifest_entry(local_path(fn, updates=updates), md5)
+    save_manifest(manifest, updates=updates)
 
 
-def validate_downloaded_data(fns, updates=False):
-    for fn in tqdm.tqdm(fns, desc="Validating local files"):
-        if updates:
-            fn_path = os.path.join(config.PUBMED_LOCAL_DATA_PATH, 'updates', fn)
-        else:
-            fn_path = os.path.join(config.PUBMED_LOCAL_DATA_PATH, fn)
-        validate_file(fn_path, fn_path+".md5", raise_for_errors=True)
+def validate_downloaded_data(fns, updates=False, workers=None):
+    """
+    check local files against their .md5 hashes
+
+    files whose size, mtime and expected md5 match the manifest are skipped;
+    the rest are hashed across a process pool (workers defaults to the
+    number of cores) and added to the manifest
+    """
+    manifest = load_manifest(updates=updates)
+    todo = []
+    for fn in fns:
+        fn_path = local_path(fn, updates=updates)
+        st = os.stat(fn_path)
+        entry = manifest.get(fn)
+        if entry and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime and entry['md5'] == read_md5_file(fn_path + ".md5"):
+            continue
+        todo.append(fn)
+
+    log.info(f"{len(fns) - len(todo)} files unchanged since last validated, {len(todo)} to hash")
+    if not todo:
+        return True
+
+    fn_paths = [local_path(fn, updates=updates) for fn in todo]
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for fn, fn_path, obs_md5 in tqdm.tqdm(zip(todo, fn_paths, executor.map(file_md5, fn_paths)), total=len(todo), desc="Validating local files"):
+                if obs_md5 != read_md5_file(fn_path + ".md5"):
+                    raise Exception("File {} doesn't match md5... possibly corrupted, suggest delete and redownload".format(fn_path))
+                manifest[fn] = manifest_entry(fn_path, obs_md5)
+    finally:
+        save_manifest(manifest, updates=updates)
     return True
 
 
-def validate_file(fn, hash_fn, raise_for_errors=True):
+def read_md5_file(hash_fn):
+    with open(hash_fn, 'r') as f:
+        return (f.read()).rstrip().split("= ")[-1]
+
 
+def file_md5(fn, block_size=md5_block_size):
+    """
+    md5 of a local file, read in fixed size blocks
+    """
+    md5 = hashlib.md5()
     with open(fn, 'rb') as f:
-        bn = f.read()
-    obs_md5 = hashlib.md5(bn).hexdigest()
-    with open(hash_fn, 'r') as f:
-        true_md5 = (f.read()).rstrip().split("= ")[-1]
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def validate_file(fn, hash_fn, raise_for_errors=True):
+
+    obs_md5 = file_md5(fn)
+    true_md5 = read_md5_file(hash_fn)
     if obs_md5 != true_md5 and raise_for_errors:
         raise Exception("File {} doesn't match md5... possibly corrupted, suggest delete and redownload".format(fn))
     else:
         return obs_md5 == true_md5
 
 
-def iter_abstracts(fn, updates=False, skip_list=None):
+def iter_abstracts(fn, updates=False, skip_list=None, backend=None):
+    """
+    stream the records from a gzipped PubMed XML file, as LazyCitations
+
+    each record is detached from the tree as soon as it has been read, so
+    memory doesn't build up over the length of the file (only end events are
+    used, besides ElementTree's first start event, for the root)
+    backend = 'etree' or 'lxml' (defaults to xml_backend in the config)
+    """
     if skip_list is None:
         skip_list = set()
+    if backend is None:
+        backend = xml_backend
     with open(fn, 'rb') as f:
         decompressedFile = gzip.GzipFile(fileobj=f, mode='r')
-        for event, elem in ET.iterparse(decompressedFile, events=("start", "end")):
-            if elem.tag == "MedlineCitation" and event=="end":
+        root = None
+        if backend == 'lxml':
+            events = lxml_etree.iterparse(decompressedFile, events=("end",), tag=record_tags)
+        else:
+            events = ET.iterparse(decompressedFile, events=("start", "end"))
+        for event, elem in events:
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag == "MedlineCitation":
                 if elem.find('PMID').text in skip_list:
+                    elem.clear()
                     continue
-                p_article = pmreader.PubmedCorpusReader(xml_ET=elem)
+                # the full record is only built for those which get stored as RCTs
+                article = pmreader.LazyCitation(elem)
                 if not updates:
-                    yield p_article.to_dict()
+                    yield article
                 else:
-                    yield {"action": "update", "article": p_article.to_dict()}
-            if elem.tag == "DeleteCitation" and event=="end" and updates:
-                yield {"action": "delete_list", "pmids": [r.text for r in elem]}
+                    yield {"action": "update", "article": article}
+            elif elem.tag in ("PubmedArticle", "PubmedBookArticle"):
+                # drop the rest of the record (PubmedData etc) too
+                free_element(elem, root)
+            elif elem.tag == "DeleteCitation":
+                if updates:
+                    yield {"action": "delete_list", "pmids": [r.text for r in elem]}
+                free_element(elem, root)
+
+
+def free_element(elem, root=None):
+    """
+    empty a record, and drop it (and any before it) from the root
+    """
+    elem.clear()
+    if hasattr(elem, 'getprevious'):
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+    elif root is not None:
+        # ElementTree has no parent links, but the records are the root's
+        # children, and this one is the last
+        del root[:]
 
 
 def predict(X, tasks=None, filter_rcts="is_rct_sensitive"):
+    return rrclient.predict(X, tasks=tasks, filter_rcts=filter_rcts)
 
-    if tasks is None:
-        tasks = ['rct_bot']
-    base_url = config.ROBOTREVIEWER_URL
-    upload_data = {
-        "articles": X,
-        "robots": tasks,
-        "filter_rcts": filter_rcts
-    }
-    r = requests.post(base_url+'queue-documents', json=upload_data, headers={"api-key": trialstreamer.config.ROBOTREVIEWER_API_KEY})
-    response = r.json()
-    if 'report_id' not in response:
-        raise Exception(f'Invalid response for RobotReviewer API request: {response}')
-    report_id = response['report_id']
-    log.info(f'Queued documents with report ID: {report_id}')
 
-    def check_report(report_id):
-        r = requests.get(base_url +'report-status/'+report_id, headers={"api-key": trialstreamer.config.ROBOTREVIEWER_API_KEY})
-        return r.json()['state'] == 'SUCCESS'
+def clf_input(entry):
+    """
+    the RobotReviewer input for a PubMed entry
+    """
+    row = {"ti": entry['title'], "ab": entry['abstract_plaintext'], "ptyp": entry['ptyp']}
+    if entry['status'] == 'MEDLINE' and entry['indexing_method'] != 'Automated':
+        # https://www.nlm.nih.gov/pubs/techbull/ja18/ja18_indexing_method.html
+        # new addition
+        # we will use either fully manual, or manually corrected ('Curated') ptyps, but ignore any fully automated
+        pass
+    else:
+        row.pop('ptyp', None)
+    return row
+
 
-    while not check_report(report_id):
-        time.sleep(0.3)
+def get_clf_version():
+    """
+    the version of the classifications: a hash of the thresholds file and of
+    what RobotReviewer makes of clf_probe (the model files themselves are on
+    the RobotReviewer server), so cached classifications are only reused for
+    the same model and thresholds. worked out once per process
+    """
+    global _clf_version
+    with _clf_version_lock:
+        if _clf_version is None:
+            with open(os.path.join(trialstreamer.DATA_ROOT, 'rct_model_calibration.json'), 'rb') as f:
+                h = hashlib.sha1(f.read())
+            pred = predict([clf_probe], tasks=['rct_bot', 'human_bot'], filter_rcts='none')[0]
+            # rounded, so that the last digits of a GPU's arithmetic don't count
+            fingerprint = {"model": pred['rct_bot']['model'], "is_human": pred['human_bot']['is_human'],
+                           "preds": {k: round(v, 3) for k, v in pred['rct_bot']['preds'].items()}}
+            h.update(json.dumps(fingerprint, sort_keys=True).encode('utf-8'))
+            _clf_version = h.hexdigest()[:16]
+            log.info("classification version {}".format(_clf_version))
+        return _clf_version
+
+
+def clf_cache_key(row, indexing_method, version):
+    """
+    hash of everything the classification depends on: the text, the ptyps
+    used (if any), the indexing method, and the model/threshold version
+    """
+    key = json.dumps([row['ti'], row['ab'], row.get('ptyp'), indexing_method, version], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def load_cached_clfs(keys, db=None):
+    """
+    cached classify() output for the content hashes in keys
+    db = the connection to read from (defaults to dbutil.db)
+    """
+    if not keys:
+        return {}
+    if db is None:
+        db = dbutil.db
+    cur = db.cursor()
+    cur.execute("SELECT content_hash, clf, clf_date FROM pubmed_clf_cache WHERE content_hash = ANY(%s);", (list(keys),))
+    cached = {}
+    for content_hash, clf, clf_date in cur.fetchall():
+        clf['clf_date'] = clf_date
+        cached[content_hash] = clf
+    cur.close()
+    return cached
 
-    report = requests.get(base_url +'report/'+report_id, headers={"api-key": trialstreamer.config.ROBOTREVIEWER_API_KEY}).json()
-    return report
 
+def classify(entry_batch, use_cache=None, db=None):
+    """
+    RobotReviewer predictions for a batch of PubMed entries
 
-def classify(entry_batch):
+    with use_cache, entries whose content hash (see clf_cache_key) has been
+    classified before reuse the stored prediction (looked up on db, see
+    load_cached_clfs); each output row has 'content_hash' (None without
+    use_cache) and 'clf_cached' keys so that new predictions can be saved
+    afterwards (see clf_cache_rows)
+    """
 
     global clf_cutoffs
 
+    if use_cache is None:
+        use_cache = clf_cache_enabled
+
     thresholds_ptyp = clf_cutoffs['thresholds']['svm_cnn_ptyp']
     thresholds_no_ptyp = clf_cutoffs['thresholds']['svm_cnn']
 
     threshold_types = ["precise", "balanced", "sensitive"]
 
 
-    X = []
+    X = [clf_input(entry) for entry in entry_batch]
+    version = get_clf_version() if use_cache else None
+    keys = [clf_cache_key(row, entry['indexing_method'], version) for row, entry in zip(X, entry_batch)]
 
-    for entry in entry_batch:
-        row = {"ti": entry['title'], "ab": entry['abstract_plaintext'], "ptyp": entry['ptyp']}
-        if entry['status'] == 'MEDLINE' and entry['indexing_method'] != 'Automated':
-            # https://www.nlm.nih.gov/pubs/techbull/ja18/ja18_indexing_method.html
-            # new addition
-            # we will use either fully manual, or manually corrected ('Curated') ptyps, but ignore any fully automated
-            pass
-        else:
-            row.pop('ptyp', None)
-        X.append(row)
+    cached = load_cached_clfs(set(keys), db=db) if use_cache else {}
 
-    preds = predict(X, tasks=['rct_bot', 'human_bot'], filter_rcts='none')
+    # only send each uncached text once
+    todo = collections.OrderedDict()
+    for key, row in zip(keys, X):
+        if key not in cached:
+            todo.setdefault(key, row)
+
+    preds = predict(list(todo.values()), tasks=['rct_bot', 'human_bot'], filter_rcts='none') if todo else []
     # prepare data out
 
-    out = []
+    new = {}
 
-    for pred in preds:
+    for key, pred in zip(todo, preds):
 
         row = {"clf_type": pred["rct_bot"]["model"], "clf_score": pred["rct_bot"]['score'], "clf_date": datetime.datetime.now(), "ptyp_rct": pred["rct_bot"]['ptyp_rct'],
         "score_cnn": pred["rct_bot"]["preds"]["cnn"], "score_svm": pred["rct_bot"]["preds"]["svm"], "score_svm_cnn": pred["rct_bot"]["preds"]["svm_cnn"], "score_svm_ptyp": pred["rct_bot"]["preds"]["svm_ptyp"],
@@ -385,10 +670,47 @@ def classify(entry_batch):
         elif pred["rct_bot"]["model"] == "svm_cnn":
             for tt in threshold_types:
                 row['is_rct_{}'.format(tt)] = (pred["rct_bot"]['score'] >= thresholds_no_ptyp[tt])
+        new[key] = row
+
+    out = []
+    for key in keys:
+        if key in cached:
+            row = dict(cached[key], content_hash=key, clf_cached=True)
+        else:
+            row = dict(new[key], content_hash=key if use_cache else None, clf_cached=False)
         out.append(row)
     return out
 
 
+def clf_cache_rows(preds):
+    """
+    (content_hash, clf, clf_date, clf_version) rows for the predictions not
+    yet cached
+    """
+    rows = {}
+    for pred in preds:
+        if pred.get('clf_cached', True) or pred['content_hash'] is None or pred['content_hash'] in rows:
+            continue
+        clf = {k: v for k, v in pred.items() if k not in ('content_hash', 'clf_cached', 'clf_date')}
+        rows[pred['content_hash']] = (pred['content_hash'], json.dumps(clf), pred['clf_date'], get_clf_version())
+    return list(rows.values())
+
+
+def prune_clf_cache():
+    """
+    drop the cached classifications of other models or thresholds, which
+    can't be used again (written as clf_version < or > the current one, so
+    that the index on clf_version is used)
+    """
+    version = get_clf_version()
+    cur = dbutil.db.cursor()
+    cur.execute("DELETE FROM pubmed_clf_cache WHERE clf_version < %s OR clf_version > %s OR clf_version IS NULL;", (version, version))
+    if cur.rowcount:
+        log.info("dropped {} cached classifications from earlier models".format(cur.rowcount))
+    cur.close()
+    dbutil.db.commit()
+
+
 def grouper(iterable, n, fillvalue=None):
     "Collect data into fixed-length chunks or blocks - from itertools recipes adapted a bit"
     # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx"
@@ -404,37 +726,209 @@ def get_date_from_fn(ftp_fn):
     return datetime.datetime(int("20" + bn[6:8])-1, 12, 31)
 
 
-def upload_to_postgres(ftp_fns, safety_test_parse, batch_size=5000, force_update=False, updates=False, modtimes=None):
+class PMIDSet():
+    """
+    compact read-only set of PMIDs: a sorted numpy int64 array (8 bytes per
+    PMID, against ~60 for a python str in a set), with membership by binary
+    search. PMIDs which aren't plain integers are kept in a small python set
+    """
+
+    def __init__(self, pmids=()):
+        ints = []
+        self.other = set()
+        for pmid in pmids:
+            try:
+                ints.append(int(pmid))
+            except (TypeError, ValueError):
+                self.other.add(pmid)
+        self.pmids = np.unique(np.array(ints, dtype=np.int64))
+
+    @classmethod
+    def from_arrays(cls, arrays, other=()):
+        pmid_set = cls()
+        if arrays:
+            pmid_set.pmids = np.unique(np.concatenate(arrays))
+        pmid_set.other = set(other)
+        return pmid_set
+
+    def __contains__(self, pmid):
+        try:
+            pmid_int = int(pmid)
+        except (TypeError, ValueError):
+            return pmid in self.other
+        i = np.searchsorted(self.pmids, pmid_int)
+        return i < len(self.pmids) and self.pmids[i] == pmid_int
+
+    def __len__(self):
+        return len(self.pmids) + len(self.other)
+
+
+def load_done_pmids(chunk_size=1000000):
+    """
+    the PMIDs already in pubmed or pubmed_excludes, as a PMIDSet, streamed
+    from a server side cursor so that only one chunk of strings is held at once
+    """
+    arrays = []
+    other = set()
+    cur = dbutil.db.cursor(name='done_pmids')
+    cur.itersize = chunk_size
+    cur.execute("SELECT pmid FROM pubmed UNION ALL SELECT pmid FROM pubmed_excludes;")
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        ints = []
+        for (pmid, ) in rows:
+            if pmid is not None and pmid.isdigit():
+                ints.append(int(pmid))
+            elif pmid is not None:
+                other.add(pmid)
+        arrays.append(np.array(ints, dtype=np.int64))
+    cur.close()
+    dbutil.db.commit()
+    return PMIDSet.from_arrays(arrays, other)
+
+
+_worker_skip_list = None
+_worker_queues = None
+
+
+def _init_parse_worker(skip_list, queues):
+    global _worker_skip_list, _worker_queues
+    _worker_skip_list = skip_list
+    _worker_queues = queues
+
+
+def parse_file_to_queue(local_fn, updates, slot, batch_size):
+    """
+    parse a file in a pool worker, sending its records back through queue
+    `slot` in lists of batch_size, then None (see ParsePool)
+    """
+    q = _worker_queues[slot]
+    try:
+        for batch in grouper(iter_abstracts(local_fn, updates=updates, skip_list=_worker_skip_list), batch_size):
+            q.put([entry for entry in batch if entry is not None])
+    except Exception as e:
+        q.put(e)
+        raise
+    q.put(None)
+
+
+class ParsePool():
+    """
+    processes parsing PubMed files, each streaming the records of its file
+    back in batches through its own bounded queue, so that at most
+    workers * (maxsize + 1) batches are held at once rather than whole files
+
+    make it before starting any threads (e.g. the upload pipeline), as the
+    workers are forked from this process
+    """
+
+    def __init__(self, workers, skip_list=None, batch_size=1000, maxsize=2):
+        self.workers = workers
+        self.batch_size = batch_size
+        self.queues = [multiprocessing.Queue(maxsize=maxsize) for _ in range(workers)]
+        self.pool = multiprocessing.Pool(workers, initializer=_init_parse_worker, initargs=(skip_list, self.queues))
+
+    def _iter_slot(self, slot, result):
+        while True:
+            batch = self.queues[slot].get()
+            if batch is None:
+                break
+            if isinstance(batch, Exception):
+                result.get()
+                raise batch
+            yield from batch
+        result.get()
+
+    def iter_files(self, local_fns, updates=False):
+        """
+        yields an iterator over the entries of each file in local_fns, in
+        order, with up to `workers` files parsing ahead; each one is read to
+        the end (or drained) before the next is yielded
+        """
+        local_fns = iter(local_fns)
+        pending = collections.deque()
+        free_slots = collections.deque(range(self.workers))
+
+        def submit():
+            for local_fn in itertools.islice(local_fns, 1):
+                slot = free_slots.popleft()
+                pending.append((slot, self.pool.apply_async(parse_file_to_queue, (local_fn, updates, slot, self.batch_size))))
+
+        for _ in range(self.workers):
+            submit()
+        while pending:
+            slot, result = pending.popleft()
+            entries = self._iter_slot(slot, result)
+            yield entries
+            # the worker can't finish (and free the slot) until its queue is read
+            for _ in entries:
+                pass
+            free_slots.append(slot)
+            submit()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+def iter_parsed_files(local_fns, updates=False, skip_list=None, pool=None):
+    """
+    yields the parsed entries of each file in local_fns, in order
+
+    with a ParsePool, the files are parsed in its processes (the pool's
+    skip_list applies); otherwise lazily, here
+    """
+    if pool is not None:
+        yield from pool.iter_files(local_fns, updates=updates)
+        return
+    for local_fn in local_fns:
+        yield iter_abstracts(local_fn, updates=updates, skip_list=skip_list)
+
+
+def upload_to_postgres(ftp_fns, safety_test_parse, batch_size=5000, force_update=False, updates=False, modtimes=None, workers=1):
     """
     ftp_fns = the filenames to parse (converted to local fns here)
-    safety_test_parse = recommended, try and read all the abstracts before deleting the existing data
+    safety_test_parse = recommended, don't change the existing data unless all the files parse. with
+        bulk_copy this is done in one pass: everything is staged, and merged in a single transaction
+        at the end (see merge_staged); otherwise the files are all test parsed first
     batch_size = how many to do at once (often lower = fatster)
     force_update = whether to delete the database
+    workers = number of processes parsing files in parallel
     """
 
     num_files = len(ftp_fns)
 
-    if safety_test_parse:
+    # stage every file, and only merge once they have all parsed
+    single_pass = safety_test_parse and bulk_copy
+
+    if safety_test_parse and not single_pass:
         log.info("Testing parse before inserting into database")
-        for idx, ftp_fn in enumerate(ftp_fns):
-            if updates:
-                local_fn = os.path.join(config.PUBMED_LOCAL_DATA_PATH, 'updates', os.path.basename(ftp_fn))
-            else:
-                local_fn = os.path.join(config.PUBMED_LOCAL_DATA_PATH, os.path.basename(ftp_fn))
-            for entry in tqdm.tqdm(iter_abstracts(local_fn, updates=updates), desc="testing the abstract parsing ({}/{}) {}".format(idx, num_files, local_fn)):
-                if updates:
-                    if entry['action'] == 'update':
-                        _ = (entry['article']['pmid'], entry['article']['year'], entry['article']['title'], entry['article']['abstract_plaintext'], json.dumps(entry['article']), ftp_fn)
-                    elif entry['action'] == 'delete_list':
-                        _ = entry['pmids']
-                else:
-                    _ = (entry['pmid'], entry['year'], entry['title'], entry['abstract_plaintext'], json.dumps(entry), ftp_fn)
+        local_fns = [local_path(ftp_fn, updates=updates) for ftp_fn in ftp_fns]
+        test_pool = ParsePool(workers) if workers > 1 else None
+        try:
+            for idx, (ftp_fn, local_fn, entries) in enumerate(zip(ftp_fns, local_fns, iter_parsed_files(local_fns, updates=updates, pool=test_pool))):
+                for entry in tqdm.tqdm(entries, desc="testing the abstract parsing ({}/{}) {}".format(idx, num_files, local_fn)):
+                    if updates:
+                        if entry['action'] == 'update':
+                            _ = (entry['article']['pmid'], entry['article']['year'], entry['article']['title'], entry['article']['abstract_plaintext'], json.dumps(entry['article'].full()), ftp_fn)
+                        elif entry['action'] == 'delete_list':
+                            _ = entry['pmids']
+                    else:
+                        _ = (entry['pmid'], entry['year'], entry['title'], entry['abstract_plaintext'], json.dumps(entry.full()), ftp_fn)
+        finally:
+            if test_pool is not None:
+                test_pool.close()
 
 
 
     # if safety mode only delete existing database where the parse has completed without exception
     if updates==False:
-        if force_update:
+        if force_update and single_pass:
+            log.warning("All entries in the PubMed database will be replaced once the files have parsed")
+            already_done_pmids = set()
+        elif force_update:
             log.warning("Deleting all entries from PubMed database")
             cur = dbutil. db.cursor()
             cur.execute("DELETE FROM pubmed;")
@@ -444,11 +938,7 @@ def upload_to_postgres(ftp_fns, safety_test_parse, batch_size=5000, force_update
             # dangerous command....
         else:
             # get already done PMIDs
-            cur = dbutil.db.cursor(cursor_factory=psycopg2.extras.DictCursor)
-            cur.execute("SELECT pmid FROM pubmed;")
-            already_done_pmids = set((r['pmid'] for r in cur.fetchall()))
-            cur.execute("SELECT pmid FROM pubmed_excludes;")
-            already_done_pmids.update((r['pmid'] for r in cur.fetchall()))
+            already_done_pmids = load_done_pmids()
             log.warning("will skip {} already done... rerun with 'force_update=True' to reclassify all".format(len(already_done_pmids)))
     else:
         already_done_pmids = set()
@@ -460,97 +950,358 @@ def upload_to_postgres(ftp_fns, safety_test_parse, batch_size=5000, force_update
     if updates:
         logged_completed_fns = already_done_updates()
 
-    for idx, ftp_fn in enumerate(ftp_fns):
+    todo = [(idx, ftp_fn) for idx, ftp_fn in enumerate(ftp_fns)
+            if not updates or os.path.basename(ftp_fn) not in logged_completed_fns]
+    local_fns = [local_path(ftp_fn, updates=updates) for _, ftp_fn in todo]
+    # the parse processes are forked here, before the pipeline starts its threads
+    parse_pool = ParsePool(workers, skip_list=already_done_pmids) if workers > 1 else None
+    parsed_files = iter_parsed_files(local_fns, updates=updates, skip_list=already_done_pmids, pool=parse_pool)
+
+    checkpoints = {}
+    if bulk_copy:
+        checkpoints = load_checkpoints()
+        todo_bns = set(os.path.basename(ftp_fn) for _, ftp_fn in todo)
+        if checkpoints and (not set(checkpoints) <= todo_bns or (force_update and not single_pass)):
+            log.warning("discarding checkpoints from a different run: {}".format(", ".join(sorted(checkpoints))))
+            checkpoints = {}
+        if not checkpoints:
+            clear_staging()
+
+    def iter_batches():
+        for (idx, ftp_fn), local_fn, entries in zip(todo, local_fns, parsed_files):
+            log.info("parsing ({}/{}) {}".format(idx, num_files, local_fn))
+            checkpoint = checkpoints.get(os.path.basename(ftp_fn))
+            record_offset = 0
+            if checkpoint and checkpoint['complete']:
+                log.info("{} already staged, skipping".format(local_fn))
+                yield {"ftp_fn": ftp_fn, "end_of_file": True}
+                continue
+            elif checkpoint:
+                entries = resume_entries(entries, checkpoint)
+                if entries is None:
+                    yield {"restart": True}
+                    return
+                record_offset = checkpoint['record_offset']
+                log.info("resuming {} after record {} (PMID {})".format(local_fn, record_offset, checkpoint['last_pmid']))
+            for entry_batch in grouper(entries, batch_size):
+                record_offset += len(entry_batch)
+                last_pmid = entry_pmid(entry_batch[-1])
+                entry_batch, pmids_to_delete = prepare_batch(entry_batch, updates=updates)
+                yield {"ftp_fn": ftp_fn, "entries": entry_batch, "pmids_to_delete": pmids_to_delete,
+                       "record_offset": record_offset, "last_pmid": last_pmid}
+            yield {"ftp_fn": ftp_fn, "end_of_file": True}
+
+    # the classify thread reads the cache on a connection of its own, as
+    # dbutil.db has the writes' transaction open in this thread
+    clf_cache_db = None
+    if clf_cache_enabled:
+        clf_cache_db = dbutil.connect()
+        clf_cache_db.set_session(readonly=True, autocommit=True)
+
+    # parse, RobotReviewer and postgres run in their own threads; the writes
+    # (and update_log) happen here, in file and batch order
+    pipeline = Pipeline(iter_batches(), [("classify", functools.partial(classify_batch, db=clf_cache_db))], source_name="parse", maxsize=pipeline_queue_size)
+    pbar = tqdm.tqdm(desc="classifying and uploading postgres (batches)")
+
+    completed_fns = []
+    restart = False
+
+    try:
+        for item in pipeline:
+
+            if item.get("restart"):
+                restart = True
+                break
+
+            if item.get("end_of_file"):
+                if single_pass:
+                    # staging tables only; nothing visible changes until the end
+                    save_checkpoint(item['ftp_fn'], complete=True)
+                    completed_fns.append(item['ftp_fn'])
+                else:
+                    if bulk_copy:
+                        merge_staged()
+                    if updates:
+                        dbutil.log_update(update_type='pubmed_update', source_filename=os.path.basename(item['ftp_fn']), source_date=modtimes[os.path.basename(item['ftp_fn'])], download_date=datetime.datetime.now())
+                log.info("{} done; queue depths {}, stage busy times {}".format(item['ftp_fn'], pipeline.depths(), {k: round(v, 1) for k, v in pipeline.timings().items()}))
+                continue
 
+            stats["batches classified"] += 1
+            preds = item.get('preds', [])
+            stats["classification cache hits"] += sum(1 for pred in preds if pred['clf_cached'])
+            stats["classification cache misses"] += sum(1 for pred in preds if not pred['clf_cached'])
+            include_rows, exclude_rows = make_rows(item['entries'], preds, item['ftp_fn'])
+            if bulk_copy:
+                stage_rows(include_rows, exclude_rows, item['pmids_to_delete'], cache_rows=clf_cache_rows(preds))
+                save_checkpoint(item['ftp_fn'], item['record_offset'], item['last_pmid'])
+            else:
+                write_rows(include_rows, exclude_rows, item['pmids_to_delete'], cache_rows=clf_cache_rows(preds))
+            pbar.update(1)
+            pbar.set_postfix(pipeline.depths())
+    finally:
+        # an exception here leaves the pipeline's generator suspended, so
+        # its threads have to be stopped explicitly (before the parse
+        # processes they read from go)
+        pipeline.close()
+        if parse_pool is not None:
+            parse_pool.close()
+        if clf_cache_db is not None:
+            clf_cache_db.close()
+
+    pbar.close()
+
+    if restart:
+        # a file changed since it was staged, so what was staged from it
+        # (and, in a single pass, from the files before it) can't be trusted
+        log.warning("discarding the staged rows and checkpoints, and starting again")
+        clear_staging()
+        return upload_to_postgres(ftp_fns, safety_test_parse, batch_size=batch_size, force_update=force_update,
+                                  updates=updates, modtimes=modtimes, workers=workers)
+
+    if single_pass:
+        log.info("All files parsed; merging into the database")
+        merge_staged(delete_all=force_update and not updates)
         if updates:
-            bn = os.path.basename(ftp_fn)
-            if bn in logged_completed_fns:
-                continue
-            local_fn = os.path.join(config.PUBMED_LOCAL_DATA_PATH, 'updates', bn)
+            for ftp_fn in completed_fns:
+                dbutil.log_update(update_type='pubmed_update', source_filename=os.path.basename(ftp_fn), source_date=modtimes[os.path.basename(ftp_fn)], download_date=datetime.datetime.now())
+
+    log.info(str(stats))
+    n_classified = stats["classification cache hits"] + stats["classification cache misses"]
+    if n_classified:
+        log.info("classification cache: {} hits, {} misses ({:.1%} hit rate)".format(
+            stats["classification cache hits"], stats["classification cache misses"], stats["classification cache hits"] / n_classified))
+    dbutil.db.commit()
+    if clf_cache_enabled:
+        prune_clf_cache()
+    if len(stats) == 0:
+        log.info("There are no new Pubmed updates for now.")
+
+
+def prepare_batch(entry_batch, updates=False):
+    """
+    split out any deletions, and remove duplicate PMIDs (keeping the later entry)
+    """
+    pmids_to_delete = []
+
+    if updates:
+
+        for r in entry_batch:
+            if r['action']=='delete_list':
+                pmids_to_delete.extend(r['pmids'])
+
+        entry_batch = [r['article'] for r in entry_batch if r['action']=='update']
+
+    # reverse the list and
+    # remove any duplicates
+    # (so that the later entries are added only)
+    dedupe = []
+    enc = set()
+
+    while entry_batch:
+        r = entry_batch.pop()
+        if r['pmid'] not in enc:
+            dedupe.append(r)
+            enc.add(r['pmid'])
+
+    return dedupe, pmids_to_delete
+
+
+def classify_batch(item, db=None):
+    """
+    pipeline stage: add RobotReviewer predictions to a batch
+    db = the connection for the cache lookups
+    """
+    if item.get('entries'):
+        item['preds'] = classify(item['entries'], db=db)
+    return item
+
+
+def make_rows(entry_batch, preds, ftp_fn):
+    include_rows = []
+    exclude_rows = []
+
+    for entry, pred in zip(entry_batch, preds):
+
+        year = int(entry['year']) if entry['year'] else None
+
+        # need to ignore entries without PMIDs
+        if not entry['pmid']:
+            continue
+        timestamp = datetime.datetime.now()
+        if pred['is_rct_sensitive']:
+            row = (entry['pmid'], entry['status'], year, entry['title'], entry['abstract_plaintext'],
+                json.dumps(entry.full()), ftp_fn, pred['clf_type'], pred['clf_score'], pred['clf_date'], pred['ptyp_rct'], pred['is_rct_precise'],
+                pred['is_rct_balanced'], pred['is_rct_sensitive'], entry['indexing_method'], pred['score_svm'], pred['score_cnn'], pred['score_svm_cnn'],
+                pred['score_svm_ptyp'], pred['score_cnn_ptyp'], pred['score_svm_cnn_ptyp'], pred['rct_probability'], pred['is_human'], timestamp)
+
+            include_rows.append(row)
         else:
-            local_fn = os.path.join(config.PUBMED_LOCAL_DATA_PATH, os.path.basename(ftp_fn))
 
+            row = (entry['pmid'], entry['status'], year,
+                ftp_fn, pred['clf_type'], pred['clf_score'], pred['clf_date'], pred['ptyp_rct'], pred['is_rct_precise'],
+                pred['is_rct_balanced'], pred['is_rct_sensitive'], entry['indexing_method'], pred['score_svm'], pred['score_cnn'], pred['score_svm_cnn'],
+                pred['score_svm_ptyp'], pred['score_cnn_ptyp'], pred['score_svm_cnn_ptyp'], pred['rct_probability'], pred['is_human'], timestamp)
+            exclude_rows.append(row)
 
-        for entry_batch in tqdm.tqdm(grouper(iter_abstracts(local_fn, updates=updates, skip_list=already_done_pmids), batch_size), desc="classifying and uploading postgres ({}/{}) {}".format(idx, num_files, local_fn)):
+    return include_rows, exclude_rows
 
-            include_rows = []
-            exclude_rows = []
 
+# everything keyed on PMID which should go when PubMed deletes a citation
+pmid_tables = ("pubmed", "pubmed_excludes", "pubmed_annotations", "registry_links", "upw", "pmid_dois")
 
-            stats["batches classified"] += 1
 
+def delete_pmids(cur, pmids, tables=pmid_tables):
+    """
+    remove deleted citations, with one statement per table for the whole list
+    """
+    pmids = list(set(pmids))
+    if not pmids:
+        return
+    deleted = {}
+    for table in tables:
+        cur.execute("DELETE FROM {} WHERE pmid = ANY(%s);".format(table), (pmids,))
+        if cur.rowcount:
+            deleted[table] = cur.rowcount
+    if deleted:
+        log.info("deleting {} PMIDs removed rows from {}".format(len(pmids), deleted))
 
-            if updates:
 
-                pmids_to_delete = []
-                for r in entry_batch:
-                    if r['action']=='delete_list':
-                        pmids_to_delete.extend(r['pmids'])
+def write_rows(include_rows, exclude_rows, pmids_to_delete, cache_rows=()):
+    cur = dbutil. db.cursor()
+    delete_pmids(cur, pmids_to_delete)
 
-                entry_batch = [r['article'] for r in entry_batch if r['action']=='update']
+    execute_values(cur, "INSERT INTO pubmed (pmid, pm_status, year, ti, ab, pm_data, source_filename, clf_type, clf_score, clf_date, ptyp_rct, is_rct_precise, is_rct_balanced, is_rct_sensitive, indexing_method, score_svm, score_cnn, score_svm_cnn, score_svm_ptyp, score_cnn_ptyp, score_svm_cnn_ptyp, rct_probability, is_human, update_date) VALUES %s ON CONFLICT (pmid) DO UPDATE SET year=EXCLUDED.year, ti=EXCLUDED.ti, ab=EXCLUDED.ab, pm_data=EXCLUDED.pm_data, source_filename=EXCLUDED.source_filename, clf_type=EXCLUDED.clf_type, clf_score=EXCLUDED.clf_score, clf_date=EXCLUDED.clf_date, ptyp_rct=EXCLUDED.ptyp_rct, is_rct_precise=EXCLUDED.is_rct_precise, is_rct_balanced=EXCLUDED.is_rct_balanced, is_rct_sensitive=EXCLUDED.is_rct_sensitive, indexing_method=EXCLUDED.indexing_method, rct_probability=EXCLUDED.rct_probability, is_human=EXCLUDED.is_human, update_date=EXCLUDED.update_date;", include_rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
 
-            # reverse the list and
-            # remove any duplicates
-            # (so that the later entries are added only)
-            dedupe = []
-            enc = set()
+    execute_values(cur, "INSERT INTO pubmed_excludes (pmid, pm_status, year, source_filename, clf_type, clf_score, clf_date, ptyp_rct, is_rct_precise, is_rct_balanced, is_rct_sensitive, indexing_method, score_svm, score_cnn, score_svm_cnn, score_svm_ptyp, score_cnn_ptyp, score_svm_cnn_ptyp, rct_probability, is_human, update_date) VALUES %s ON CONFLICT (pmid) DO UPDATE SET year=EXCLUDED.year, source_filename=EXCLUDED.source_filename, clf_type=EXCLUDED.clf_type, clf_score=EXCLUDED.clf_score, clf_date=EXCLUDED.clf_date, ptyp_rct=EXCLUDED.ptyp_rct, is_rct_precise=EXCLUDED.is_rct_precise, is_rct_balanced=EXCLUDED.is_rct_balanced, is_rct_sensitive=EXCLUDED.is_rct_sensitive, indexing_method=EXCLUDED.indexing_method, rct_probability=EXCLUDED.rct_probability, is_human=EXCLUDED.is_human, update_date=EXCLUDED.update_date;", exclude_rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
 
-            while entry_batch:
-                r = entry_batch.pop()
-                if r['pmid'] not in enc:
-                    dedupe.append(r)
-                    enc.add(r['pmid'])
+    if cache_rows:
+        execute_values(cur, "INSERT INTO pubmed_clf_cache (content_hash, clf, clf_date, clf_version) VALUES %s ON CONFLICT (content_hash) DO UPDATE SET clf=EXCLUDED.clf, clf_date=EXCLUDED.clf_date, clf_version=EXCLUDED.clf_version;", cache_rows)
 
-            entry_batch, dedupe = dedupe, entry_batch
-            if len(entry_batch) == 0:
-                continue
+    cur.close()
+    dbutil.db.commit()
 
-            preds = classify(entry_batch)
 
-            for entry, pred in zip(entry_batch, preds):
+pubmed_columns = ("pmid", "pm_status", "year", "ti", "ab", "pm_data", "source_filename", "clf_type", "clf_score", "clf_date", "ptyp_rct",
+                  "is_rct_precise", "is_rct_balanced", "is_rct_sensitive", "indexing_method", "score_svm", "score_cnn", "score_svm_cnn",
+                  "score_svm_ptyp", "score_cnn_ptyp", "score_svm_cnn_ptyp", "rct_probability", "is_human", "update_date")
+pubmed_excludes_columns = tuple(c for c in pubmed_columns if c not in ("ti", "ab", "pm_data"))
+# columns refreshed when a PMID is already in the table (as in write_rows)
+upsert_columns = ("year", "ti", "ab", "pm_data", "source_filename", "clf_type", "clf_score", "clf_date", "ptyp_rct", "is_rct_precise",
+                  "is_rct_balanced", "is_rct_sensitive", "indexing_method", "rct_probability", "is_human", "update_date")
 
-                year = int(entry['year']) if entry['year'] else None
 
-                # need to ignore entries without PMIDs
-                if not entry['pmid']:
-                    continue
-                timestamp = datetime.datetime.now()
-                if pred['is_rct_sensitive']:
-                    row = (entry['pmid'], entry['status'], year, entry['title'], entry['abstract_plaintext'],
-                        json.dumps(entry), ftp_fn, pred['clf_type'], pred['clf_score'], pred['clf_date'], pred['ptyp_rct'], pred['is_rct_precise'],
-                        pred['is_rct_balanced'], pred['is_rct_sensitive'], entry['indexing_method'], pred['score_svm'], pred['score_cnn'], pred['score_svm_cnn'],
-                        pred['score_svm_ptyp'], pred['score_cnn_ptyp'], pred['score_svm_cnn_ptyp'], pred['rct_probability'], pred['is_human'], timestamp)
-
-                    include_rows.append(row)
-                else:
+def clear_staging():
+    cur = dbutil.db.cursor()
+    cur.execute("TRUNCATE pubmed_staging, pubmed_excludes_staging, pubmed_deletes_staging, ingest_checkpoints;")
+    cur.close()
+    dbutil.db.commit()
 
-                    row = (entry['pmid'], entry['status'], year,
-                        ftp_fn, pred['clf_type'], pred['clf_score'], pred['clf_date'], pred['ptyp_rct'], pred['is_rct_precise'],
-                        pred['is_rct_balanced'], pred['is_rct_sensitive'], entry['indexing_method'], pred['score_svm'], pred['score_cnn'], pred['score_svm_cnn'],
-                        pred['score_svm_ptyp'], pred['score_cnn_ptyp'], pred['score_svm_cnn_ptyp'], pred['rct_probability'], pred['is_human'], timestamp)
-                    exclude_rows.append(row)
 
-            cur = dbutil. db.cursor()
-            if updates:
-                for pm in pmids_to_delete:
-                    cur.execute("DELETE FROM pubmed WHERE pmid=(%s);", (pm,))
-                    cur.execute("DELETE FROM pubmed_excludes WHERE pmid=(%s);", (pm,))
-                    cur.execute("DELETE FROM pubmed_annotations WHERE pmid=(%s);", (pm, ))
+def load_checkpoints():
+    """
+    checkpoints of files partly (or, in safety mode, wholly) staged by an
+    earlier run which didn't finish, by file basename
+    """
+    cur = dbutil.db.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute("SELECT source_filename, record_offset, last_pmid, complete FROM ingest_checkpoints;")
+    checkpoints = {r['source_filename']: dict(r) for r in cur.fetchall()}
+    cur.close()
+    return checkpoints
 
-            execute_values(cur, "INSERT INTO pubmed (pmid, pm_status, year, ti, ab, pm_data, source_filename, clf_type, clf_score, clf_date, ptyp_rct, is_rct_precise, is_rct_balanced, is_rct_sensitive, indexing_method, score_svm, score_cnn, score_svm_cnn, score_svm_ptyp, score_cnn_ptyp, score_svm_cnn_ptyp, rct_probability, is_human, update_date) VALUES %s ON CONFLICT (pmid) DO UPDATE SET year=EXCLUDED.year, ti=EXCLUDED.ti, ab=EXCLUDED.ab, pm_data=EXCLUDED.pm_data, source_filename=EXCLUDED.source_filename, clf_type=EXCLUDED.clf_type, clf_score=EXCLUDED.clf_score, clf_date=EXCLUDED.clf_date, ptyp_rct=EXCLUDED.ptyp_rct, is_rct_precise=EXCLUDED.is_rct_precise, is_rct_balanced=EXCLUDED.is_rct_balanced, is_rct_sensitive=EXCLUDED.is_rct_sensitive, indexing_method=EXCLUDED.indexing_method, rct_probability=EXCLUDED.rct_probability, is_human=EXCLUDED.is_human, update_date=EXCLUDED.update_date;", include_rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
 
+def save_checkpoint(ftp_fn, record_offset=None, last_pmid=None, complete=False):
+    """
+    record how far through a file has been staged, and commit it together
+    with the staged batch
+    """
+    cur = dbutil.db.cursor()
+    cur.execute("INSERT INTO ingest_checkpoints (source_filename, record_offset, last_pmid, complete, update_date) VALUES (%s, %s, %s, %s, %s) "
+                "ON CONFLICT (source_filename) DO UPDATE SET record_offset=COALESCE(EXCLUDED.record_offset, ingest_checkpoints.record_offset), "
+                "last_pmid=COALESCE(EXCLUDED.last_pmid, ingest_checkpoints.last_pmid), complete=EXCLUDED.complete, update_date=EXCLUDED.update_date;",
+                (os.path.basename(ftp_fn), record_offset, last_pmid, complete, datetime.datetime.now()))
+    cur.close()
+    dbutil.db.commit()
 
-            execute_values(cur, "INSERT INTO pubmed_excludes (pmid, pm_status, year, source_filename, clf_type, clf_score, clf_date, ptyp_rct, is_rct_precise, is_rct_balanced, is_rct_sensitive, indexing_method, score_svm, score_cnn, score_svm_cnn, score_svm_ptyp, score_cnn_ptyp, score_svm_cnn_ptyp, rct_probability, is_human, update_date) VALUES %s ON CONFLICT (pmid) DO UPDATE SET year=EXCLUDED.year, source_filename=EXCLUDED.source_filename, clf_type=EXCLUDED.clf_type, clf_score=EXCLUDED.clf_score, clf_date=EXCLUDED.clf_date, ptyp_rct=EXCLUDED.ptyp_rct, is_rct_precise=EXCLUDED.is_rct_precise, is_rct_balanced=EXCLUDED.is_rct_balanced, is_rct_sensitive=EXCLUDED.is_rct_sensitive, indexing_method=EXCLUDED.indexing_method, rct_probability=EXCLUDED.rct_probability, is_human=EXCLUDED.is_human, update_date=EXCLUDED.update_date;", exclude_rows, template="(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)")
 
-            cur.close()
-            dbutil.db.commit()
-        if updates:
-            dbutil.log_update(update_type='pubmed_update', source_filename=os.path.basename(ftp_fn), source_date=modtimes[os.path.basename(ftp_fn)], download_date=datetime.datetime.now())
+def entry_pmid(entry):
+    """
+    the PMID of a parsed entry (the last one, for an update file's delete list)
+    """
+    if 'action' not in entry:
+        return entry['pmid']
+    elif entry['action'] == 'update':
+        return entry['article']['pmid']
+    else:
+        return entry['pmids'][-1] if entry['pmids'] else None
 
-    log.info(str(stats))
+
+def resume_entries(entries, checkpoint):
+    """
+    skip the entries of a file which were staged before the checkpoint. the
+    last skipped entry has to be the checkpointed PMID, otherwise the file
+    has changed underneath us and None is returned (the run has to start
+    again without its checkpoints)
+    """
+    entries = iter(entries)
+    skipped = list(itertools.islice(entries, checkpoint['record_offset']))
+    if len(skipped) != checkpoint['record_offset'] or (skipped and entry_pmid(skipped[-1]) != checkpoint['last_pmid']):
+        log.warning("checkpoint for {} (record {}, PMID {}) does not match the file".format(
+            checkpoint['source_filename'], checkpoint['record_offset'], checkpoint['last_pmid']))
+        return None
+    return entries
+
+
+def stage_rows(include_rows, exclude_rows, pmids_to_delete, cache_rows=()):
+    """
+    bulk alternative to write_rows: COPY a batch into the unlogged staging
+    tables, to be merged into pubmed/pubmed_excludes by merge_staged() at the
+    end of the file. nothing is committed here (see save_checkpoint)
+
+    deletions are staged too, and applied by merge_staged
+    """
+    cur = dbutil.db.cursor()
+    # anything staged earlier for these PMIDs is superseded by the deletion
+    delete_pmids(cur, pmids_to_delete, tables=("pubmed_staging", "pubmed_excludes_staging"))
+    dbutil.copy_rows(cur, "pubmed_deletes_staging", ("pmid", ), ((pm, ) for pm in set(pmids_to_delete)))
+
+    dbutil.copy_rows(cur, "pubmed_staging", pubmed_columns, include_rows)
+    dbutil.copy_rows(cur, "pubmed_excludes_staging", pubmed_excludes_columns, exclude_rows)
+
+    if cache_rows:
+        execute_values(cur, "INSERT INTO pubmed_clf_cache (content_hash, clf, clf_date, clf_version) VALUES %s ON CONFLICT (content_hash) DO UPDATE SET clf=EXCLUDED.clf, clf_date=EXCLUDED.clf_date, clf_version=EXCLUDED.clf_version;", cache_rows)
+    cur.close()
+
+
+def merge_staged(delete_all=False):
+    """
+    upsert everything staged since the last merge in one statement per
+    table (the latest staged row wins for each PMID), then commit
+
+    staged deletions are applied first (any rows staged before a deletion
+    were dropped by stage_rows, so what is left comes after it)
+    delete_all = empty the pubmed table first, in the same transaction
+    """
+    cur = dbutil.db.cursor()
+    if delete_all:
+        log.warning("Deleting all entries from PubMed database")
+        cur.execute("DELETE FROM pubmed;")
+    deleted = {}
+    for table in pmid_tables:
+        cur.execute("DELETE FROM {} WHERE pmid IN (SELECT pmid FROM pubmed_deletes_staging);".format(table))
+        if cur.rowcount:
+            deleted[table] = cur.rowcount
+    if deleted:
+        log.info("applying the staged deletions removed rows from {}".format(deleted))
+    for table, columns in (("pubmed", pubmed_columns), ("pubmed_excludes", pubmed_excludes_columns)):
+        cols = ', '.join(columns)
+        updates = ', '.join('{0}=EXCLUDED.{0}'.format(c) for c in upsert_columns if c in columns)
+        cur.execute("INSERT INTO {table} ({cols}) SELECT DISTINCT ON (pmid) {cols} FROM {table}_staging ORDER BY pmid, seq DESC "
+                    "ON CONFLICT (pmid) DO UPDATE SET {updates};".format(table=table, cols=cols, updates=updates))
+    # the checkpoints only describe what was staged
+    cur.execute("TRUNCATE pubmed_staging, pubmed_excludes_staging, pubmed_deletes_staging, ingest_checkpoints;")
+    cur.close()
     dbutil.db.commit()
-    if len(stats) == 0:
-        log.info("There are no new Pubmed updates for now.")
+
 
 # def meshify_pico():
 #     """
@@ -582,61 +1333,92 @@ def annotate_rcts(force_refresh=False, limit_to='is_rct_balanced', batch_size=10
         # deleting doi table from database
         log.info('deleting all PICO data from table...')
         cur.execute('delete from pubmed_annotations;')
-        already_done_picos = set()
-    else:
-        log.info('getting list of all PICOs done so far...')
-        cur.execute("SELECT pmid FROM pubmed_annotations;")
-        records = cur.fetchall()
-        already_done_picos = set((r['pmid'] for r in records))
 
 
     log.info('Fetching data to annotate')
-    cur.execute("SELECT pmid, ti, ab FROM pubmed WHERE {}=true;".format(limit_to))
-    records = cur.fetchall()
-    print(f'{len(records)} pubmed articles found')
-    print(f'{len(already_done_picos)} already_done_picos')
+    # only the articles without annotations are streamed, from a server side
+    # cursor (held open over the commits below)
+    todo_cur = dbutil.db.cursor(name='pubmed_to_annotate', cursor_factory=psycopg2.extras.RealDictCursor, withhold=True)
+    todo_cur.itersize = batch_size * 10
+    todo_cur.execute("SELECT pm.pmid, pm.ti, pm.ab FROM pubmed pm WHERE pm.{}=true AND NOT EXISTS (SELECT 1 FROM pubmed_annotations pa WHERE pa.pmid = pm.pmid);".format(limit_to))
     log.info('PICO annotation in progress')
 
-    for r in tqdm.tqdm(grouper(records, batch_size), desc='100s articles annotated'):
-
-        r_f = [i for i in r if i['pmid'] not in already_done_picos]
-
-        if r_f:
-
-            annotations = predict(r_f, tasks=['pico_span_bot', 'sample_size_bot', 'bias_ab_bot', 'punchline_bot'], filter_rcts='none')
-
-            for a in annotations:
-
-
-                sample_size = a.get('sample_size_bot', {}).get('num_randomized')
-                if sample_size == 'not found' or int(sample_size) > 1000000:
-                    sample_size = None
-
-                cur.execute("INSERT INTO pubmed_annotations (pmid, population, interventions, outcomes, population_mesh, interventions_mesh, outcomes_mesh, population_berts, interventions_berts, outcomes_berts, num_randomized, prob_low_rob, punchline_text, effect) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s);",
-                    (a['pmid'],
-                     json.dumps(a['pico_span_bot']['population']),
-                     json.dumps(a['pico_span_bot']['interventions']),
-                     json.dumps(a['pico_span_bot']['outcomes']),
-                     json.dumps(a['pico_span_bot']['population_mesh']),
-                     json.dumps(a['pico_span_bot']['interventions_mesh']),
-                     json.dumps(a['pico_span_bot']['outcomes_mesh']),
-                     a['pico_span_bot']['population_berts'],
-                     a['pico_span_bot']['interventions_berts'],
-                     a['pico_span_bot']['outcomes_berts'],
-                     sample_size,
-                     a['bias_ab_bot']['prob_low_rob'],
-                     a['punchline_bot']['punchline_text'],
-                     a['punchline_bot']['effect']
-                     ))
-
-            dbutil.db.commit()
-
+    num_annotated = 0
+    pbar = tqdm.tqdm(desc='100s articles annotated')
+
+    def write_annotations(annotations):
+        execute_values(cur, "INSERT INTO pubmed_annotations (pmid, population, interventions, outcomes, population_mesh, interventions_mesh, outcomes_mesh, population_berts, interventions_berts, outcomes_berts, num_randomized, prob_low_rob, punchline_text, effect, abbrev_dict) VALUES %s;",
+                       [annotation_row(a) for a in annotations])
+        dbutil.db.commit()
+        pbar.update(1)
+
+    # up to annotate_workers RobotReviewer batches are in flight at once;
+    # fetching and writing stay in this thread
+    with ThreadPoolExecutor(max_workers=annotate_workers) as executor:
+        pending = collections.deque()
+        for r_f in iter(lambda: todo_cur.fetchmany(batch_size), []):
+            num_annotated += len(r_f)
+            pending.append(executor.submit(predict, r_f, tasks=['pico_span_bot', 'sample_size_bot', 'bias_ab_bot', 'punchline_bot'], filter_rcts='none'))
+            if len(pending) >= annotate_workers:
+                write_annotations(pending.popleft().result())
+        while pending:
+            write_annotations(pending.popleft().result())
+
+    pbar.close()
+    todo_cur.close()
+    cur.close()
+    log.info(f'{num_annotated} pubmed articles annotated')
     update_type = "picospan_full" if force_refresh else "picospan_partial"
     dbutil.log_update(update_type=update_type, source_date=datetime.datetime.now())
 
 
-def update():
-    download_ftp_baseline()
-    download_ftp_updates()
+def annotation_row(a):
+    """
+    pubmed_annotations row for a RobotReviewer annotation
+    """
+    sample_size = a.get('sample_size_bot', {}).get('num_randomized')
+    if sample_size == 'not found' or int(sample_size) > 1000000:
+        sample_size = None
+
+    return (a['pmid'],
+            json.dumps(a['pico_span_bot']['population']),
+            json.dumps(a['pico_span_bot']['interventions']),
+            json.dumps(a['pico_span_bot']['outcomes']),
+            json.dumps(a['pico_span_bot']['population_mesh']),
+            json.dumps(a['pico_span_bot']['interventions_mesh']),
+            json.dumps(a['pico_span_bot']['outcomes_mesh']),
+            a['pico_span_bot']['population_berts'],
+            a['pico_span_bot']['interventions_berts'],
+            a['pico_span_bot']['outcomes_berts'],
+            sample_size,
+            a['bias_ab_bot']['prob_low_rob'],
+            a['punchline_bot']['punchline_text'],
+            a['punchline_bot']['effect'],
+            json.dumps(schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=a.get('ab'))))
+
+
+def backfill_abbrev_dicts(batch_size=1000):
+    """
+    fill in abbrev_dict for annotations written before it was computed
+    """
+    cur = dbutil.db.cursor()
+    todo_cur = dbutil.db.cursor(name='abbrevs_to_backfill', withhold=True)
+    todo_cur.itersize = batch_size * 10
+    todo_cur.execute("SELECT pa.pmid, pm.ab FROM pubmed_annotations pa, pubmed pm WHERE pa.pmid = pm.pmid AND pa.abbrev_dict IS NULL;")
+
+    num_updated = 0
+    for rows in tqdm.tqdm(iter(lambda: todo_cur.fetchmany(batch_size), []), desc='abbreviation batches'):
+        execute_values(cur, "UPDATE pubmed_annotations pa SET abbrev_dict = v.abbrev_dict::jsonb FROM (VALUES %s) AS v(pmid, abbrev_dict) WHERE pa.pmid = v.pmid;",
+                       [(pmid, json.dumps(schwartz_hearst.extract_abbreviation_definition_pairs(doc_text=ab))) for pmid, ab in rows])
+        dbutil.db.commit()
+        num_updated += len(rows)
+
+    todo_cur.close()
+    cur.close()
+    log.info(f'{num_updated} pubmed abbreviation dictionaries backfilled')
+
+
+def update(workers=1):
+    download_ftp_baseline(workers=workers)
+    download_ftp_updates(workers=workers)
     annotate_rcts()
-    update_counts()
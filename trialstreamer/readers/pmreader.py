@@ -25,6 +25,28 @@ def list_bounds(input_list, index, boundary):
     return input_list[index_lower:index_upper]
 
 
+def parse_pages(page_string):
+    parts = page_string.split('-')
+    if len(parts) == 2:
+        l0, l1 = len(parts[0]), len(parts[1])
+        page_to = parts[0][:l0-l1] + parts[1]
+        page_from = parts[0]
+        return {"page_from":page_from, "page_to":page_to}
+    elif len(parts)==1:
+        page_from, page_to = parts[0], parts[0]
+        return {"page_from":page_from, "page_to":page_to}
+    else:
+        return {}
+
+
+def yr_proc(raw_date):
+    m = re.search(r"\b(19|20)\d{2}\b", raw_date)
+    if m:
+        return m.group(0)
+    else:
+        return None
+
+
 class NLMCorpusReader(XMLReader):
     pass
 
@@ -128,24 +150,10 @@ class PubmedCorpusReader(NLMCorpusReader):
         return None
 
     def parse_pages(self, page_string):
-        parts = page_string.split('-')
-        if len(parts) == 2:
-            l0, l1 = len(parts[0]), len(parts[1])
-            page_to = parts[0][:l0-l1] + parts[1]
-            page_from = parts[0]
-            return {"page_from":page_from, "page_to":page_to}
-        elif len(parts)==1:
-            page_from, page_to = parts[0], parts[0]
-            return {"page_from":page_from, "page_to":page_to}
-        else:
-            return {}
+        return parse_pages(page_string)
 
     def yr_proc(self, raw_date):
-        m = re.search(r"\b(19|20)\d{2}\b", raw_date)
-        if m:
-            return m.group(0)
-        else:
-            return None
+        return yr_proc(raw_date)
 
     def year(self):
         yr_try1 = self.text_filtered('year')
@@ -181,3 +189,234 @@ class PubmedCorpusReader(NLMCorpusReader):
 
     def indexing_method(self):
         return self.data.attrib.get('IndexingMethod', 'Human')
+
+
+def _text(el):
+    "text of an element as XMLReader._ET2unicode gives it (stripped)"
+    if el is None:
+        return ""
+    parts = list(el.itertext())
+    if el.tail:
+        parts.append(el.tail)
+    return ' '.join(parts).strip()
+
+
+summary_fields = ("pmid", "status", "indexing_method", "title", "abstract",
+                  "abstract_plaintext", "year", "ptyp")
+
+
+def citation_to_dict(elem, summary_only=False):
+    """
+    single pass equivalent of PubmedCorpusReader(xml_ET=elem).to_dict()
+
+    walks the MedlineCitation once, picking up only the fields we store,
+    rather than running a path lookup per field. elem can be from
+    ElementTree or lxml
+
+    summary_only=True gives just the summary_fields (those needed to
+    classify the record and store it as an exclude)
+    """
+    pmid = title = vernacular_title = journal = journal_abbrv = None
+    volume = issue = year = medlinedate = month = pages = None
+    abstract, authors, mesh, ptyp, registry_ids, dois = [], [], [], [], [], []
+
+    for child in elem:
+        tag = child.tag
+        if tag == 'PMID':
+            if pmid is None:
+                pmid = child
+        elif tag == 'MeshHeadingList' and not summary_only:
+            for heading in child:
+                if heading.tag == 'MeshHeading':
+                    mesh.extend(_text(d) for d in heading if d.tag == 'DescriptorName')
+        elif tag == 'Article':
+            for a in child:
+                tag = a.tag
+                if tag == 'ArticleTitle':
+                    if title is None:
+                        title = a
+                elif tag == 'VernacularTitle':
+                    if vernacular_title is None:
+                        vernacular_title = a
+                elif tag == 'Abstract':
+                    for sec in a:
+                        if sec.tag == 'AbstractText':
+                            abstract.append({"header": sec.get('Label', "_UNSTRUCTURED"),
+                                             "text": _text(sec)})
+                elif tag == 'Journal':
+                    for j in a:
+                        tag = j.tag
+                        if tag == 'Title':
+                            if journal is None:
+                                journal = j
+                        elif tag == 'ISOAbbreviation':
+                            if journal_abbrv is None:
+                                journal_abbrv = j
+                        elif tag == 'JournalIssue':
+                            for ji in j:
+                                tag = ji.tag
+                                if tag == 'Volume':
+                                    if volume is None:
+                                        volume = ji
+                                elif tag == 'Issue':
+                                    if issue is None:
+                                        issue = ji
+                                elif tag == 'PubDate':
+                                    for d in ji:
+                                        tag = d.tag
+                                        if tag == 'Year':
+                                            if year is None:
+                                                year = d
+                                        elif tag == 'MedlineDate':
+                                            if medlinedate is None:
+                                                medlinedate = d
+                                        elif tag == 'Month':
+                                            if month is None:
+                                                month = d
+                elif tag == 'PublicationTypeList':
+                    ptyp.extend(_text(p) for p in a if p.tag == 'PublicationType')
+                elif summary_only:
+                    continue
+                elif tag == 'Pagination':
+                    for p in a:
+                        if p.tag == 'MedlinePgn' and pages is None:
+                            pages = p
+                elif tag == 'ELocationID':
+                    if a.get('EIdType') == 'doi':
+                        dois.append(a.text)
+                elif tag == 'AuthorList':
+                    for author_el in a:
+                        if author_el.tag == 'Author':
+                            authors.append(_author(author_el))
+                elif tag == 'DataBankList':
+                    for bank in a:
+                        if bank.tag == 'DataBank':
+                            for acc_list in bank:
+                                if acc_list.tag == 'AccessionNumberList':
+                                    registry_ids.extend(_text(n) for n in acc_list if n.tag == 'AccessionNumber')
+
+    title_text = _text(title)
+    if title_text == '' or title_text == '[Not Available].':
+        title_text = _text(vernacular_title)
+        if title_text == '[Not Available].':
+            title_text = ''
+
+    abstract_plaintext = []
+    for sec in abstract:
+        if sec["header"] != "_UNSTRUCTURED":
+            abstract_plaintext.append(sec["header"])
+            abstract_plaintext.append("\n")
+        abstract_plaintext.append(sec["text"])
+
+    year_text = _text(year)
+    if year_text == '':
+        year_text = yr_proc(_text(medlinedate))
+
+    if summary_only:
+        return {"pmid": _text(pmid),
+                "status": elem.get('Status'),
+                "indexing_method": elem.get('IndexingMethod', 'Human'),
+                "title": title_text,
+                "abstract": abstract,
+                "abstract_plaintext": "\n".join(abstract_plaintext),
+                "year": year_text,
+                "ptyp": ptyp}
+
+    return {"pmid": _text(pmid),
+            "status": elem.get('Status'),
+            "indexing_method": elem.get('IndexingMethod', 'Human'),
+            "title": title_text,
+            "abstract": abstract,
+            "abstract_plaintext": "\n".join(abstract_plaintext),
+            "authors": authors,
+            "journal": _text(journal),
+            "journal_abbrv": _text(journal_abbrv),
+            "year": year_text,
+            "mesh": mesh,
+            "month": _text(month),
+            "volume": _text(volume),
+            "issue": _text(issue),
+            "pages": parse_pages(_text(pages)),
+            "ptyp": ptyp,
+            "registry_ids": registry_ids,
+            "dois": dois}
+
+
+class LazyCitation(dict):
+    """
+    a MedlineCitation with only the summary_fields extracted; the full record
+    (authors, MeSH, etc) is only built if full() is called
+
+    parts of the citation which full() doesn't read are dropped from the
+    element straight away. pickling (e.g. back from a pool worker) sends the
+    summary and the pruned element as XML, which full() parses again if it
+    is ever called
+    """
+
+    keep_tags = ('PMID', 'Article', 'MeshHeadingList')
+
+    def __init__(self, elem=None, full=None, summary=None, xml=None):
+        self._xml = None
+        if full is not None:
+            super().__init__((k, full[k]) for k in summary_fields)
+            self._elem = None
+            self._full = full
+        elif xml is not None:
+            super().__init__(summary)
+            self._elem = None
+            self._xml = xml
+            self._full = None
+        else:
+            super().__init__(citation_to_dict(elem, summary_only=True))
+            for child in list(elem):
+                if child.tag not in self.keep_tags:
+                    elem.remove(child)
+            self._elem = elem
+            self._full = None
+
+    def full(self):
+        if self._full is None:
+            if self._elem is None:
+                self._elem = ET.fromstring(self._xml)
+                self._xml = None
+            self._full = citation_to_dict(self._elem)
+            self._elem = None
+        return self._full
+
+    def __reduce__(self):
+        if self._full is not None:
+            return (LazyCitation, (None, self._full))
+        if self._xml is None:
+            self._xml = element_to_bytes(self._elem)
+            self._elem = None
+        return (LazyCitation, (None, None, dict(self), self._xml))
+
+
+def element_to_bytes(elem):
+    if hasattr(elem, 'getparent'):
+        # lxml
+        from lxml import etree
+        return etree.tostring(elem, with_tail=False)
+    return ET.tostring(elem)
+
+
+def _author(author_el):
+    initials = last_name = fore_name = affiliation = None
+    for el in author_el:
+        tag = el.tag
+        if tag == 'Initials':
+            if initials is None:
+                initials = el
+        elif tag == 'LastName':
+            if last_name is None:
+                last_name = el
+        elif tag == 'ForeName':
+            if fore_name is None:
+                fore_name = el
+        elif tag == 'AffiliationInfo' and affiliation is None:
+            for aff in el:
+                if aff.tag == 'Affiliation':
+                    affiliation = aff
+                    break
+    return {"Initials": _text(initials), "LastName": _text(last_name),
+            "ForeName": _text(fore_name), "Affiliation": _text(affiliation)}
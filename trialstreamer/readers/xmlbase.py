@@ -50,8 +50,12 @@ class XMLReader():
         if ET_instance is not None:
             if strip_tags:
                 # print "tags stripped!"
-                return ' '.join([s for s in ET.tostringlist(
-                                        ET_instance, method="text", encoding="unicode") if s is not None])
+                # same pieces as ET.tostringlist(method="text") (incl. the tail),
+                # without serialising the element
+                parts = list(ET_instance.itertext())
+                if ET_instance.tail:
+                    parts.append(ET_instance.tail)
+                return ' '.join(parts)
 
             else:
                 return ET.tostring(ET_instance, method="xml", encoding="utf-8").decode("utf-8")
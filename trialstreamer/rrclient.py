@@ -0,0 +1,174 @@
+#
+#   RobotReviewer REST API client
+#
+
+from trialstreamer import config
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
+
+
+class RobotReviewerClient():
+    """
+    shared client for the RobotReviewer queue-documents API
+
+    - one pooled HTTP session is reused for every request
+    - predict() splits the articles into chunks and keeps up to
+      max_in_flight reports queued at once, returning results in order
+    - report status is polled with exponential backoff
+    - connection errors and 5xx responses are retried up to retry_attempts
+      times, waiting retry_backoff * 2**(attempt - 1) seconds before each
+    - timeout applies to the status and report requests; the upload
+      (queue-documents) waits upload_timeout, which by default is no limit,
+      as large chunks can take a while to be accepted
+    - the chunk size is tuned from observed latency: it starts at
+      max_batch_size (i.e. one report per call, as before), then after each
+      predict() takes a step up or down depending on whether the last step
+      raised or lowered throughput (articles/s); it also shrinks whenever a
+      single report takes longer than target_latency seconds
+    """
+
+    def __init__(self, base_url=None, api_key=None, max_in_flight=4, batch_size=None,
+                 min_batch_size=50, max_batch_size=5000, target_latency=60,
+                 poll_initial=0.1, poll_max=2.0, poll_factor=1.3, timeout=60,
+                 upload_timeout=None, retry_attempts=3, retry_backoff=1.0):
+        self.base_url = base_url or config.ROBOTREVIEWER_URL
+        self.headers = {"api-key": api_key if api_key is not None else config.ROBOTREVIEWER_API_KEY}
+        self.max_in_flight = max_in_flight
+        self.batch_size = batch_size or max_batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.poll_initial = poll_initial
+        self.poll_max = poll_max
+        self.poll_factor = poll_factor
+        self.timeout = timeout
+        self.upload_timeout = upload_timeout
+        self.retry_attempts = retry_attempts
+        self.retry_backoff = retry_backoff
+        self.stats = {"reports": 0, "articles": 0, "seconds": 0.0}
+        self._last_rate = None
+        self._direction = -1
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_in_flight * 2)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def _request(self, method, path, timeout=None, **kwargs):
+        """
+        one API request, retried on connection errors and 5xx responses
+        """
+        attempt = 0
+        while True:
+            try:
+                r = self.session.request(method, self.base_url + path, headers=self.headers, timeout=timeout, **kwargs)
+                if r.status_code < 500:
+                    return r
+                error = requests.HTTPError(f'{r.status_code} response from RobotReviewer for {path}', response=r)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            attempt += 1
+            if attempt > self.retry_attempts:
+                raise error
+            log.info(f'RobotReviewer request {path} failed ({error}), retrying ({attempt})...')
+            time.sleep(self.retry_backoff * 2 ** (attempt - 1))
+
+    def queue_documents(self, X, tasks, filter_rcts):
+        upload_data = {
+            "articles": X,
+            "robots": tasks,
+            "filter_rcts": filter_rcts
+        }
+        r = self._request('POST', 'queue-documents', json=upload_data, timeout=self.upload_timeout)
+        response = r.json()
+        if 'report_id' not in response:
+            raise Exception(f'Invalid response for RobotReviewer API request: {response}')
+        log.info(f"Queued {len(X)} documents with report ID: {response['report_id']}")
+        return response['report_id']
+
+    def wait_for_report(self, report_id):
+        delay = self.poll_initial
+        while True:
+            r = self._request('GET', 'report-status/' + report_id, timeout=self.timeout)
+            if r.json()['state'] == 'SUCCESS':
+                break
+            time.sleep(delay)
+            delay = min(delay * self.poll_factor, self.poll_max)
+        return self._request('GET', 'report/' + report_id, timeout=self.timeout).json()
+
+    def run_report(self, X, tasks, filter_rcts):
+        start = time.time()
+        report = self.wait_for_report(self.queue_documents(X, tasks, filter_rcts))
+        self._observe(len(X), time.time() - start)
+        return report
+
+    def _observe(self, n, latency):
+        with self._lock:
+            self.stats["reports"] += 1
+            self.stats["articles"] += n
+            self.stats["seconds"] += latency
+            if latency > self.target_latency:
+                self.batch_size = max(self.min_batch_size, int(self.batch_size / 1.5))
+                self._last_rate = None
+
+    def _tune(self, n, elapsed):
+        """
+        hill climb the chunk size on throughput across predict() calls
+        """
+        if n < self.batch_size or elapsed <= 0:
+            # too small to say anything about the chunk size
+            return
+        with self._lock:
+            rate = n / elapsed
+            if self._last_rate is not None and rate < self._last_rate:
+                self._direction = -self._direction
+            self._last_rate = rate
+            self.batch_size = int(self.batch_size * (1.25 ** self._direction))
+            self.batch_size = min(self.max_batch_size, max(self.min_batch_size, self.batch_size))
+            log.debug(f"RobotReviewer {rate:.0f} articles/s, chunk size now {self.batch_size}")
+
+    def predict(self, X, tasks=None, filter_rcts="is_rct_sensitive"):
+        if tasks is None:
+            tasks = ['rct_bot']
+        X = list(X)
+        size = self.batch_size
+        chunks = [X[i:i + size] for i in range(0, len(X), size)]
+
+        start = time.time()
+        if len(chunks) <= 1:
+            out = self.run_report(X, tasks, filter_rcts)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+                reports = executor.map(lambda chunk: self.run_report(chunk, tasks, filter_rcts), chunks)
+                out = [r for report in reports for r in report]
+        self._tune(len(X), time.time() - start)
+        return out
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    the per-process client, set up from the config
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = RobotReviewerClient(max_in_flight=getattr(config, 'ROBOTREVIEWER_MAX_IN_FLIGHT', 4),
+                                          target_latency=getattr(config, 'ROBOTREVIEWER_TARGET_LATENCY', 60),
+                                          upload_timeout=getattr(config, 'ROBOTREVIEWER_UPLOAD_TIMEOUT', None) or None,
+                                          retry_attempts=getattr(config, 'ROBOTREVIEWER_RETRY_ATTEMPTS', 3))
+        return _client
+
+
+def predict(X, tasks=None, filter_rcts="is_rct_sensitive"):
+    return get_client().predict(X, tasks=tasks, filter_rcts=filter_rcts)
@@ -0,0 +1,116 @@
+#
+#   picosearch result cache, shared by the API workers
+#
+
+import trialstreamer
+from trialstreamer import config
+from collections import OrderedDict
+from flask import json
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# a new row of one of these in update_log means the search results may have changed
+update_types = ('fullcheck', 'ictrp', 'medrxiv')
+
+
+def cache_key(terms, order, expand_terms, retmode):
+    """
+    key for a query, independent of the order of the terms and of any
+    fields besides cui and field
+    """
+    norm_terms = sorted((t['field'], t['cui']) for t in terms)
+    key = json.dumps([norm_terms, order, bool(expand_terms), retmode])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class SearchCache():
+    """
+    LRU cache of search results in an sqlite file, so all the gunicorn
+    workers on a machine share it
+
+    each entry is stored with the data generation it was computed for (the
+    latest update_log id of the update_types); entries from an older
+    generation are misses, and are cleared out by the next newer put
+
+    values are stored as JSON (as the API would return them), in a file
+    only readable by the user running the API
+    """
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0}
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        if os.stat(path).st_uid != os.getuid():
+            raise PermissionError(f"{path} belongs to another user")
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self.lock, self.db as db:
+            db.execute("PRAGMA journal_mode=WAL;")
+            db.execute("CREATE TABLE IF NOT EXISTS search_results (key TEXT PRIMARY KEY, generation INTEGER, value TEXT, last_used REAL);")
+            db.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON search_results (last_used);")
+
+    def get(self, key, generation):
+        with self.lock, self.db as db:
+            row = db.execute("SELECT value FROM search_results WHERE key = ? AND generation = ?;", (key, generation or 0)).fetchone()
+            if row is None:
+                self.metrics["misses"] += 1
+                return None
+            db.execute("UPDATE search_results SET last_used = ? WHERE key = ?;", (time.time(), key))
+        self.metrics["hits"] += 1
+        return json.loads(row[0], object_pairs_hook=OrderedDict)
+
+    def put(self, key, generation, value):
+        value = json.dumps(value)
+        with self.lock, self.db as db:
+            db.execute("INSERT OR REPLACE INTO search_results (key, generation, value, last_used) VALUES (?, ?, ?, ?);",
+                       (key, generation or 0, value, time.time()))
+            db.execute("DELETE FROM search_results WHERE generation < ?;", (generation or 0, ))
+            db.execute("DELETE FROM search_results WHERE key IN (SELECT key FROM search_results ORDER BY last_used DESC LIMIT -1 OFFSET ?);", (self.max_entries, ))
+
+    def stats(self):
+        with self.lock, self.db as db:
+            entries = db.execute("SELECT count(*) FROM search_results;").fetchone()[0]
+        return dict(self.metrics, entries=entries, max_entries=self.max_entries)
+
+
+def data_generation(db):
+    """
+    id of the latest update_log row which changes search results
+    """
+    cur = db.cursor()
+    cur.execute("SELECT max(id) FROM update_log WHERE update_type IN %s;", (update_types, ))
+    generation = cur.fetchone()[0]
+    cur.close()
+    return generation
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    the cache from the config (picosearch_cache_path, picosearch_cache_size),
+    or None if picosearch_cache_size is 0
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            size = getattr(config, 'PICOSEARCH_CACHE_SIZE', 1000)
+            if not size:
+                return None
+            path = getattr(config, 'PICOSEARCH_CACHE_PATH', None)
+            if not path:
+                cache_dir = os.path.join(trialstreamer.DATA_ROOT, 'cache')
+                os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+                path = os.path.join(cache_dir, 'picosearch.sqlite')
+            log.info(f"picosearch cache at {path} ({size} entries)")
+            _cache = SearchCache(path, max_entries=size)
+        return _cache
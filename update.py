@@ -1,7 +1,7 @@
 import argparse
 import datetime
 from trialstreamer import pubmed
-from trialstreamer.dbutil import db, log_update
+from trialstreamer.dbutil import db, log_update, migrate
 
 
 if __name__ == "__main__":
@@ -9,6 +9,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Trialstreamer daily update script')
 
     parser.add_argument('--source', type=str, help='pubmed|medrxiv')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes for parsing PubMed files (default 1)')
+    parser.add_argument('--migrate', action='store_true', help='apply the one-off database changes after upgrading (backfills and triggers), then exit')
+    parser.add_argument('--backfill-abbrevs', action='store_true', help='compute the abbreviation dictionaries missing from earlier annotations, then exit')
 
     args = parser.parse_args()
 
@@ -20,12 +23,22 @@ if __name__ == "__main__":
     # FIRST DO UPDATES
     # NB! RobotReviewer MUST be running locally in API mode (ideally on a GPU)
 
-    if not args.source:
+    if args.migrate:
+        print("Migrating the database")
+        migrate()
+        print("Done! :)")
+    elif args.backfill_abbrevs:
+        print("Backfilling abbreviation dictionaries")
+        pubmed.backfill_abbrev_dicts()
+        from trialstreamer import medrxiv_cov
+        medrxiv_cov.backfill_abbrev_dicts()
+        print("Done! :)")
+    elif not args.source:
         print("Missing --source argument")
         parser.print_help()
     elif args.source == 'pubmed':
         print("Downloading any updates from PubMed")
-        pubmed.download_ftp_updates()
+        pubmed.download_ftp_updates(workers=args.workers)
         print("Annotating using RobotReviewer")
         pubmed.annotate_rcts()
         print("Updating counts")